@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+"""
+VOT Benchmark
+=============
+Runs the trackers over a VOT sequence and scores them against the sequence ground truth using the VOT supervised
+protocol: the tracker is initialized on the ground truth, a frame with no overlap is a failure, and the tracker is
+re-initialized a few frames after every failure.
+
+Reported per tracker:
+ accuracy => mean overlap with the ground truth, ignoring the burn-in frames after every (re-)initialization.
+ failures => number of times the tracker lost the target (robustness).
+ fps => frames tracked per second, including decoding (or reading from a frame store with --store).
+ latency => per-stage latency percentiles in milliseconds, including the stages the trackers report to their probe.
+ counters => totals of the counters the trackers report to their probe (points tracked, detections, ...).
+ search => number of frames searched by each path, for trackers that report one (ROI or full frame cascade search).
+ attributes => accuracy and failures restricted to the frames carrying each per-frame attribute label.
+
+Results are written as JSON, and can be compared against a previous results file to catch regressions.
+"""
+
+import argparse
+import glob
+import json
+import os
+import time
+
+import numpy as np
+
+import cascade_tracker
+import dense_optical_flow
+import frame_store
+import hybrid_tracker
+import instrumentation
+import lk_tracker
+import orb_tracker
+import pipeline
+import resolution
+import utilities
+
+# Frames skipped after a failure before the tracker is re-initialized, and frames after an initialization that are
+# not counted towards accuracy, as in the VOT 2014 evaluation kit
+SKIP_FRAMES = 5
+BURN_IN_FRAMES = 10
+
+# Latency percentiles that are reported for every stage
+PERCENTILES = (50, 90, 99)
+
+# Trackers that can be benchmarked, each called with the frames to track, the initial rectangle and the probe the
+# tracker reports its stages and counters to
+TRACKERS = {
+    'lk': lambda frames, rect, probe: lk_tracker.lk_track(frames, car_rect=rect, probe=probe),
+    'lk_adaptive': lambda frames, rect, probe: lk_tracker.lk_track(frames, car_rect=rect, min_car_points=8,
+                                                                   probe=probe),
+    'orb': lambda frames, rect, probe: orb_tracker.orb_track(frames, car_rect=rect, probe=probe),
+    'cascade': lambda frames, rect, probe: cascade_tracker.cascade_track(frames, './resources/cars3.xml',
+                                                                         probe=probe),
+    'cascade_roi': lambda frames, rect, probe: cascade_tracker.cascade_track(frames, './resources/cars3.xml', True,
+                                                                             rect, probe=probe),
+    'dense': lambda frames, rect, probe: dense_optical_flow.dense_track(frames, rect, probe=probe),
+    'dense_half': lambda frames, rect, probe: dense_optical_flow.dense_track(frames, rect, scale=0.5, probe=probe),
+    'hybrid': lambda frames, rect, probe: hybrid_tracker.hybrid_track(frames, './resources/cars3.xml', rect,
+                                                                      probe=probe),
+    'lk_reduced': lambda frames, rect, probe: resolution.reduced_track(resolution.SCALED_TRACKERS['lk'], frames, rect,
+                                                                        probe=probe),
+    'orb_reduced': lambda frames, rect, probe: resolution.reduced_track(resolution.SCALED_TRACKERS['orb'], frames,
+                                                                         rect, probe=probe),
+    'dense_reduced': lambda frames, rect, probe: resolution.reduced_track(resolution.SCALED_TRACKERS['dense'], frames,
+                                                                           rect, probe=probe),
+    'fused': lambda frames, rect, probe: pipeline.multi_track(frames, rect, dict((name, TRACKERS[name])
+                                                                                 for name in ('lk', 'hybrid')),
+                                                              probe=probe),
+}
+
+
+def load_groundtruth(path):
+    """
+    Loads a VOT groundtruth.txt file. Every line is either a polygon (x1,y1,...,x4,y4) or a rectangle (x,y,w,h), both
+    are converted to the axis aligned rectangle used by the trackers
+
+    :param path: location of the groundtruth file
+    :return: N x 4 array of rectangles [X min, Y min, X max, Y max]
+    """
+    rects = []
+    with open(path) as f:
+        for line in f:
+            values = [float(v) for v in line.strip().split(',') if v]
+            if len(values) == 4:
+                x, y, w, h = values
+                rects.append([x, y, x + w, y + h])
+            else:
+                xs, ys = values[0::2], values[1::2]
+                rects.append([min(xs), min(ys), max(xs), max(ys)])
+    return np.array(rects, np.float64)
+
+
+def load_labels(sequence):
+    """
+    Loads every per-frame attribute label file (*.label) of a sequence
+
+    :param sequence: directory of the sequence
+    :return: dict of label name to boolean array with one entry per frame
+    """
+    labels = {}
+    for path in sorted(glob.glob(os.path.join(sequence, '*.label'))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        labels[name] = np.loadtxt(path, ndmin=1).astype(bool)
+    return labels
+
+
+def run_supervised(tracker, imgs, gt):
+    """
+    Runs a tracker over a sequence with the VOT supervised protocol
+
+    :param tracker: callable taking (frames, initial rect, probe) and returning a generator of TrackResult
+    :param imgs: string array containing image file locations, or an array of already decoded frames
+    :param gt: N x 4 array of ground truth rectangles
+    :return: dict with per-frame rects, overlaps, a validity mask for accuracy, failure frames, stage timings and
+             counter totals
+    """
+    n_frames = min(len(imgs), len(gt))
+    rects = np.full((n_frames, 4), np.nan)
+    valid = np.zeros(n_frames, bool)
+    failures = []
+    stages = {'decode': [], 'track': [], 'frame': []}
+    counters = {}
+    search = {}
+
+    start = time.perf_counter()
+    init_idx = 0
+    while init_idx < n_frames:
+        # (Re-)initialize the tracker on the ground truth at init_idx
+        if isinstance(imgs, np.ndarray):
+            frames = imgs[init_idx:n_frames]
+        else:
+            frames = utilities.FrameSource(imgs[:n_frames], start=init_idx)
+        probe = instrumentation.Probe()
+        results = iter(tracker(frames, np.int32(np.round(gt[init_idx])), probe))
+        restart = None
+        while True:
+            tick = time.perf_counter()
+            result = next(results, None)
+            if result is None:
+                break
+            elapsed = time.perf_counter() - tick
+
+            # Fold the stages and counters the tracker reported for this frame, decode comes from the probe
+            record = probe.current
+            decode = record['stages'].get('decode', 0.0)
+            stages['decode'].append(decode)
+            stages['track'].append(elapsed - decode)
+            stages['frame'].append(elapsed)
+            for stage, seconds in record['stages'].items():
+                if stage != 'decode':
+                    stages.setdefault(stage, []).append(seconds)
+            for counter, n in record['counters'].items():
+                counters[counter] = counters.get(counter, 0) + n
+
+            frame_idx = init_idx + result.frame_idx
+            if 'search' in result.info:
+                search[result.info['search']] = search.get(result.info['search'], 0) + 1
+            if result.rect is not None:
+                rects[frame_idx] = result.rect
+            valid[frame_idx] = frame_idx >= init_idx + BURN_IN_FRAMES
+
+            # A frame that does not overlap the ground truth at all is a failure, skip ahead and re-initialize
+            if frame_idx > init_idx and utilities.rect_overlap(rects[frame_idx], gt[frame_idx])[0] <= 0:
+                failures.append(frame_idx)
+                restart = frame_idx + SKIP_FRAMES
+                break
+        if hasattr(results, 'close'):
+            results.close()
+        if restart is None:
+            break
+        init_idx = restart
+    wall = time.perf_counter() - start
+
+    return dict(rects=rects, overlaps=utilities.rect_overlap(rects, gt[:n_frames]), valid=valid, failures=failures,
+                stages=stages, counters=counters, search=search, wall=wall, n_tracked=len(stages['frame']))
+
+
+def percentiles(samples):
+    """
+    Summarizes latency samples in milliseconds
+
+    :param samples: array of latencies in seconds
+    :return: dict of mean and percentile latencies in milliseconds
+    """
+    samples = np.asarray(samples, np.float64) * 1000.0
+    if len(samples) == 0:
+        return {}
+    summary = {'mean': float(np.mean(samples))}
+    for p in PERCENTILES:
+        summary['p%d' % p] = float(np.percentile(samples, p))
+    return summary
+
+
+def score(run, labels):
+    """
+    Reduces a supervised run to accuracy, robustness, speed and per-attribute scores
+
+    :param run: dict returned by run_supervised
+    :param labels: dict of label name to per-frame boolean array
+    :return: dict of scores
+    """
+    n_frames = len(run['overlaps'])
+    failures = np.zeros(n_frames, bool)
+    failures[run['failures']] = True
+
+    def summarize(mask):
+        used = mask & run['valid']
+        return {'frames': int(mask.sum()),
+                'accuracy': float(np.mean(run['overlaps'][used])) if used.any() else None,
+                'failures': int(failures[mask].sum())}
+
+    summary = summarize(np.ones(n_frames, bool))
+    summary['fps'] = run['n_tracked'] / run['wall'] if run['wall'] > 0 else None
+    summary['latency'] = dict((stage, percentiles(samples)) for stage, samples in run['stages'].items())
+    summary['counters'] = run['counters']
+    if run['search']:
+        summary['search'] = run['search']
+
+    # Per attribute scores, plus the frames carrying no attribute at all
+    attributes = {}
+    any_label = np.zeros(n_frames, bool)
+    for name, label in labels.items():
+        label = label[:n_frames]
+        any_label |= label
+        attributes[name] = summarize(label)
+    if labels:
+        attributes['empty'] = summarize(~any_label)
+    summary['attributes'] = attributes
+    return summary
+
+
+def benchmark(sequence, trackers=('lk', 'orb', 'cascade'), store=None):
+    """
+    Benchmarks trackers on a VOT sequence
+
+    :param sequence: directory of the sequence, containing the images, groundtruth.txt and *.label files
+    :param trackers: names of the trackers in TRACKERS to run
+    :param store: optional directory of a frame store of the sequence to read frames from instead of decoding the
+                  images, built if it does not exist yet
+    :return: dict of results, ready to be written as JSON
+    """
+    imgs = utilities.get_jpeg(sequence)
+    if store is not None:
+        imgs = frame_store.open_store(sequence, store).frames
+    gt = load_groundtruth(os.path.join(sequence, 'groundtruth.txt'))
+    labels = load_labels(sequence)
+
+    results = {'sequence': sequence, 'frames': min(len(imgs), len(gt)), 'trackers': {}}
+    for name in trackers:
+        run = run_supervised(TRACKERS[name], imgs, gt)
+        results['trackers'][name] = score(run, labels)
+    return results
+
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Compares benchmark results against a baseline results file
+
+    :param results: dict returned by benchmark
+    :param baseline: dict returned by benchmark for a previous version
+    :param tolerance: relative drop in accuracy or fps (or rise in failures) that counts as a regression
+    :return: array of regression descriptions, empty if there are none
+    """
+    regressions = []
+    for name, current in results['trackers'].items():
+        previous = baseline.get('trackers', {}).get(name)
+        if previous is None:
+            continue
+        for key in ('accuracy', 'fps'):
+            if current[key] is not None and previous[key] and current[key] < previous[key] * (1 - tolerance):
+                regressions.append('%s %s dropped from %.3f to %.3f' % (name, key, previous[key], current[key]))
+        if current['failures'] > previous['failures'] * (1 + tolerance):
+            regressions.append('%s failures rose from %d to %d' % (name, previous['failures'], current['failures']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark trackers on a VOT sequence')
+    parser.add_argument('--sequence', default='./resources/car/', help='directory of the sequence')
+    parser.add_argument('--trackers', nargs='+', default=['lk', 'orb', 'cascade'], choices=sorted(TRACKERS))
+    parser.add_argument('--output', default='benchmark.json', help='JSON file the results are written to')
+    parser.add_argument('--baseline', help='previous results file to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative change counted as a regression')
+    parser.add_argument('--store', help='frame store to read the decoded frames from, see frame_store.py')
+    args = parser.parse_args()
+
+    results = benchmark(args.sequence, args.trackers, args.store)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    for name, summary in sorted(results['trackers'].items()):
+        print('%-8s accuracy %s  failures %d  fps %.1f' % (name, summary['accuracy'], summary['failures'],
+                                                           summary['fps']))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION: ' + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -10,83 +10,165 @@ at each frame in an array.
 import cv2
 import numpy as np
 
+import checkpoint
+import instrumentation
 import utilities
 
 
-def cascade(imgs, cascade_classifier, display_image=True, write_video=False, video_name='HAAR.avi'):
+def load_cascade(cascade_classifier):
     """
-    Gives the average position of a haar cascade classifier and displays image stream with classifier matches
+    Loads a cascade classifier, classifiers that are already loaded are returned as is
 
-    :param imgs: string array containing image file locations
-    :param cascade_classifier: string containing file location of Haar classifier XML
-    :param display_image: flag determining whether or not to display the image stream
-    :param write_video: Flag determining whether or not to record image stream
-    :param video_name: File name of image stream
-    :return: array of average locations of the matches of the Haar classifier
+    :param cascade_classifier: string containing file location of Haar classifier XML, or a loaded CascadeClassifier
+    :return: CascadeClassifier
     """
+    if isinstance(cascade_classifier, str):
+        return cv2.CascadeClassifier(cascade_classifier)
+    return cascade_classifier
 
-    # Load cascade classifier
-    car_cascade = cv2.CascadeClassifier(cascade_classifier)
 
-    # If write_video flag, record a video
-    if write_video:
-        height, width, _ = cv2.imread(imgs[0]).shape
-        writer = cv2.VideoWriter(video_name, -1, 20, (width, height))
-
-    # Initialize the average position to an empty array
-    ave_pos = []
-
-    # Initialize frame index
-    frame_idx = 0
+def detect_cars(car_cascade, gray, rect=None, roi_expand=3.0, scale_range=(0.5, 2.0)):
+    """
+    Runs the cascade classifier over the full image, or only over a window around a rectangle for matches of a
+    similar size to it. Matches have the shape of the classifier's window (square for cars3.xml) whatever the shape
+    of the rectangle, so the sizes kept are relative to the smallest match covering the rectangle, and the window is
+    grown on both axes to hold the largest of them. Matches out of the size range are dropped after the search rather
+    than passed to the classifier as minSize and maxSize, with which it missed about 40% of the matches it finds on
+    resources/car.
+
+    :param car_cascade: loaded CascadeClassifier
+    :param gray: grayscale image
+    :param rect: optional car rectangle [X min, Y min, X max, Y max] to search around
+    :param roi_expand: size of the search window relative to the rectangle, at least the largest match kept
+    :param scale_range: smallest and largest match size kept, relative to the smallest match covering the rectangle
+    :return: array of matches (x, y, w, h) in image coordinates
+    """
+    if rect is None:
+        return car_cascade.detectMultiScale(gray)
+
+    # Sizes of the matches kept, in the shape of the classifier's window
+    window_w, window_h = car_cascade.getOriginalWindowSize()
+    w, h = rect[2] - rect[0], rect[3] - rect[1]
+    cover = max(w / float(window_w), h / float(window_h))
+    min_size = (max(1, int(window_w * cover * scale_range[0])), max(1, int(window_h * cover * scale_range[0])))
+    max_size = (int(window_w * cover * scale_range[1]) + 1, int(window_h * cover * scale_range[1]) + 1)
+
+    # Search window around the rectangle, large enough for the largest match, clipped to the image
+    cx, cy = utilities.rect_center(rect)
+    half_w = max(w * roi_expand, max_size[0]) / 2.0
+    half_h = max(h * roi_expand, max_size[1]) / 2.0
+    height, width = gray.shape[:2]
+    x0, y0 = int(max(0, cx - half_w)), int(max(0, cy - half_h))
+    x1, y1 = int(min(width, cx + half_w)), int(min(height, cy + half_h))
+    if x1 - x0 < min_size[0] or y1 - y0 < min_size[1]:
+        return ()
+    cars = car_cascade.detectMultiScale(gray[y0:y1, x0:x1])
+    cars = [car for car in cars if min_size[0] <= car[2] <= max_size[0] and min_size[1] <= car[3] <= max_size[1]]
+    if len(cars) == 0:
+        return ()
+
+    # Move the matches from window to image coordinates
+    return np.array(cars) + [x0, y0, 0, 0]
+
+
+def cascade_track(imgs, cascade_classifier, roi_search=False, car_rect=None, roi_expand=3.0, scale_range=(0.5, 2.0),
+                  max_misses=3, probe=instrumentation.NULL_PROBE, state=None,
+                  checkpointer=checkpoint.NULL_CHECKPOINTER, checkpoint_name='cascade'):
+    """
+    Generator running a haar cascade classifier on every frame. A TrackResult holding the average match rectangle is
+    yielded as soon as each frame is searched, no GUI calls are made.
+
+    In ROI search mode, once the car has been found only a window around the previous match is searched, and only for
+    matches of a similar size to the previous one. The full frame is scanned again after max_misses frames in a row
+    without a match. The path taken on each frame is given by info['search'], either 'roi' or 'full'.
+
+    :param imgs: string array containing image file locations, or a FrameSource
+    :param cascade_classifier: string containing file location of Haar classifier XML, or a loaded CascadeClassifier
+    :param roi_search: flag determining whether to search around the previous match instead of the full frame
+    :param car_rect: optional initial car position [X min, Y min, X max, Y max] to start the ROI search from
+    :param roi_expand: size of the search window relative to the previous match, see detect_cars
+    :param scale_range: smallest and largest match size kept, relative to the previous match, see detect_cars
+    :param max_misses: consecutive frames without a match in ROI search before falling back to the full frame
+    :param probe: instrumentation probe the stages and counters are reported to
+    :param state: state saved by a checkpointer to resume from, imgs then starts at its frame_idx and car_rect is
+                  ignored
+    :param checkpointer: checkpointer the state is saved through every interval frames, see checkpoint.py
+    :param checkpoint_name: name the state is saved and resumed under, e.g. the name of the configuration, so that
+                            configurations sharing a checkpoint directory never resume from each other's states
+    :return: generator of TrackResult, rect and center are None on frames without a match
+    """
 
-    # Loop through images, displaying every cascade match in a blue rectangle
-    while frame_idx < len(imgs):
-        # Load image at current index
-        frame = cv2.imread(imgs[frame_idx])
+    # Load cascade classifier
+    car_cascade = load_cascade(cascade_classifier)
 
-        # Create grayscale image for cascade classifier
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    # Load images, decoding ahead of the detection loop
+    frames = probe.frames(utilities.open_frames(imgs))
 
-        # Detect all classifier matches of grayscale image
-        cars = car_cascade.detectMultiScale(gray)
+    # Last matched rectangle and the number of frames since it was matched
+    last_rect = None if car_rect is None else np.int32(car_rect)
+    misses = 0
 
-        # Initialize the x,y positions at this frame to empty arrays
-        pos_x = []
-        pos_y = []
+    # Carry on from a checkpoint: the last match, if any, and the misses since
+    start = checkpoint.check_state(state, checkpoint_name)
+    if state is not None:
+        last_rect = np.int32(state['last_rect']) if len(state['last_rect']) else None
+        misses = int(state['misses'])
 
-        # Create rectangle for every match
-        for (x, y, w, h) in cars:
-            # Create a rectangle
-            cv2.rectangle(frame, (x, y), (x + w, y + h), (255, 0, 0))
-            pos_x.append(np.mean([x, x + w]))
-            pos_y.append(np.mean([y, y + h]))
+    # Loop through images
+    for frame_idx, frame in enumerate(frames, start):
 
-        # Only add a new position to the array if there was a classifier match
+        # Create grayscale image for cascade classifier
+        with probe.stage('gray'):
+            gray = utilities.to_gray(frame)
+
+        with probe.stage('detect'):
+            if roi_search and last_rect is not None and misses < max_misses:
+                # Search a window around the last match, for matches of about the same size
+                cars = detect_cars(car_cascade, gray, last_rect, roi_expand, scale_range)
+                search = 'roi'
+            else:
+                # Detect all classifier matches of grayscale image
+                cars = detect_cars(car_cascade, gray)
+                search = 'full'
+        probe.count(search + '_searches')
+        probe.count('detections', len(cars))
+
+        # Average the matches into a single rectangle and position, only if there was a classifier match
+        rect = None
+        center = None
         if len(cars) > 0:
-            ave_pos.append((np.mean(pos_x), np.mean(pos_y)))
+            x, y, w, h = np.array(cars, np.float64).T
+            rect = np.int32([np.mean(x), np.mean(y), np.mean(x + w), np.mean(y + h)])
+            center = (np.mean(x + w / 2), np.mean(y + h / 2))
+            last_rect = rect
+            misses = 0
+        else:
+            misses += 1
 
-        # Display the image if the display image flag is true
-        if display_image:
-            cv2.imshow('img', frame)
-            k = cv2.waitKey(30) & 0xff
-            if k == 27:
-                break
+        yield utilities.TrackResult(frame_idx, rect, center, len(cars), frame, None,
+                                    {'detections': cars, 'search': search})
 
-        # Write to video
-        if write_video:
-            writer.write(frame)
+        # Checkpoint once the consumer has taken the result, so that a resumed run starts with the next frame
+        if checkpointer.due(frame_idx):
+            with probe.stage('checkpoint'):
+                checkpointer.save({'tracker': checkpoint_name, 'frame_idx': frame_idx + 1, 'misses': misses,
+                                   'last_rect': np.zeros(0, np.int32) if last_rect is None else last_rect})
 
-        # Update the index
-        frame_idx += 1
 
-    # Close all windows
-    cv2.destroyAllWindows()
-
-    # Release the video
-    if write_video:
-        writer.release()
+def cascade(imgs, cascade_classifier, display_image=True, write_video=False, video_name='HAAR.avi', roi_search=False):
+    """
+    Gives the average position of a haar cascade classifier and displays image stream with classifier matches
 
-    return ave_pos
+    :param imgs: string array containing image file locations, or a FrameSource
+    :param cascade_classifier: string containing file location of Haar classifier XML
+    :param display_image: flag determining whether or not to display the image stream
+    :param write_video: Flag determining whether or not to record image stream
+    :param video_name: File name of image stream
+    :param roi_search: flag determining whether to search around the previous match instead of the full frame
+    :return: array of average locations of the matches of the Haar classifier
+    """
+    results = cascade_track(imgs, cascade_classifier, roi_search)
+    return utilities.show_results(results, 'img', display_image, write_video, video_name)
 
 
 if __name__ == '__main__':
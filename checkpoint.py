@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+"""
+Checkpoints
+===========
+Periodic checkpoints of tracker state, so that a long run that crashes or is rescheduled resumes from its latest
+checkpoint instead of re-decoding and re-tracking the whole stream from frame 0.
+
+The state of a tracker is a flat dict of NumPy arrays (e.g. the tracked points, the car rectangle and the previous
+grayscale frame for lk_track), always holding:
+ tracker => name the state was saved under, the tracker's name unless it was given a checkpoint_name (e.g. the
+            name of the configuration, so that lk and lk_adaptive runs sharing a directory are kept apart).
+ frame_idx => index of the next frame to track.
+A checkpoint is that dict written with np.savez, arrays only, so it is compact and loaded without unpickling
+anything. Checkpoints are written under a temporary name and renamed, so a crash while writing never leaves a
+corrupt latest checkpoint, and only the last few are kept.
+
+The trackers that support it (lk_track, lk_track_multi, orb_track and cascade_track) take a checkpointer, and save
+their state through it every interval frames once the consumer has taken the frame's result, and a state to resume
+from. They are then given the frames from the state's frame_idx onwards:
+
+    checkpointer = Checkpointer('./lk_checkpoints', interval=100)
+    state = checkpointer.latest('lk')
+    for result in lk_tracker.lk_track(resume_frames(imgs, state), state=state, checkpointer=checkpointer):
+        pass
+"""
+
+import glob
+import os
+import time
+
+import numpy as np
+
+import utilities
+
+
+class NullCheckpointer(object):
+    """
+    Checkpointer that never saves, the default of the trackers
+    """
+
+    def due(self, frame_idx):
+        return False
+
+    def save(self, state):
+        pass
+
+    def latest(self, tracker=None):
+        return None
+
+
+# Shared checkpointer that does nothing
+NULL_CHECKPOINTER = NullCheckpointer()
+
+
+class Checkpointer(object):
+    """
+    Writes tracker states to a directory every interval frames, keeping the last few
+    """
+
+    def __init__(self, path, interval=100, keep=2):
+        """
+        :param path: directory the checkpoints are written to, created if needed
+        :param interval: number of frames between two checkpoints
+        :param keep: number of most recent checkpoints kept
+        """
+        self.path = path
+        self.interval = max(1, interval)
+        self.keep = max(1, keep)
+        self.saved = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _files(self, tracker=None):
+        # Checkpoint files of a tracker, or of every tracker, oldest first
+        pattern = '*.npz' if tracker is None else '%s_*.npz' % tracker
+        names = glob.glob(os.path.join(self.path, pattern))
+        if tracker is not None:
+            # Leave out trackers whose name only starts with this one, e.g. lk_adaptive for lk
+            names = [name for name in names if os.path.basename(name)[len(tracker) + 1:-4].isdigit()]
+            return sorted(names, key=utilities._frame_number)
+        return sorted(names, key=os.path.getmtime)
+
+    def due(self, frame_idx):
+        """
+        :param frame_idx: index of the frame just tracked
+        :return: True if a checkpoint is due after the frame
+        """
+        return (frame_idx + 1) % self.interval == 0
+
+    def save(self, state):
+        """
+        Writes a tracker state, then removes the checkpoints of the same tracker beyond the last keep
+
+        :param state: dict of arrays, with 'tracker' and 'frame_idx' among them
+        """
+        start = time.perf_counter()
+        name = os.path.join(self.path, '%s_%08d.npz' % (state['tracker'], int(state['frame_idx'])))
+        with open(name + '.tmp', 'wb') as f:
+            np.savez(f, **dict((key, np.asarray(value)) for key, value in state.items()))
+        os.replace(name + '.tmp', name)
+        self.saved += 1
+        self.bytes = os.path.getsize(name)
+
+        for old in self._files(str(state['tracker']))[:-self.keep]:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+        self.seconds += time.perf_counter() - start
+
+    def latest(self, tracker=None):
+        """
+        Loads the most recent checkpoint that can be read
+
+        :param tracker: optional tracker name the checkpoint must belong to, None for the most recently written
+                        checkpoint of any tracker
+        :return: dict of arrays, or None if there is no checkpoint
+        """
+        for name in reversed(self._files(tracker)):
+            try:
+                with np.load(name, allow_pickle=False) as data:
+                    state = dict((key, data[key]) for key in data.files)
+            except (IOError, OSError, ValueError):
+                continue
+            if tracker is None or str(state['tracker']) == tracker:
+                return state
+        return None
+
+    def clear(self, tracker=None):
+        """
+        Removes the checkpoints of a tracker
+
+        :param tracker: name of the tracker whose checkpoints are removed, None for every checkpoint
+        """
+        for name in self._files(tracker):
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+
+    def stats(self):
+        """
+        :return: dict of checkpoints written, size of the last one and time spent writing them
+        """
+        return {'saved': self.saved, 'bytes': self.bytes, 'seconds': self.seconds}
+
+
+def check_state(state, tracker):
+    """
+    Checks that a state belongs to a tracker
+
+    :param state: dict of arrays, or None
+    :param tracker: name of the tracker resuming from it
+    :return: index of the first frame to track, 0 without a state
+    """
+    if state is None:
+        return 0
+    if str(state['tracker']) != tracker:
+        raise ValueError('Cannot resume %s from a %s state' % (tracker, state['tracker']))
+    return int(state['frame_idx'])
+
+
+def resume_frames(imgs, state):
+    """
+    Returns the frames of a sequence from the frame a state resumes at
+
+    :param imgs: directory, string array containing image file locations, a FrameSource, a FrameStore or an array of
+                 frames. Any other iterable, e.g. a LiveSource, is returned as is, it carries on from where it is
+    :param state: dict of arrays, or None to start from the first frame
+    :return: iterable of frames
+    """
+    start = 0 if state is None else int(state['frame_idx'])
+    if isinstance(imgs, str):
+        imgs = utilities.get_jpeg(imgs)
+    if isinstance(imgs, utilities.FrameSource):
+        return utilities.FrameSource(imgs.imgs, imgs.grayscale, imgs.buffer_size, imgs.workers, imgs.start + start,
+                                     imgs.reduce)
+    if hasattr(imgs, '__getitem__') and hasattr(imgs, '__len__'):
+        return imgs[start:]
+    return imgs
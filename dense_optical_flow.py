@@ -2,129 +2,403 @@
 """
 Dense Optical Flow
 ==================
-Runs dense optical flow algorithm on image sequence and displays output
+Runs dense optical flow algorithm on image sequence and displays output, or tracks the car rectangle with the dense
+flow computed only in a window around the car
 """
 
 
+from collections import namedtuple
+
 import numpy as np
 import cv2
 
-def dense_optical_flow(imgs, display_image=True, display_type='hsv', write_video=False, video_name='D_OF.avi'):
+import frame_store
+import instrumentation
+import utilities
+
+
+# Arguments:
+# pyr_scale - image scale for pyramid, 0.5 means each lay is half the previous
+# levels - pyramid number of levels
+# winsize - averaging size -> bigger = blurrier
+# iterations - iterations at each pyramid level -> makes for better results but significantly slows speed
+# poly_n - pixel neighborhood size -> bigger = blurrier
+# poly_sigma - gaussian std used for smoothing
+# flags - no initial flow estimate is passed in, so OPTFLOW_USE_INITIAL_FLOW is not set
+FARNEBACK_PARAMS = dict(pyr_scale=0.5, levels=1, winsize=50, iterations=2, poly_n=7, poly_sigma=1.5, flags=0)
+
+# Farneback arguments for tracking, where the flow is only computed in a small window around the car
+ROI_FARNEBACK_PARAMS = dict(pyr_scale=0.5, levels=2, winsize=15, iterations=2, poly_n=5, poly_sigma=1.1, flags=0)
+
+# Per-frame result yielded by flow_fields:
+# frame_idx - index of the second frame of the pair
+# frame - the second grayscale frame of the pair
+# flow - flow field from the previous frame to this one
+FlowResult = namedtuple('FlowResult', ['frame_idx', 'frame', 'flow'])
+
+
+def frame_names(imgs):
     """
-    Runs and displays dense optical flow visualization of image sequence
+    Finds the image files frames are decoded from, so that flow fields can be cached against them
+
+    :param imgs: directory, string array containing image file locations, a FrameSource or a FrameStore
+    :return: (array of image file locations, decode mode), or (None, None) for already decoded frames
+    """
+    if isinstance(imgs, str):
+        return utilities.get_jpeg(imgs), 'gray'
+    if isinstance(imgs, (list, tuple)) and all(isinstance(name, str) for name in imgs):
+        return list(imgs), 'gray'
+    if isinstance(imgs, utilities.FrameSource):
+        return imgs.imgs[imgs.start:], 'gray' if imgs.grayscale else 'color'
+    if isinstance(imgs, frame_store.FrameStore):
+        return imgs.names, 'gray' if imgs.grayscale else 'color'
+    return None, None
+
+
+def cached_flow(cache, key, prvs, nxt, farneback_params, probe=instrumentation.NULL_PROBE):
+    """
+    Computes the flow between two images, reading it from a FlowCache if it was computed before
+
+    :param cache: FlowCache, or None to always compute the flow
+    :param key: key of the flow field in the cache, None to always compute the flow
+    :param prvs: previous grayscale image
+    :param nxt: next grayscale image
+    :param farneback_params: Farneback parameters
+    :param probe: instrumentation probe the cache and flow stages are reported to
+    :return: flow field
+    """
+    if cache is not None and key is not None:
+        with probe.stage('cache'):
+            flow = cache.get(key)
+        if flow is not None:
+            probe.count('cache_hits')
+            return flow
+
+    with probe.stage('flow'):
+        flow = cv2.calcOpticalFlowFarneback(prvs, nxt, None, **farneback_params)
+    if cache is not None and key is not None:
+        with probe.stage('cache'):
+            cache.put(key, flow)
+    return flow
+
+
+def flow_fields(imgs, farneback_params=None, probe=instrumentation.NULL_PROBE, cache=None):
+    """
+    Generator computing the dense optical flow between consecutive frames. A FlowResult is yielded as soon as each
+    flow field is computed, no GUI calls are made.
+
+    :param imgs: string array containing image file locations, or a FrameSource
+    :param farneback_params: Farneback parameters, defaults to FARNEBACK_PARAMS
+    :param probe: instrumentation probe the stages are reported to
+    :param cache: optional flow_cache.FlowCache the flow fields are read from and stored to, only used when the frames
+                  are decoded from image files. Fields read back from the cache have the precision they are stored at
+    :return: generator of FlowResult
+    """
+    farneback_params = FARNEBACK_PARAMS if farneback_params is None else farneback_params
+    names, decode = frame_names(imgs) if cache is not None else (None, None)
+
+    # Load images, decoded directly to grayscale ahead of the flow loop
+    frames = iter(probe.frames(utilities.open_frames(imgs, grayscale=True)))
+
+    # Read the first frame
+    prvs = utilities.to_gray(next(frames))
+
+    for frame_idx, frame2 in enumerate(frames, 1):
+
+        # Load next grayscale frame
+        with probe.stage('gray'):
+            nxt = utilities.to_gray(frame2)
+
+        key = None
+        if names is not None:
+            key = cache.key(names[frame_idx - 1], names[frame_idx], farneback_params, {'decode': decode})
+        flow = cached_flow(cache, key, prvs, nxt, farneback_params, probe)
+        yield FlowResult(frame_idx, nxt, flow)
+
+        # Set previous to next
+        prvs = nxt
+
+
+def rect_flow(flow, rect, estimator='median'):
+    """
+    Reduces the flow vectors inside a rectangle to a single motion
+
+    :param flow: flow field
+    :param rect: rectangle [X min, Y min, X max, Y max] in flow field coordinates
+    :param estimator: 'median', or 'trimmed' for the mean of the vectors between the 25th and 75th percentiles
+    :return: (dx, dy) motion, and the number of flow vectors it was computed from
+    """
+    height, width = flow.shape[:2]
+    x0, y0 = max(0, int(rect[0])), max(0, int(rect[1]))
+    x1, y1 = min(width, int(np.ceil(rect[2]))), min(height, int(np.ceil(rect[3])))
+    vectors = flow[y0:y1, x0:x1].reshape(-1, 2)
+    if len(vectors) == 0:
+        return (0.0, 0.0), 0
+    if estimator == 'trimmed':
+        low, high = np.percentile(vectors, [25, 75], axis=0)
+        motion = [np.mean(v[(v >= lo) & (v <= hi)]) for v, lo, hi in zip(vectors.T, low, high)]
+    else:
+        motion = np.median(vectors, axis=0)
+    return (float(motion[0]), float(motion[1])), len(vectors)
+
+
+def dense_track(imgs, car_rect=[5, 160, 50, 195], roi_expand=2.0, scale=1.0, estimator='median',
+                farneback_params=None, probe=instrumentation.NULL_PROBE, cache=None):
+    """
+    Generator tracking the car rectangle with dense optical flow computed only in a window around the car, optionally
+    at a reduced scale. The rectangle is moved by the median (or trimmed mean) flow inside it, so the cost grows with
+    the size of the car rather than the size of the frame. A TrackResult is yielded as soon as each frame is tracked,
+    no GUI calls are made.
+
+    :param imgs: string array containing image file locations, or a FrameSource
+    :param car_rect: initial car position [X min, Y min, X max, Y max]
+    :param roi_expand: size of the window the flow is computed in, relative to the car rectangle
+    :param scale: scale the window is resized to before computing the flow, e.g. 0.5 for half resolution
+    :param estimator: 'median' or 'trimmed', see rect_flow
+    :param farneback_params: Farneback parameters, defaults to ROI_FARNEBACK_PARAMS
+    :param probe: instrumentation probe the stages are reported to
+    :param cache: optional flow_cache.FlowCache the flow fields are read from and stored to, keyed by the frame pair,
+                  window and scale, only used when the frames are decoded from image files
+    :return: generator of TrackResult, count is the number of flow vectors inside the car rectangle
+    """
+    farneback_params = ROI_FARNEBACK_PARAMS if farneback_params is None else farneback_params
+    names, decode = frame_names(imgs) if cache is not None else (None, None)
+
+    # Load images, decoded directly to grayscale ahead of the flow loop
+    frames = probe.frames(utilities.open_frames(imgs, grayscale=True))
+
+    rect = np.float64(car_rect)
+    prvs = None
+    for frame_idx, frame in enumerate(frames):
+        with probe.stage('gray'):
+            nxt = utilities.to_gray(frame)
+        count = 0
+        window = None
+
+        if prvs is not None:
+            # Keep the rectangle on the frame, moving it back in whole, or the window around it would be empty
+            height, width = nxt.shape[:2]
+            size = np.minimum(rect[2:] - rect[:2], [width, height])
+            corner = np.clip(rect[:2], 0, np.float64([width, height]) - size)
+            rect = np.concatenate([corner, corner + size])
 
-    :param imgs: string array containing image file locations
+            # Crop the same window from both frames
+            window = utilities.expand_rect(rect, nxt.shape, roi_expand)
+            x0, y0, x1, y1 = window
+            crop0, crop1 = prvs[y0:y1, x0:x1], nxt[y0:y1, x0:x1]
+            if scale != 1.0 and crop0.shape[0] > 1 and crop0.shape[1] > 1:
+                with probe.stage('resize'):
+                    size = (max(1, int(round((x1 - x0) * scale))), max(1, int(round((y1 - y0) * scale))))
+                    crop0 = cv2.resize(crop0, size, interpolation=cv2.INTER_AREA)
+                    crop1 = cv2.resize(crop1, size, interpolation=cv2.INTER_AREA)
+
+            if crop0.shape[0] > 1 and crop0.shape[1] > 1:
+                key = None
+                if names is not None:
+                    key = cache.key(names[frame_idx - 1], names[frame_idx], farneback_params,
+                                    {'decode': decode, 'window': window, 'scale': scale})
+                flow = cached_flow(cache, key, crop0, crop1, farneback_params, probe)
+
+                # Move the rectangle by the flow inside it, brought back to full resolution
+                with probe.stage('rect_update'):
+                    in_window = (np.float64(rect) - [x0, y0, x0, y0]) * scale
+                    (dx, dy), count = rect_flow(flow, in_window, estimator)
+                    rect = rect + np.float64([dx, dy, dx, dy]) / scale
+                probe.count('flow_vectors', count)
+
+        prvs = nxt
+        yield utilities.TrackResult(frame_idx, np.int32(np.round(rect)), utilities.rect_center(rect), count, frame,
+                                    None, {'window': window})
+
+
+def dense_flow_tracker(imgs, car_rect=[5, 160, 50, 195], scale=1.0, display_image=True, write_video=False,
+                       video_name='D_OF_track.avi'):
+    """
+    Tracks the car with dense optical flow computed around it and displays the tracking rectangle
+
+    :param imgs: string array containing image file locations, or a FrameSource
+    :param car_rect: initial car position [X min, Y min, X max, Y max]
+    :param scale: scale the flow is computed at, e.g. 0.5 for half resolution
     :param display_image: flag determining whether or not to display the image stream
-    :param display_type: Type of display for image sequence, hsv or vec (hsv is color-based and vec shows a grid of
-            vectors)
     :param write_video: Flag determining whether or not to record image stream
     :param video_name: File name of image stream
-    :return: None
+    :return: array of average locations of the car rect
     """
+    results = dense_track(imgs, car_rect, scale=scale)
+    return utilities.show_results(results, 'dense_track', display_image, write_video, video_name)
 
-    # Load images
-    cap = cv2.VideoCapture(imgs[0])
 
-    # If write_video flag, record a video
-    if write_video:
-        height, width, _ = cv2.imread(imgs[0]).shape
-        writer = cv2.VideoWriter(video_name, -1, 20, (width, height))
+class FlowRenderer(object):
+    """
+    Renders flow fields into preallocated buffers, as an hsv color field or as a grid of vectors. The buffers and the
+    vector grid are allocated once for the frame size and reused for every frame, and only every k-th frame is
+    rendered if asked to.
+    """
 
-    # Read the first frame and initialize hsv image
-    ret, frame1 = cap.read()
-    prvs = cv2.cvtColor(frame1, cv2.COLOR_BGR2GRAY)
+    def __init__(self, display_type='hsv', step=10, every=1):
+        """
+        :param display_type: Type of display, hsv or vec (hsv is color-based and vec shows a grid of vectors)
+        :param step: grid spacing of the vectors
+        :param every: render only every k-th frame, the others are skipped
+        """
+        self.display_type = display_type
+        self.step = step
+        self.every = max(1, every)
+        self.shape = None
+        self.calls = 0
 
-    # Set initial hsv image to all zeros
-    hsv = np.zeros_like(frame1)
+    def _allocate(self, shape):
+        # Output image, shared by both display types
+        height, width = shape[:2]
+        self.shape = shape[:2]
+        self.out = np.zeros((height, width, 3), np.uint8)
 
-    # Set to color
-    hsv[..., 1] = 255
+        # hsv planes: hue from the flow angle, full saturation, value from the flow magnitude
+        self.mag = np.zeros((height, width), np.float32)
+        self.ang = np.zeros((height, width), np.float32)
+        self.hue = np.zeros((height, width), np.uint8)
+        self.sat = np.full((height, width), 255, np.uint8)
+        self.val = np.zeros((height, width), np.uint8)
+        self.hsv = np.zeros((height, width, 3), np.uint8)
 
-    # initialize frame index
-    frame_idx = 1
+        # Vector grid, its line buffer and the dots drawn at every grid point
+        step = self.step
+        self.grid_y, self.grid_x = np.mgrid[step // 2:height:step, step // 2:width:step].reshape(2, -1)
+        self.lines = np.zeros((len(self.grid_x), 2, 2), np.int32)
+        self.lines[:, 0, 0] = self.grid_x
+        self.lines[:, 0, 1] = self.grid_y
+        dots = np.zeros((height, width), np.uint8)
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                if dx * dx + dy * dy <= 1:
+                    dots[np.clip(self.grid_y + dy, 0, height - 1), np.clip(self.grid_x + dx, 0, width - 1)] = 1
+        self.dots = dots.astype(bool)
 
-    while frame_idx < len(imgs):
+    def render(self, img, flow):
+        """
+        Renders a flow field
 
-        # Load next frame and grayscale frame
-        ret, frame2 = cap.read()
-        next = cv2.cvtColor(frame2, cv2.COLOR_BGR2GRAY)
+        :param img: grayscale image the flow was computed on, drawn under the vectors
+        :param flow: flow field given by Farneback optical flow algorithm
+        :return: vis image, which is overwritten by the next call, or None if the frame is skipped
+        """
+        self.calls += 1
+        if (self.calls - 1) % self.every != 0:
+            return None
+        if self.shape != flow.shape[:2]:
+            self._allocate(flow.shape)
 
+        if self.display_type == 'hsv':
+            # Angle in degrees halved into the 0-180 OpenCV hue range, magnitude stretched over 0-255
+            cv2.cartToPolar(flow[..., 0], flow[..., 1], magnitude=self.mag, angle=self.ang, angleInDegrees=True)
+            cv2.convertScaleAbs(self.ang, self.hue, 0.5)
+            cv2.normalize(self.mag, self.val, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
+            cv2.merge((self.hue, self.sat, self.val), self.hsv)
+            cv2.cvtColor(self.hsv, cv2.COLOR_HSV2BGR, self.out)
+        else:
+            # Vector end points of the whole grid at once, dots at the grid points in a single masked assignment
+            end = flow[self.grid_y, self.grid_x]
+            self.lines[:, 1, 0] = np.int32(self.grid_x + end[:, 0] + 0.5)
+            self.lines[:, 1, 1] = np.int32(self.grid_y + end[:, 1] + 0.5)
+            cv2.cvtColor(img, cv2.COLOR_GRAY2BGR, self.out)
+            self.out[self.dots] = (0, 255, 0)
+            cv2.polylines(self.out, self.lines, False, (0, 255, 0))
+        return self.out
 
-        # Arguments:
-        # prev - first image
-        # next - second image
-        # pyr_scale - image scale for pyramid, 0.5 means each lay is half the previous
-        # levels - pyramid number of levels
-        # winsize - averaging size -> bigger = blurrier
-        # iterations - iterations at each pyramid level -> makes for better results but significantly slows speed
-        # poly_n - pixel neighborhood size -> bigger = blurrier
-        # poly_sigma - gaussian std used for smoothing
-        flow = cv2.calcOpticalFlowFarneback(prvs, next, 0.5, 1, 50, 2, 7, 1.5, 1)
 
-        # Display type
-        if display_image:
-            if display_type == 'hsv':
-                frame = draw_hsv(hsv, flow)
-            elif display_type == 'vec':
-                frame = draw_vec(next, flow)
-            cv2.imshow('Frame', frame)
-
-            # Write to video
-            if write_video:
-                writer.write(frame)
+def show_flow(flows, display_image=True, display_type='hsv', write_video=False, video_name='D_OF.avi', every=1,
+              writer=None, probe=instrumentation.NULL_PROBE):
+    """
+    Consumes the results of flow_fields, optionally displaying and recording a visualization of them. Nothing is drawn
+    when neither display nor recording is requested.
 
-        k = cv2.waitKey(30) & 0xff
-        if k == 27:
-            break
+    :param flows: iterable of FlowResult
+    :param display_image: flag determining whether or not to display the image stream
+    :param display_type: Type of display for image sequence, hsv or vec (hsv is color-based and vec shows a grid of
+            vectors)
+    :param write_video: Flag determining whether or not to record image stream
+    :param video_name: File name of image stream
+    :param every: display and record only every k-th frame
+    :param writer: optional utilities.VideoWriter to record to instead of one opened on video_name, it is released at
+            the end
+    :param probe: instrumentation probe the render, display and write stages are reported to
+    :return: None
+    """
+    renderer = FlowRenderer(display_type, every=every)
+    write_video = write_video or writer is not None
+    for result in flows:
+        if not (display_image or write_video):
+            continue
+
+        with probe.stage('render'):
+            frame = renderer.render(result.frame, result.flow)
+        if frame is None:
+            continue
+
+        # Write to video, encoded on a background thread
+        if write_video:
+            with probe.stage('write'):
+                if writer is None:
+                    writer = utilities.VideoWriter(video_name)
+                writer.write(frame)
 
-        # Set previous to next and increment index
-        prvs = next
-        frame_idx += 1
+        if display_image:
+            with probe.stage('display'):
+                cv2.imshow('Frame', frame)
+                k = cv2.waitKey(30) & 0xff
+            if k == 27:
+                break
 
     # Destroy image viewer
-    cap.release()
-    cv2.destroyAllWindows()
-    if write_video:
+    if display_image:
+        cv2.destroyAllWindows()
+    if writer is not None:
         writer.release()
 
 
+def dense_optical_flow(imgs, display_image=True, display_type='hsv', write_video=False, video_name='D_OF.avi',
+                       cache=None):
+    """
+    Runs and displays dense optical flow visualization of image sequence
+
+    :param imgs: string array containing image file locations, or a FrameSource
+    :param display_image: flag determining whether or not to display the image stream
+    :param display_type: Type of display for image sequence, hsv or vec (hsv is color-based and vec shows a grid of
+            vectors)
+    :param write_video: Flag determining whether or not to record image stream
+    :param video_name: File name of image stream
+    :param cache: optional flow_cache.FlowCache, so that re-rendering the same sequence reads the flow fields back
+    :return: None
+    """
+    show_flow(flow_fields(imgs, cache=cache), display_image, display_type, write_video, video_name)
+
+
 def draw_vec(img, flow, step=10):
     """
-    Displays vector field on image. This code was taken directly from the "samples" portion of opencv
+    Displays vector field on image. Use a FlowRenderer to reuse the buffers across frames
 
     :param img: image to display
     :param flow: flow field given by Farneback optical flow algorithm
     :param step: grid spacing
     :return: vis image
     """
-    h, w = img.shape[:2]
-    y, x = np.mgrid[step/2:h:step, step/2:w:step].reshape(2,-1)
-    fx, fy = flow[y,x].T
-    lines = np.vstack([x, y, x+fx, y+fy]).T.reshape(-1, 2, 2)
-    lines = np.int32(lines + 0.5)
-    vis = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
-    cv2.polylines(vis, lines, 0, (0, 255, 0))
-    for (x1, y1), (x2, y2) in lines:
-        cv2.circle(vis, (x1, y1), 1, (0, 255, 0), -1)
-    return vis
+    return FlowRenderer('vec', step).render(img, flow).copy()
 
 
 def draw_hsv(hsv, flow):
     """
-    Displays hsv color field of polar coordinates on image. This code was taken directly from the "samples" portion of opencv
-    :param hsv: hsv color image
+    Displays hsv color field of polar coordinates on image. Use a FlowRenderer to reuse the buffers across frames
+    :param hsv: hsv color image, filled with the hsv rendering
     :param flow: flow field given by Farneback optical flow algorithm
     :return:
     """
-    mag, ang = cv2.cartToPolar(flow[..., 0], flow[..., 1])
-    hsv[..., 0] = ang*180/np.pi/2
-    hsv[..., 2] = cv2.normalize(mag, None, 0, 255, cv2.NORM_MINMAX)
-    rgb = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
+    renderer = FlowRenderer('hsv')
+    rgb = renderer.render(None, flow).copy()
+    hsv[...] = renderer.hsv
     return rgb
 
 
 if __name__ == '__main__':
-    import utilities
 
     # Load images
     imgs = utilities.get_jpeg('./resources/car/')
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+"""
+Flow Field Cache
+================
+On-disk cache of dense optical flow fields, so that re-rendering a visualisation or re-running a tracker on the same
+sequence reads the flow fields back instead of recomputing them with calcOpticalFlowFarneback.
+
+Every flow field is stored as its own float16 .npy file, named after a hash of the frame pair, the Farneback
+parameters, anything else the flow depends on (e.g. the window it was computed in), and the identity of the two
+source images: their path, size and modification time, or a hash of their content. Editing or replacing an image
+therefore never returns a stale field. The cache is capped in size, and the least recently used fields are evicted
+first.
+
+    cache = FlowCache('./flow_cache')
+    for result in dense_optical_flow.flow_fields(imgs, cache=cache):
+        pass
+"""
+
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+# Default size cap of the cache
+MAX_BYTES = 512 * 1024 * 1024
+
+
+class FlowCache(object):
+    """
+    Size-capped, least recently used, on-disk cache of flow fields
+    """
+
+    def __init__(self, path='./flow_cache', max_bytes=MAX_BYTES, hash_files=False, dtype=np.float16):
+        """
+        :param path: directory the flow fields are stored in, created if needed
+        :param max_bytes: size above which the least recently used flow fields are evicted
+        :param hash_files: flag determining whether source images are identified by a hash of their content instead
+                           of their size and modification time
+        :param dtype: type the flow fields are stored as, float16 halves the size of float32 with a precision of
+                      about 0.06 pixels on a 100 pixel motion
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hash_files = hash_files
+        self.dtype = dtype
+        self.hits = 0
+        self.misses = 0
+        self._sources = {}
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        # Index of the cached fields, least recently used first, rebuilt from the modification times on disk
+        entries = []
+        for name in os.listdir(path):
+            if name.endswith('.npy'):
+                stat = os.stat(os.path.join(path, name))
+                entries.append((stat.st_mtime, name[:-4], stat.st_size))
+        self.index = OrderedDict((key, size) for _, key, size in sorted(entries))
+        self.size = sum(self.index.values())
+
+    def __len__(self):
+        return len(self.index)
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.npy')
+
+    def source_id(self, name):
+        """
+        Identifies a source image, either by its path, size and modification time or by a hash of its content
+
+        :param name: image file location
+        :return: string identifying the current version of the image
+        """
+        stat = os.stat(name)
+        version = (stat.st_size, stat.st_mtime_ns)
+        cached = self._sources.get(name)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        if self.hash_files:
+            with open(name, 'rb') as f:
+                source = hashlib.sha1(f.read()).hexdigest()
+        else:
+            source = '%s:%d:%d' % ((os.path.abspath(name),) + version)
+        self._sources[name] = (version, source)
+        return source
+
+    def key(self, name0, name1, params, extra=None):
+        """
+        Builds the key of the flow field between two images
+
+        :param name0: location of the first image of the pair
+        :param name1: location of the second image of the pair
+        :param params: parameters the flow is computed with
+        :param extra: anything else the flow depends on, e.g. the window it is computed in, must be JSON serializable
+        :return: hex string key
+        """
+        description = json.dumps([self.source_id(name0), self.source_id(name1), params, extra], sort_keys=True,
+                                 default=str)
+        return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        :param key: key returned by key()
+        :return: float32 flow field, or None if it is not cached
+        """
+        if key not in self.index:
+            self.misses += 1
+            return None
+        try:
+            flow = np.load(self._file(key))
+        except (IOError, ValueError):
+            # Evicted by another process, or a partial file
+            self._forget(key)
+            self.misses += 1
+            return None
+
+        # Mark as most recently used, on disk as well so that the order survives restarts
+        self.index.move_to_end(key)
+        os.utime(self._file(key), None)
+        self.hits += 1
+        return np.float32(flow)
+
+    def put(self, key, flow):
+        """
+        Stores a flow field, evicting the least recently used fields if the cache grows over its cap
+
+        :param key: key returned by key()
+        :param flow: flow field
+        """
+        # Write to a temporary file first so that readers never see a partial field
+        tmp = self._file(key) + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.save(f, np.asarray(flow, self.dtype))
+        os.replace(tmp, self._file(key))
+
+        if key in self.index:
+            self.size -= self.index.pop(key)
+        self.index[key] = os.path.getsize(self._file(key))
+        self.size += self.index[key]
+
+        while self.size > self.max_bytes and len(self.index) > 1:
+            oldest = next(iter(self.index))
+            self._forget(oldest)
+            try:
+                os.remove(self._file(oldest))
+            except OSError:
+                pass
+
+    def _forget(self, key):
+        self.size -= self.index.pop(key, 0)
+
+    def clear(self):
+        """
+        Removes every cached flow field
+        """
+        for key in list(self.index):
+            self._forget(key)
+            try:
+                os.remove(self._file(key))
+            except OSError:
+                pass
+
+    def stats(self):
+        """
+        :return: dict of hits, misses, cached fields and bytes used
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'fields': len(self.index), 'bytes': self.size}
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+"""
+Frame Store
+===========
+Decodes an image sequence once into memory-mapped uint8 frame stacks, so that repeated runs over the same sequence
+read frames straight from the page cache instead of decoding every JPEG again. Several processes opening the same
+store share the same pages.
+
+A store is a directory holding:
+ color.npy => N x H x W x 3 BGR frame stack.
+ gray.npy => N x H x W grayscale frame stack, decoded directly to grayscale, if asked for.
+ index.json => the source image locations with their size and modification time, and the shape of every stack.
+
+Build a store from the command line:
+
+    python frame_store.py --sequence ./resources/car/ --store ./resources/car.frames --gray
+
+and read it from python, the frames are read-only views into the mapped stack:
+
+    store = frame_store.open_store('./resources/car/', './resources/car.frames')
+    for result in lk_tracker.lk_track(store):
+        pass
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+import utilities
+
+# Version of the store layout, stores of another version are rebuilt
+STORE_VERSION = 1
+
+
+def _source_entry(name):
+    stat = os.stat(name)
+    return {'name': os.path.abspath(name), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def build_store(imgs, path, color=True, gray=False):
+    """
+    Decodes an image sequence into memory-mapped frame stacks
+
+    :param imgs: directory, or string array containing image file locations
+    :param path: directory of the store, created if needed
+    :param color: flag determining whether the BGR frame stack is written
+    :param gray: flag determining whether the grayscale frame stack is written
+    :return: dict of the store index
+    """
+    if isinstance(imgs, str):
+        imgs = utilities.get_jpeg(imgs)
+    if not (color or gray):
+        raise ValueError('A frame store needs a color or a grayscale stack')
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    index = {'version': STORE_VERSION, 'created': time.time(), 'frames': len(imgs),
+             'sources': [_source_entry(name) for name in imgs], 'stacks': {}}
+
+    # Decode every kind of stack in its own pass, each frame decoded the way FrameSource would
+    for mode, wanted in (('color', color), ('gray', gray)):
+        stack_path = os.path.join(path, mode + '.npy')
+        if not wanted:
+            if os.path.exists(stack_path):
+                os.remove(stack_path)
+            continue
+        stack = None
+        for idx, frame in enumerate(utilities.FrameSource(imgs, grayscale=mode == 'gray')):
+            if stack is None:
+                stack = np.lib.format.open_memmap(stack_path + '.tmp', 'w+', np.uint8, (len(imgs),) + frame.shape)
+            if frame.shape != stack.shape[1:]:
+                raise ValueError('Frame %s has shape %s, expected %s' % (imgs[idx], frame.shape, stack.shape[1:]))
+            stack[idx] = frame
+        stack.flush()
+        index['stacks'][mode] = list(stack.shape)
+        del stack
+        os.replace(stack_path + '.tmp', stack_path)
+
+    # The index is written last, so that a store without one is never mistaken for a complete store
+    with open(os.path.join(path, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=2)
+    return index
+
+
+class FrameStore(object):
+    """
+    Read-only view of a frame store. Iterating over it or indexing it returns frames that are views into the
+    memory-mapped stack, nothing is decoded or copied.
+    """
+
+    def __init__(self, path, grayscale=False):
+        """
+        :param path: directory of the store
+        :param grayscale: flag determining whether the grayscale stack is read instead of the color stack
+        """
+        with open(os.path.join(path, 'index.json')) as f:
+            self.index = json.load(f)
+        mode = 'gray' if grayscale else 'color'
+        if mode not in self.index['stacks']:
+            raise IOError('Frame store %s has no %s stack' % (path, mode))
+        self.path = path
+        self.grayscale = grayscale
+        self.frames = np.load(os.path.join(path, mode + '.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, idx):
+        return self.frames[idx]
+
+    def __iter__(self):
+        return iter(self.frames)
+
+    @property
+    def names(self):
+        """
+        :return: array of the locations of the images the frames were decoded from
+        """
+        return [source['name'] for source in self.index['sources']]
+
+    def stale(self):
+        """
+        :return: True if a source image was changed, moved or removed since the store was built
+        """
+        for source in self.index['sources']:
+            try:
+                if _source_entry(source['name']) != source:
+                    return True
+            except OSError:
+                return True
+        return False
+
+
+def open_store(sequence, path=None, grayscale=False, rebuild=False):
+    """
+    Opens the frame store of a sequence, building it first if it does not exist yet, lacks the requested stack or is
+    out of date with the images
+
+    :param sequence: directory, or string array containing image file locations
+    :param path: directory of the store, defaults to the sequence directory with a .frames suffix
+    :param grayscale: flag determining whether the grayscale stack is read instead of the color stack
+    :param rebuild: flag forcing the store to be rebuilt
+    :return: FrameStore
+    """
+    imgs = utilities.get_jpeg(sequence) if isinstance(sequence, str) else list(sequence)
+    if path is None:
+        if not isinstance(sequence, str):
+            raise ValueError('A store path is needed for an image array')
+        path = os.path.normpath(sequence) + '.frames'
+
+    store = None
+    if not rebuild:
+        try:
+            store = FrameStore(path, grayscale)
+        except (IOError, OSError, ValueError, KeyError):
+            store = None
+    if (store is None or store.index.get('version') != STORE_VERSION or store.stale() or
+            store.names != [os.path.abspath(name) for name in imgs]):
+        # Rebuild the stack asked for, along with any other stack the store already had
+        try:
+            with open(os.path.join(path, 'index.json')) as f:
+                stacks = json.load(f).get('stacks', {})
+        except (IOError, OSError, ValueError):
+            stacks = {}
+        build_store(imgs, path, color=not grayscale or 'color' in stacks, gray=grayscale or 'gray' in stacks)
+        store = FrameStore(path, grayscale)
+    return store
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Decode an image sequence once into a memory-mapped frame store')
+    parser.add_argument('--sequence', default='./resources/car/', help='directory of the sequence')
+    parser.add_argument('--store', help='directory of the store, defaults to the sequence directory + .frames')
+    parser.add_argument('--gray', action='store_true', help='also write a grayscale stack')
+    parser.add_argument('--gray-only', action='store_true', help='only write a grayscale stack')
+    args = parser.parse_args()
+
+    path = args.store or os.path.normpath(args.sequence) + '.frames'
+    start = time.perf_counter()
+    index = build_store(args.sequence, path, color=not args.gray_only, gray=args.gray or args.gray_only)
+    print('%d frames written to %s in %.1fs: %s' % (index['frames'], path, time.perf_counter() - start,
+                                                    ', '.join('%s %s' % (k, tuple(v))
+                                                              for k, v in sorted(index['stacks'].items()))))
+
+
+if __name__ == '__main__':
+    main()
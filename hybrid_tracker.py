@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+"""
+Hybrid Cascade and Lucas-Kanade Tracker
+=======================================
+Runs the Haar cascade classifier on a schedule and bridges the frames in between with Lucas-Kanade optical flow. The
+cascade is run every detect_interval frames, or earlier when too few tracked points survive the forward-backward
+check. The cascade searches a window around the tracked rectangle, and the full frame until the car is found and
+after max_misses searches in a row without a match. In adaptive mode the interval doubles (up to max_interval) every
+time the cascade agrees with the tracked rectangle, and drops back to detect_interval when it does not.
+
+cars3.xml matches are square and sit loosely on the car, so they are compared with the tracked rectangle by position
+only, and only move a rectangle whose points were lost. On resources/car the rectangle is carried by LK: in the
+supervised benchmark the cascade runs 22 times, finds the car 5 times, confirms the rectangle 3 times and relocates
+it once. The 'confirmed' and 'relocated' counters report these per run.
+"""
+
+import cv2
+import numpy as np
+
+import cascade_tracker
+import instrumentation
+import lk_tracker
+import utilities
+
+# Parameters for ShiTomasi corner detection inside the car rectangle, more corners than lk_tracker as the detection
+# is limited to the car
+FEATURE_PARAMS = dict(maxCorners=50, qualityLevel=0.1, minDistance=3, blockSize=5)
+
+
+def propagate_rect(rect, p0, p1):
+    """
+    Moves a rectangle with the points inside it: shifted by the median point motion and scaled by the median change
+    in distance between pairs of points
+
+    :param rect: rectangle [X min, Y min, X max, Y max]
+    :param p0: N x 2 array of points in the previous image
+    :param p1: N x 2 array of the same points in the current image
+    :return: moved rectangle as a float array
+    """
+    dx, dy = np.median(p1 - p0, axis=0)
+
+    # Scale from the ratio of pairwise distances, only meaningful with at least 2 points
+    scale = 1.0
+    if len(p0) >= 2:
+        i, j = np.triu_indices(len(p0), 1)
+        d0 = np.hypot(*(p0[i] - p0[j]).T)
+        d1 = np.hypot(*(p1[i] - p1[j]).T)
+        ok = d0 > 1e-3
+        if ok.any():
+            scale = float(np.median(d1[ok] / d0[ok]))
+
+    cx, cy = utilities.rect_center(rect)
+    half_w = (rect[2] - rect[0]) * scale / 2.0
+    half_h = (rect[3] - rect[1]) * scale / 2.0
+    return np.float64([cx + dx - half_w, cy + dy - half_h, cx + dx + half_w, cy + dy + half_h])
+
+
+def seed_points(gray, rect, feature_params=None):
+    """
+    Detects Shi-Tomasi corners inside a rectangle
+
+    :param gray: grayscale image
+    :param rect: rectangle [X min, Y min, X max, Y max]
+    :param feature_params: Shi-Tomasi parameters, defaults to FEATURE_PARAMS
+    :return: N x 2 array of points
+    """
+    feature_params = FEATURE_PARAMS if feature_params is None else feature_params
+    height, width = gray.shape[:2]
+    x0, y0 = max(0, int(rect[0])), max(0, int(rect[1]))
+    x1, y1 = min(width, int(rect[2])), min(height, int(rect[3]))
+    if x1 - x0 < 2 or y1 - y0 < 2:
+        return np.zeros((0, 2), np.float32)
+    p = cv2.goodFeaturesToTrack(gray[y0:y1, x0:x1], **feature_params)
+    if p is None:
+        return np.zeros((0, 2), np.float32)
+    return np.float32(p).reshape(-1, 2) + np.float32([x0, y0])
+
+
+def hybrid_track(imgs, cascade_classifier, car_rect=None, detect_interval=10, min_points=5, adaptive=True,
+                 max_interval=40, min_agreement=0.5, feature_params=None, lk_params=None,
+                 probe=instrumentation.NULL_PROBE, max_misses=3):
+    """
+    Generator tracking the car with the cascade classifier on a schedule and Lucas-Kanade optical flow in between. A
+    TrackResult is yielded as soon as each frame is tracked, no GUI calls are made. info['detector'] tells whether the
+    cascade ran on the frame, info['search'] where it searched ('roi' around the tracked rectangle, or 'full' until
+    the car is found and after max_misses searches in a row without a match) and info['interval'] the current
+    detection interval.
+
+    :param imgs: string array containing image file locations, or a FrameSource
+    :param cascade_classifier: string containing file location of Haar classifier XML, or a loaded CascadeClassifier
+    :param car_rect: optional initial car position [X min, Y min, X max, Y max], found by the cascade if not given
+    :param detect_interval: frames between cascade runs
+    :param min_points: tracked points in the car rectangle below which the cascade runs early
+    :param adaptive: flag determining whether the interval grows while the cascade agrees with the tracked rectangle
+    :param max_interval: largest interval in adaptive mode
+    :param min_agreement: overlap of the cascade match with the tracked rectangle that counts as agreement
+    :param feature_params: Shi-Tomasi parameters for seeding points in the car rectangle, defaults to FEATURE_PARAMS
+    :param lk_params: Lucas-Kanade parameters, defaults to lk_tracker.LK_PARAMS
+    :param probe: instrumentation probe the stages and counters are reported to
+    :param max_misses: cascade runs in a row without a match around the tracked rectangle before the full frame is
+                       scanned, as in cascade_tracker.cascade_track
+    :return: generator of TrackResult, rect and center are None until the car is first found
+    """
+    car_cascade = cascade_tracker.load_cascade(cascade_classifier)
+
+    # Load images, decoding ahead of the tracking loop
+    frames = probe.frames(utilities.open_frames(imgs))
+
+    rect = None if car_rect is None else np.float64(car_rect)
+    points = np.zeros((0, 2), np.float32)
+    interval = detect_interval
+    last_detect = None
+    misses = 0
+    prev_gray = None
+
+    for frame_idx, frame in enumerate(frames):
+        with probe.stage('gray'):
+            gray = utilities.to_gray(frame)
+
+        # Bridge from the previous frame with LK, keeping only the points in the car rectangle that pass the
+        # forward-backward check
+        if rect is not None and prev_gray is not None and len(points) > 0:
+            with probe.stage('flow'):
+                p1, good = lk_tracker.track_points(prev_gray, gray, points, lk_params)
+            with probe.stage('rect_update'):
+                inside = ((points[:, 0] > rect[0]) & (points[:, 0] < rect[2]) &
+                          (points[:, 1] > rect[1]) & (points[:, 1] < rect[3]))
+                keep = good & inside
+                if keep.any():
+                    rect = propagate_rect(rect, points[keep], p1[keep])
+            probe.count('points_tracked', len(points))
+            probe.count('points_rejected', len(points) - int(keep.sum()))
+            points = p1[keep]
+
+        # Run the cascade when it is due, when LK has too few points left, or when the car has not been found yet
+        due = last_detect is None or frame_idx - last_detect >= interval
+        ran = rect is None or due or len(points) < min_points
+        if ran:
+            # Search around the tracked rectangle, or over the full frame when the search around it keeps failing
+            search = 'roi' if rect is not None and misses < max_misses else 'full'
+            with probe.stage('detect'):
+                cars = cascade_tracker.detect_cars(car_cascade, gray, rect if search == 'roi' else None)
+            probe.count(search + '_searches')
+            probe.count('detections', len(cars))
+            last_detect = frame_idx
+            misses = 0 if len(cars) > 0 else misses + 1
+            if len(cars) > 0:
+                boxes = np.float64([[x, y, x + w, y + h] for (x, y, w, h) in cars])
+                if rect is None:
+                    # Nothing to compare against, take the largest match
+                    rect = boxes[np.argmax((boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]))]
+                    agreement = 0.0
+                else:
+                    # Matches are the shape of the classifier's window, not of the car, so they are compared with the
+                    # tracked rectangle by position only: the tracked rectangle moved onto each match
+                    shifts = np.float64([utilities.rect_center(box) for box in boxes]) - utilities.rect_center(rect)
+                    moved = rect + np.tile(shifts, 2)
+                    overlaps = utilities.rect_overlap(moved, np.tile(rect, (len(boxes), 1)))
+                    best = np.argmax(overlaps)
+                    agreement = overlaps[best]
+                    if agreement >= min_agreement:
+                        probe.count('confirmed')
+
+                    # The matches are too coarse to correct a rectangle LK still holds, they only move one whose
+                    # points were lost
+                    if len(points) < min_points:
+                        rect = moved[best]
+                        probe.count('relocated')
+
+                # Grow the interval while the cascade confirms the tracked rectangle, reset it otherwise
+                if adaptive and agreement >= min_agreement:
+                    interval = min(interval * 2, max_interval)
+                else:
+                    interval = detect_interval
+            else:
+                interval = detect_interval
+
+            # Start tracking fresh points on the (re-)detected car
+            if rect is not None:
+                with probe.stage('seed'):
+                    points = seed_points(gray, rect, feature_params)
+        elif len(points) < min_points:
+            with probe.stage('seed'):
+                points = seed_points(gray, rect, feature_params)
+
+        prev_gray = gray
+
+        info = {'detector': ran, 'interval': interval}
+        if ran:
+            info['search'] = search
+        if rect is None:
+            yield utilities.TrackResult(frame_idx, None, None, 0, frame, points, info)
+        else:
+            yield utilities.TrackResult(frame_idx, np.int32(np.round(rect)), utilities.rect_center(rect),
+                                        len(points), frame, points, info)
+
+
+def hybrid(imgs, cascade_classifier, car_rect=None, detect_interval=10, display_image=True, write_video=False,
+           video_name='HYBRID.avi'):
+    """
+    Tracks the car with the cascade classifier on a schedule and Lucas-Kanade optical flow in between, and displays
+    the tracking rectangle and points
+
+    :param imgs: string array containing image file locations, or a FrameSource
+    :param cascade_classifier: string containing file location of Haar classifier XML
+    :param car_rect: optional initial car position [X min, Y min, X max, Y max]
+    :param detect_interval: frames between cascade runs
+    :param display_image: flag determining whether or not to display the image stream
+    :param write_video: Flag determining whether or not to record image stream
+    :param video_name: File name of image stream
+    :return: array of average locations of the car rect
+    """
+    results = hybrid_track(imgs, cascade_classifier, car_rect, detect_interval)
+    return utilities.show_results(results, 'hybrid', display_image, write_video, video_name)
+
+
+if __name__ == '__main__':
+
+    # Load images
+    imgs = utilities.get_jpeg('./resources/car/')
+
+    # Get average position
+    ave_pos = hybrid(imgs, './resources/cars3.xml', [5, 160, 50, 195])
+
+    # Plot the average position
+    utilities.plot_pixel_position(ave_pos)
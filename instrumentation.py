@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+"""
+Instrumentation
+===============
+Lightweight per-stage timers and counters that the trackers report into.
+
+A Probe keeps one record per frame, holding the time spent in every named stage (decode, gray, flow, detect,
+rect_resize, draw, display, write, ...) and the counters incremented on that frame (points_tracked, points_rejected,
+detections, roi_searches, ...). Records can be exported to JSON or CSV, along with aggregate percentiles.
+
+Trackers default to NULL_PROBE, whose methods do nothing, so instrumentation costs close to nothing when disabled:
+
+    probe = Probe()
+    for result in lk_tracker.lk_track(imgs, probe=probe):
+        pass
+    probe.to_json('lk_profile.json')
+"""
+
+import csv
+import json
+import time
+
+import numpy as np
+
+# Percentiles reported for every stage
+PERCENTILES = (50, 90, 99)
+
+
+class _NullStage(object):
+    """
+    Context manager that does nothing, shared by every disabled stage timer
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class _Stage(object):
+    """
+    Context manager timing a stage into the current frame record of a probe
+    """
+
+    def __init__(self, probe, name):
+        self.probe = probe
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.probe.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class NullProbe(object):
+    """
+    Disabled probe, every call is a no-op
+    """
+    enabled = False
+    _stage = _NullStage()
+
+    def frames(self, frames):
+        return frames
+
+    def begin(self, frame_idx):
+        pass
+
+    def stage(self, name):
+        return self._stage
+
+    def add(self, name, seconds):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+
+# Shared disabled probe, the default of every tracker
+NULL_PROBE = NullProbe()
+
+
+class Probe(object):
+    """
+    Collects per-frame stage timings and counters
+    """
+    enabled = True
+
+    def __init__(self):
+        self.records = []
+        self.current = None
+
+    def frames(self, frames):
+        """
+        Wraps an iterable of frames, starting a new record for every frame and timing how long it took to be
+        delivered as the 'decode' stage
+
+        :param frames: iterable of frames
+        :return: generator of the same frames
+        """
+        frames = iter(frames)
+        frame_idx = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                frame = next(frames)
+            except StopIteration:
+                return
+            self.begin(frame_idx)
+            self.add('decode', time.perf_counter() - start)
+            frame_idx += 1
+            yield frame
+
+    def begin(self, frame_idx):
+        """
+        Starts the record of a new frame, stages and counters reported from now on belong to it
+
+        :param frame_idx: index of the frame
+        """
+        self.current = {'frame_idx': frame_idx, 'stages': {}, 'counters': {}}
+        self.records.append(self.current)
+
+    def stage(self, name):
+        """
+        :param name: name of the stage
+        :return: context manager timing the stage into the current frame
+        """
+        return _Stage(self, name)
+
+    def add(self, name, seconds):
+        """
+        Adds time to a stage of the current frame
+
+        :param name: name of the stage
+        :param seconds: time spent
+        """
+        if self.current is None:
+            self.begin(0)
+        stages = self.current['stages']
+        stages[name] = stages.get(name, 0.0) + seconds
+
+    def count(self, name, n=1):
+        """
+        Increments a counter of the current frame
+
+        :param name: name of the counter
+        :param n: amount to add
+        """
+        if self.current is None:
+            self.begin(0)
+        counters = self.current['counters']
+        counters[name] = counters.get(name, 0) + n
+
+    def stage_names(self):
+        return sorted(set(name for record in self.records for name in record['stages']))
+
+    def counter_names(self):
+        return sorted(set(name for record in self.records for name in record['counters']))
+
+    def summary(self):
+        """
+        :return: dict of per-stage latency percentiles in milliseconds (over the frames the stage ran on) and counter
+                 totals
+        """
+        stages = {}
+        for name in self.stage_names():
+            samples = np.float64([r['stages'][name] for r in self.records if name in r['stages']]) * 1000.0
+            stages[name] = {'frames': len(samples), 'mean': float(samples.mean()), 'total': float(samples.sum())}
+            for p in PERCENTILES:
+                stages[name]['p%d' % p] = float(np.percentile(samples, p))
+        counters = dict((name, sum(r['counters'].get(name, 0) for r in self.records))
+                        for name in self.counter_names())
+        return {'frames': len(self.records), 'stages': stages, 'counters': counters}
+
+    def to_json(self, path):
+        """
+        Writes the per-frame records and the summary to a JSON file
+
+        :param path: location of the JSON file
+        """
+        with open(path, 'w') as f:
+            json.dump({'summary': self.summary(), 'frames': self.records}, f, indent=2, sort_keys=True)
+
+    def to_csv(self, path):
+        """
+        Writes one row per frame, with a column per stage (in milliseconds) and per counter
+
+        :param path: location of the CSV file
+        """
+        stage_names = self.stage_names()
+        counter_names = self.counter_names()
+        with open(path, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(['frame_idx'] + [name + '_ms' for name in stage_names] + counter_names)
+            for r in self.records:
+                writer.writerow([r['frame_idx']] +
+                                ['%.4f' % (r['stages'][name] * 1000.0) if name in r['stages'] else ''
+                                 for name in stage_names] +
+                                [r['counters'].get(name, 0) for name in counter_names])
+
+
+class LatencySample(object):
+    """
+    Running count, mean and max of latencies, with a fixed size uniform random sample of them (reservoir sampling) the
+    percentiles are estimated from, so that memory stays constant however many latencies are added
+    """
+
+    def __init__(self, size=4096, seed=0):
+        """
+        :param size: number of latencies sampled
+        :param seed: seed of the sampling, so that runs are repeatable
+        """
+        self.samples = np.zeros(max(1, size))
+        self.random = np.random.RandomState(seed)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, seconds):
+        """
+        Adds a latency
+
+        :param seconds: latency in seconds
+        """
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+        # Keep every latency until the sample is full, then replace a random one with decreasing probability
+        if self.count < len(self.samples):
+            self.samples[self.count] = seconds
+        else:
+            slot = self.random.randint(0, self.count + 1)
+            if slot < len(self.samples):
+                self.samples[slot] = seconds
+        self.count += 1
+
+    def summary(self):
+        """
+        :return: dict of the mean, PERCENTILES and max latencies in milliseconds, empty without latencies
+        """
+        if self.count == 0:
+            return {}
+        samples = self.samples[:min(self.count, len(self.samples))] * 1000.0
+        summary = {'mean': self.total * 1000.0 / self.count}
+        for p in PERCENTILES:
+            summary['p%d' % p] = float(np.percentile(samples, p))
+        summary['max'] = self.max * 1000.0
+        return summary
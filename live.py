@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+"""
+Live Ingestion
+==============
+Feeds frames that are still arriving to the trackers, instead of a complete list of images.
+
+A LiveSource reads frames, in order, from one of:
+ a directory => tailed for new JPEG files, in frame number order, until a file named END appears or nothing new
+                arrives for idle_timeout seconds.
+ tcp://host:port => a socket listened on for a single producer, sending every JPEG as a 4 byte big-endian length
+                    followed by the JPEG bytes, a length of 0 or closing the connection ends the stream.
+ any other path => a pipe (or file) carrying the same length-prefixed JPEG stream, '-' for standard input.
+
+Frames are decoded on a background thread into a bounded queue. When the tracker falls behind, the 'block' policy
+stops reading until there is room (the producer is held back through the directory or the socket), and the 'drop'
+policy drops the oldest queued frame so that the tracker always gets the freshest one. The source iterates like any
+list of frames, so every tracker can run on it unchanged, and the end-to-end latency of every frame (from its arrival
+to its tracking result) is recorded with latency(). The state kept stays bounded however long the stream runs: a
+tailed directory is only read past the last frame number taken, the arrival times of the last ARRIVALS_KEPT frames are
+kept, and the latency percentiles come from a fixed size random sample of the latencies.
+
+    source = LiveSource('./incoming/', policy='drop')
+    for result in lk_tracker.lk_track(source):
+        source.latency(result.frame_idx)
+    print(source.stats())
+
+Run a tracker on a live source, optionally with a replay of a sequence into it:
+
+    python live.py --source /tmp/incoming --replay ./resources/car/ --fps 30 --tracker lk --policy drop
+"""
+
+import argparse
+import os
+import queue
+import socket
+import struct
+import sys
+import threading
+import time
+
+import cv2
+import numpy as np
+
+import benchmark
+import instrumentation
+import utilities
+
+# Name of the file that ends a tailed directory stream
+END_MARKER = 'END'
+
+# Header of every frame of a socket or pipe stream: the length of the JPEG bytes that follow
+HEADER = struct.Struct('>I')
+
+# Number of delivered frames whose arrival time is kept for latency()
+ARRIVALS_KEPT = 1024
+
+# Number of latencies sampled for the percentiles of stats()
+LATENCY_SAMPLES = 4096
+
+
+def _read_exact(stream, n):
+    # Reads exactly n bytes, or returns None at the end of the stream
+    data = b''
+    while len(data) < n:
+        chunk = stream.read(n - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+class LiveSource(object):
+    """
+    Iterable over frames arriving from a directory, a socket or a pipe, decoded on a background thread into a bounded
+    queue
+    """
+
+    def __init__(self, source, policy='block', queue_size=4, grayscale=False, poll_interval=0.005, idle_timeout=None):
+        """
+        :param source: directory to tail, tcp://host:port to listen on, or path of a pipe ('-' for standard input)
+        :param policy: 'block' to stop reading while the queue is full, 'drop' to drop the oldest queued frame
+        :param queue_size: maximum number of decoded frames waiting for the tracker
+        :param grayscale: flag determining whether frames are decoded directly to grayscale
+        :param poll_interval: time between directory scans
+        :param idle_timeout: time without new frames after which a tailed directory stream ends, None to wait for the
+                             END file
+        """
+        if policy not in ('block', 'drop'):
+            raise ValueError('Unknown policy ' + str(policy))
+        self.source = source
+        self.policy = policy
+        self.grayscale = grayscale
+        self.poll_interval = poll_interval
+        self.idle_timeout = idle_timeout
+        self.queue = queue.Queue(maxsize=max(1, queue_size))
+        self.stop = threading.Event()
+        self.error = None
+        self.connection = None
+
+        # Statistics: frames received, delivered and dropped, arrival time of the last frames delivered by index, and
+        # the measured latencies
+        self.received = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.arrivals = {}
+        self.latencies = instrumentation.LatencySample(LATENCY_SAMPLES)
+        self.started = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def _decode(self, data):
+        flags = cv2.IMREAD_GRAYSCALE if self.grayscale else cv2.IMREAD_COLOR
+        return cv2.imdecode(np.frombuffer(data, np.uint8), flags)
+
+    def _push(self, frame, arrival):
+        # Queue a decoded frame, holding the reader back or dropping the oldest frame when the queue is full
+        self.received += 1
+        item = (frame, arrival)
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1 if self.policy == 'block' else 0)
+                return
+            except queue.Full:
+                if self.policy == 'drop':
+                    try:
+                        self.queue.get_nowait()
+                        self.dropped += 1
+                    except queue.Empty:
+                        pass
+
+    def _tail_directory(self):
+        flags = cv2.IMREAD_GRAYSCALE if self.grayscale else cv2.IMREAD_COLOR
+
+        # Sort key of the last frame taken, only the frames after it are read
+        last = None
+        last_new = time.perf_counter()
+        while not self.stop.is_set():
+            # Look for the end marker before listing, so that every frame written before it is in the listing
+            ended = os.path.exists(os.path.join(self.source, END_MARKER))
+            complete = True
+            new = [(utilities._frame_number(f), f) for f in os.listdir(self.source) if f.endswith('.jpg')]
+            for key, f in sorted(item for item in new if last is None or item[0] > last):
+                arrival = time.perf_counter()
+                frame = cv2.imread(os.path.join(self.source, f), flags)
+                if frame is None:
+                    # Still being written, pick it up on the next scan
+                    complete = False
+                    break
+                last = key
+                last_new = arrival
+                self._push(frame, arrival)
+                if self.stop.is_set():
+                    return
+            if complete and ended:
+                return
+            if self.idle_timeout is not None and time.perf_counter() - last_new > self.idle_timeout:
+                return
+            time.sleep(self.poll_interval)
+
+    def _read_stream(self, stream):
+        while not self.stop.is_set():
+            header = _read_exact(stream, HEADER.size)
+            if header is None:
+                return
+            length, = HEADER.unpack(header)
+            if length == 0:
+                return
+            data = _read_exact(stream, length)
+            if data is None:
+                return
+            arrival = time.perf_counter()
+            frame = self._decode(data)
+            if frame is None:
+                raise IOError('Could not decode a frame of %d bytes from %s' % (length, self.source))
+            self._push(frame, arrival)
+
+    def _run(self):
+        try:
+            if self.source.startswith('tcp://'):
+                host, port = self.source[len('tcp://'):].rsplit(':', 1)
+                server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                server.bind((host, int(port)))
+                server.listen(1)
+                self.connection, _ = server.accept()
+                server.close()
+                with self.connection.makefile('rb') as stream:
+                    self._read_stream(stream)
+            elif os.path.isdir(self.source):
+                self._tail_directory()
+            elif self.source == '-':
+                self._read_stream(sys.stdin.buffer)
+            else:
+                with open(self.source, 'rb') as stream:
+                    self._read_stream(stream)
+        except Exception as e:
+            self.error = e
+        finally:
+            # Wake the consumer up at the end of the stream, even if the queue is full
+            while True:
+                try:
+                    self.queue.put(None, timeout=0.1)
+                    break
+                except queue.Full:
+                    if self.stop.is_set():
+                        break
+
+    def __iter__(self):
+        if self.started:
+            raise RuntimeError('A live source can only be iterated once')
+        self.started = True
+        self.thread.start()
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                frame, arrival = item
+                self.arrivals[self.delivered] = arrival
+                self.arrivals.pop(self.delivered - ARRIVALS_KEPT, None)
+                self.delivered += 1
+                yield frame
+        finally:
+            self.close()
+        if self.error is not None:
+            raise self.error
+
+    def latency(self, frame_idx):
+        """
+        Records the end-to-end latency of a frame, from its arrival to now. Call it as soon as the frame's result is
+        ready
+
+        :param frame_idx: index of the frame among the frames delivered by the source, one of the last ARRIVALS_KEPT
+        :return: latency in seconds
+        """
+        latency = time.perf_counter() - self.arrivals[frame_idx]
+        self.latencies.add(latency)
+        return latency
+
+    def close(self):
+        """
+        Stops reading from the source
+        """
+        self.stop.set()
+        if self.connection is not None:
+            try:
+                self.connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def stats(self):
+        """
+        :return: dict of frames received, delivered and dropped, and end-to-end latency mean, max and percentiles in
+                 milliseconds, the percentiles estimated from the sampled latencies
+        """
+        stats = {'received': self.received, 'delivered': self.delivered, 'dropped': self.dropped}
+        for key, value in self.latencies.summary().items():
+            stats['latency_' + key] = value
+        return stats
+
+
+def replay(imgs, destination, fps=30.0, loops=1):
+    """
+    Replays an image sequence into a live destination at a fixed frame rate, for testing live sources
+
+    :param imgs: directory, or string array containing image file locations
+    :param destination: directory to copy the images into, or tcp://host:port to send them to
+    :param fps: frame rate of the replay
+    :param loops: number of times the sequence is replayed
+    """
+    if isinstance(imgs, str):
+        imgs = utilities.get_jpeg(imgs)
+    connection = None
+    if destination.startswith('tcp://'):
+        host, port = destination[len('tcp://'):].rsplit(':', 1)
+        for _ in range(100):
+            try:
+                connection = socket.create_connection((host, int(port)))
+                break
+            except OSError:
+                time.sleep(0.05)
+        if connection is None:
+            raise IOError('Could not connect to ' + destination)
+    elif not os.path.isdir(destination):
+        os.makedirs(destination)
+
+    start = time.perf_counter()
+    for idx in range(len(imgs) * loops):
+        # Keep to the frame rate, without drifting
+        delay = start + idx / float(fps) - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        with open(imgs[idx % len(imgs)], 'rb') as f:
+            data = f.read()
+        if connection is not None:
+            connection.sendall(HEADER.pack(len(data)) + data)
+        else:
+            # Write under a temporary name and rename, so that the reader never sees a partial file
+            name = os.path.join(destination, '%08d.jpg' % idx)
+            with open(name + '.part', 'wb') as f:
+                f.write(data)
+            os.replace(name + '.part', name)
+
+    if connection is not None:
+        connection.sendall(HEADER.pack(0))
+        connection.close()
+    else:
+        open(os.path.join(destination, END_MARKER), 'w').close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Track a car in frames that are still arriving')
+    parser.add_argument('--source', required=True, help='directory to tail, tcp://host:port, or a pipe (- for stdin)')
+    parser.add_argument('--tracker', default='lk', choices=sorted(benchmark.TRACKERS))
+    parser.add_argument('--rect', type=int, nargs=4, default=[5, 160, 50, 195], help='initial car rectangle')
+    parser.add_argument('--policy', default='block', choices=['block', 'drop'])
+    parser.add_argument('--queue-size', type=int, default=4, help='decoded frames waiting for the tracker')
+    parser.add_argument('--idle-timeout', type=float, help='seconds without new files that end a directory stream')
+    parser.add_argument('--replay', help='sequence replayed into the source, for testing')
+    parser.add_argument('--fps', type=float, default=30.0, help='frame rate of the replay')
+    args = parser.parse_args()
+
+    if args.replay and not args.source.startswith('tcp://') and not os.path.exists(args.source):
+        # The directory has to exist before the source starts, or it would be taken for a pipe
+        os.makedirs(args.source)
+    source = LiveSource(args.source, args.policy, args.queue_size, idle_timeout=args.idle_timeout)
+    if args.replay:
+        producer = threading.Thread(target=replay, args=(args.replay, args.source, args.fps))
+        producer.daemon = True
+        producer.start()
+
+    for result in benchmark.TRACKERS[args.tracker](source, args.rect, instrumentation.NULL_PROBE):
+        latency = source.latency(result.frame_idx)
+        print('frame %5d  rect %s  latency %.1f ms' % (result.frame_idx, result.rect, latency * 1000.0))
+
+    stats = source.stats()
+    print(', '.join('%s %s' % (key, round(value, 2)) for key, value in sorted(stats.items())))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,163 +5,469 @@ Lucas-Kanade Optical Flow
 Runs LK OF algorithm to update bounding rectangle of the car
 """
 
+from collections import OrderedDict
+
 import cv2
 import numpy as np
 
+import checkpoint
+import instrumentation
 import utilities
 
+# Parameters for ShiTomasi corner detection:
+# maxCorners -
+# qualityLevel - characterizes the minimal accepted quality of the image corners. The parameter value is multiplied
+#                by the best corner quality measure, which is the minimal eigenvalue or the Harris function response
+# minDistance - distance between points
+# blockSize - Size of an average block for computing a derivative covariation matrix over each pixel neighborhood.
+FEATURE_PARAMS = dict(maxCorners=20, qualityLevel=0.5, minDistance=7, blockSize=10)
 
-def lk_optical_flow(imgs, detect_interval=5, car_rect=[5, 160, 50, 195], display_image=True, write_video=False, video_name='LK_OF.avi'):
+# Parameters for Lucas kanade optical flow
+LK_PARAMS = dict(winSize=(15, 15), maxLevel=2, criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
+
+
+class TrackStore(object):
     """
-    Runs Lucas-Kanade optical flow algorithm combined with an assumption of the car location rectangle to track the car
-    location.
+    Fixed capacity, array backed store of the points being tracked. Live points are kept packed at the front of the
+    point array, and an optional ring buffer holds the last few positions of every track, so memory stays constant
+    however long the sequence is.
+    """
+
+    def __init__(self, capacity=500, history=0):
+        """
+        :param capacity: maximum number of points tracked at once, new points beyond it are dropped
+        :param history: number of past positions kept per track, 0 keeps only the current position
+        """
+        self.capacity = capacity
+        self.points = np.zeros((capacity, 2), np.float32)
+        self.count = 0
+
+        # Ring buffer of past positions: every live track is written at the same head position each frame, and ages
+        # holds how many positions each track has recorded
+        self.history = np.zeros((capacity, history, 2), np.float32)
+        self.ages = np.zeros(capacity, np.int64)
+        self.head = 0
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def live(self):
+        """
+        :return: N x 2 view of the live points
+        """
+        return self.points[:self.count]
+
+    def _record(self, start):
+        # Write the current position of the tracks from start onwards into the history
+        if self.history.shape[1] > 0:
+            self.history[start:self.count, self.head] = self.points[start:self.count]
+        self.ages[start:self.count] += 1
+
+    def update(self, p1, good):
+        """
+        Moves the live points to their tracked positions, dropping the ones that failed tracking
+
+        :param p1: N x 2 array of tracked positions of the live points
+        :param good: boolean array marking the points to keep
+        """
+        self.points[:self.count] = p1
+        self.filter(good)
+
+        # Every track moved on by one frame
+        if self.history.shape[1] > 0:
+            self.head = (self.head + 1) % self.history.shape[1]
+        self._record(0)
+
+    def filter(self, good):
+        """
+        Drops live points without moving the tracks on, e.g. to stop tracking points far from the car
+
+        :param good: boolean array marking the points to keep
+        """
+        keep = np.flatnonzero(good)
+        n = len(keep)
+        self.points[:n] = self.points[keep]
+        self.history[:n] = self.history[keep]
+        self.ages[:n] = self.ages[keep]
+        self.count = n
+
+    def add(self, p):
+        """
+        Starts tracking new points, as far as the capacity allows
+
+        :param p: N x 2 array of points
+        """
+        p = np.float32(p).reshape(-1, 2)[:self.capacity - self.count]
+        start = self.count
+        self.count += len(p)
+        self.points[start:self.count] = p
+        self.ages[start:self.count] = 0
+        self._record(start)
+
+    def inside(self, rect):
+        """
+        :param rect: rectangle [X min, Y min, X max, Y max]
+        :return: boolean array marking the live points strictly inside the rectangle
+        """
+        x, y = self.live.T
+        return (x > rect[0]) & (x < rect[2]) & (y > rect[1]) & (y < rect[3])
+
+    def track(self, idx):
+        """
+        :param idx: index of a live point
+        :return: M x 2 array of the recorded positions of the track, oldest first
+        """
+        length = min(self.ages[idx], self.history.shape[1])
+        order = (self.head - np.arange(length)[::-1]) % max(1, self.history.shape[1])
+        return self.history[idx, order]
+
+    def state(self):
+        """
+        :return: dict of arrays holding the live points, their history and ages, and the ring buffer head
+        """
+        return {'points': self.live.copy(), 'history': self.history[:self.count].copy(),
+                'ages': self.ages[:self.count].copy(), 'head': np.int64(self.head)}
+
+    def restore(self, state):
+        """
+        Replaces the live points with the ones of a state returned by state()
+
+        :param state: dict of arrays
+        """
+        n = min(len(state['points']), self.capacity)
+        self.points[:n] = state['points'][:n]
+        self.ages[:n] = state['ages'][:n]
+        if self.history.shape[1] > 0 and state['history'].shape[1:] == self.history.shape[1:]:
+            self.history[:n] = state['history'][:n]
+            self.head = int(state['head'])
+        self.count = n
+
+
+class PyramidCache(object):
+    """
+    Holds the image pyramids of the most recent frames, so that each frame's pyramid is built once and shared by the
+    forward pass, the backward pass and the next frame's passes. OpenCV's python bindings do not accept a prebuilt
+    pyramid in calcOpticalFlowPyrLK, so the cached levels are tracked through one level at a time by track_points.
+    """
+
+    def __init__(self, lk_params=None, size=2, probe=instrumentation.NULL_PROBE):
+        """
+        :param lk_params: Lucas-Kanade parameters the pyramids are built for, defaults to LK_PARAMS
+        :param size: number of frames whose pyramids are kept
+        :param probe: instrumentation probe the build time is reported to as the 'pyramid' stage
+        """
+        lk_params = LK_PARAMS if lk_params is None else lk_params
+        self.max_level = lk_params.get('maxLevel', 3)
+        self.size = size
+        self.probe = probe
+        self.pyramids = OrderedDict()
+
+    def get(self, key, img):
+        """
+        Returns the pyramid of a frame, building it if it is not cached
+
+        :param key: key identifying the frame, e.g. its index
+        :param img: grayscale image of the frame
+        :return: list of pyramid levels, finest first
+        """
+        if key not in self.pyramids:
+            with self.probe.stage('pyramid'):
+                pyramid = [img]
+                for _ in range(self.max_level):
+                    pyramid.append(cv2.pyrDown(pyramid[-1]))
+            self.pyramids[key] = pyramid
+            while len(self.pyramids) > self.size:
+                self.pyramids.popitem(last=False)
+        return self.pyramids[key]
+
+
+def flow_pyramid(pyr0, pyr1, p0, lk_params):
+    """
+    Lucas-Kanade optical flow over prebuilt pyramids, coarse to fine, each level's result seeding the next finer level
+
+    :param pyr0: list of pyramid levels of the previous image, finest first
+    :param pyr1: list of pyramid levels of the current image, finest first
+    :param p0: N x 1 x 2 array of points in the previous image
+    :param lk_params: Lucas-Kanade parameters
+    :return: N x 1 x 2 array of points in the current image, and the status of each point
+    """
+    level_params = dict(lk_params, maxLevel=0, flags=lk_params.get('flags', 0) | cv2.OPTFLOW_USE_INITIAL_FLOW)
+    top = min(len(pyr0), len(pyr1)) - 1
+    guess = p0 / float(2 ** top)
+    for level in range(top, -1, -1):
+        p1, st, err = cv2.calcOpticalFlowPyrLK(pyr0[level], pyr1[level], np.float32(p0 / float(2 ** level)),
+                                               np.float32(guess), **level_params)
+        guess = p1 * 2
+    return p1, st
+
+
+def track_points(img0, img1, p0, lk_params=None):
+    """
+    Tracks points from one image to the next with Lucas-Kanade optical flow, checking each point by tracking it back
+
+    :param img0: previous grayscale image, or its pyramid from a PyramidCache
+    :param img1: current grayscale image, or its pyramid from a PyramidCache
+    :param p0: N x 2 array of points in the previous image
+    :param lk_params: Lucas-Kanade parameters, defaults to LK_PARAMS
+    :return: N x 2 array of points in the current image, and a boolean array marking the points that passed the check
+    """
+    lk_params = LK_PARAMS if lk_params is None else lk_params
+    p0 = np.float32(p0).reshape(-1, 1, 2)
+
+    if isinstance(img0, list):
+        # Define new points to track using the cached pyramids of the current image and previous image
+        p1, st = flow_pyramid(img0, img1, p0, lk_params)
+
+        # Define new points to track using the same pyramids but reversed
+        p0r, st = flow_pyramid(img1, img0, p1, lk_params)
+    else:
+        # Define new points to track using Lucas-Kanade and the current image and previous image
+        p1, st, err = cv2.calcOpticalFlowPyrLK(img0, img1, p0, None, **lk_params)
+
+        # Define new points to track using Lucas-Kanade but with the images reversed
+        p0r, st, err = cv2.calcOpticalFlowPyrLK(img1, img0, p1, None, **lk_params)
+
+    # Find the difference between the 2 LK optical flow calculations for each tracking point
+    difference = abs(p0-p0r).reshape(-1, 2).max(-1)
+
+    # Define the good points to be those where the difference between the 2 LK optical flow calculations is
+    #  less than 1. This will allow us to backward check the points to make sure that all points are good
+    good = difference < 1
+    return p1.reshape(-1, 2), good
+
+
+def exclusion_mask(shape, points, radius=5, offset=(0, 0)):
+    """
+    Builds a detection mask that blocks a disc around every point, by marking all points at once and dilating them
+    with a disc, rather than drawing one circle at a time
+
+    :param shape: shape of the mask
+    :param points: N x 2 array of points in image coordinates
+    :param radius: radius of the blocked disc around each point
+    :param offset: (x, y) image coordinates of the top left corner of the mask
+    :return: uint8 mask, 255 where detection is allowed
+    """
+    # Work on a mask padded by the radius, so that points just off the mask still block the pixels near them
+    height, width = shape[:2]
+    blocked = np.zeros((height + 2 * radius, width + 2 * radius), np.uint8)
+    xy = np.int32(np.float32(points).reshape(-1, 2)) - np.int32(offset) + radius
+    on_mask = (xy[:, 0] >= 0) & (xy[:, 0] < blocked.shape[1]) & (xy[:, 1] >= 0) & (xy[:, 1] < blocked.shape[0])
+    blocked[xy[on_mask, 1], xy[on_mask, 0]] = 255
+    if on_mask.any():
+        # The same disc cv2.circle would draw
+        disc = np.zeros((2 * radius + 1, 2 * radius + 1), np.uint8)
+        cv2.circle(disc, (radius, radius), radius, 1, -1)
+        blocked = cv2.dilate(blocked, disc)
+    blocked = blocked[radius:radius + height, radius:radius + width]
+    return 255 - blocked
+
+
+def detect_features(gray, existing, feature_params=None, region=None):
+    """
+    Finds new features to track using Shi-Tomasi, away from the points already being tracked
 
-    :param imgs: string array containing image file locations
+    :param gray: grayscale image
+    :param existing: N x 2 array of points already being tracked
+    :param feature_params: Shi-Tomasi parameters, defaults to FEATURE_PARAMS
+    :param region: optional rectangle [X min, Y min, X max, Y max] to limit the detection to, the full image otherwise
+    :return: M x 2 array of new points
+    """
+    feature_params = FEATURE_PARAMS if feature_params is None else feature_params
+    x0, y0, x1, y1 = [0, 0, gray.shape[1], gray.shape[0]] if region is None else region
+    if x1 - x0 < 2 or y1 - y0 < 2:
+        return np.zeros((0, 2), np.float32)
+
+    # Find new features to track in the region, with a mask keeping them away from the tracked points
+    window = gray[y0:y1, x0:x1]
+    mask = exclusion_mask(window.shape, existing, offset=(x0, y0))
+    p = cv2.goodFeaturesToTrack(window, mask=mask, **feature_params)
+    if p is None:
+        return np.zeros((0, 2), np.float32)
+    return np.float32(p).reshape(-1, 2) + np.float32([x0, y0])
+
+
+def lk_track(imgs, detect_interval=5, car_rect=[5, 160, 50, 195], feature_params=None, lk_params=None, max_points=500,
+             history=0, reuse_pyramids=True, min_car_points=None, detect_expand=1.5,
+             probe=instrumentation.NULL_PROBE, rect_buffer=40, state=None, checkpointer=checkpoint.NULL_CHECKPOINTER,
+             checkpoint_name='lk'):
+    """
+    Generator running Lucas-Kanade optical flow combined with an assumption of the car location rectangle to track the
+    car location. A TrackResult is yielded as soon as each frame is tracked, no GUI calls are made.
+
+    :param imgs: string array containing image file locations, or a FrameSource
     :param detect_interval: interaval determining how often new features to track are calculated using Shi-Tomasi
             detector
     :param car_rect: initial car position defined by rectangle
-    :param display_image: flag determining whether or not to display the image stream
-    :param write_video: Flag determining whether or not to record image stream
-    :param video_name: File name of image stream
-    :return: array of average locations of the car rect
+    :param feature_params: Shi-Tomasi parameters, defaults to FEATURE_PARAMS
+    :param lk_params: Lucas-Kanade parameters, defaults to LK_PARAMS
+    :param max_points: maximum number of points tracked at once
+    :param history: number of past positions kept per tracked point
+    :param reuse_pyramids: flag determining whether each frame's pyramid is built once and reused
+    :param min_car_points: if given, features are re-detected only when fewer points than this are left in the car
+            rectangle instead of every detect_interval frames, only inside the car rectangle grown by detect_expand,
+            and points that drift out of that region are no longer tracked
+    :param detect_expand: size of the detection region relative to the car rectangle when min_car_points is given
+    :param probe: instrumentation probe the stages and counters are reported to
+    :param rect_buffer: margin in pixels around the car points the rectangle is resized towards
+    :param state: state saved by a checkpointer to resume from, imgs then starts at its frame_idx
+    :param checkpointer: checkpointer the state is saved through, see checkpoint.py
+    :param checkpoint_name: name the state is saved and resumed under, e.g. the name of the configuration, so that
+            configurations sharing a checkpoint directory never resume from each other's states
+    :return: generator of TrackResult, info['detected'] tells whether features were re-detected on the frame
     """
-    # Load images
-    cap = cv2.VideoCapture(imgs[0])
+    results = lk_track_multi(imgs, [car_rect], detect_interval, feature_params, lk_params, max_points, history,
+                             reuse_pyramids, min_car_points, detect_expand, probe, rect_buffer, state, checkpointer,
+                             checkpoint_name)
+    for result in results:
+        rect = result.rect[0]
+        yield utilities.TrackResult(result.frame_idx, rect, utilities.rect_center(rect), int(result.count[0]),
+                                    result.frame, result.points, {'detected': bool(result.info['detected'][0])})
+
+
+def lk_track_multi(imgs, car_rects, detect_interval=5, feature_params=None, lk_params=None, max_points=500,
+                   history=0, reuse_pyramids=True, min_car_points=None, detect_expand=1.5,
+                   probe=instrumentation.NULL_PROBE, rect_buffer=40, state=None,
+                   checkpointer=checkpoint.NULL_CHECKPOINTER, checkpoint_name='lk'):
+    """
+    Generator tracking several cars at once with Lucas-Kanade optical flow. The points of every car are tracked
+    together, with a single forward-backward pass per frame, and are assigned to the car rectangles all at once, so
+    the cost grows with the number of points rather than with the number of cars. A TrackResult is yielded per frame
+    holding every car: rect is an M x 4 array of rectangles, center an M x 2 array and count the number of points in
+    each rectangle.
+
+    :param imgs: string array containing image file locations, or a FrameSource
+    :param car_rects: M x 4 array of initial car positions [X min, Y min, X max, Y max]
+    :param detect_interval: interval determining how often new features to track are calculated using Shi-Tomasi
+            detector
+    :param feature_params: Shi-Tomasi parameters, defaults to FEATURE_PARAMS
+    :param lk_params: Lucas-Kanade parameters, defaults to LK_PARAMS
+    :param max_points: maximum number of points tracked at once, over all cars
+    :param history: number of past positions kept per tracked point
+    :param reuse_pyramids: flag determining whether each frame's pyramid is built once and reused
+    :param min_car_points: if given, features are re-detected around a car only when fewer points than this are left
+            in its rectangle instead of every detect_interval frames over the full frame, and points that drift out of
+            every car's detection region are no longer tracked
+    :param detect_expand: size of the detection regions relative to the car rectangles when min_car_points is given
+    :param probe: instrumentation probe the stages and counters are reported to
+    :param rect_buffer: margin in pixels around the car points the rectangles are resized towards
+    :param state: state saved by a checkpointer to resume from, imgs then starts at its frame_idx and car_rects is
+            ignored
+    :param checkpointer: checkpointer the state is saved through every interval frames, see checkpoint.py
+    :param checkpoint_name: name the state is saved and resumed under, see lk_track
+    :return: generator of TrackResult, info['detected'] tells for every car whether features were re-detected for it
+    """
+    # Load images, decoding ahead of the tracking loop
+    frames = probe.frames(utilities.open_frames(imgs))
 
-    # If write_video flag, record a video
-    if write_video:
-        height, width, _ = cv2.imread(imgs[0]).shape
-        writer = cv2.VideoWriter(video_name, -1, 20, (width, height))
+    feature_params = FEATURE_PARAMS if feature_params is None else feature_params
+    lk_params = LK_PARAMS if lk_params is None else lk_params
 
-    # Parameters for ShiTomasi corner detection:
-    # maxCorners -
-    # qualityLevel - characterizes the minimal accepted quality of the image corners. The parameter value is multiplied
-    #                by the best corner quality measure, which is the minimal eigenvalue or the Harris function response
-    # minDistance - distance between points
-    # blockSize - Size of an average block for computing a derivative covariation matrix over each pixel neighborhood.
-    feature_params = dict(maxCorners=20, qualityLevel=0.5, minDistance=7, blockSize=10)
+    # Work on a copy so the caller's rectangles are never resized in place
+    car_rects = np.int32(car_rects).reshape(-1, 4)
+    n_cars = len(car_rects)
 
-    # Parameters for Lucas kanade optical flow
-    lk_params = dict(winSize=(15, 15), maxLevel=2, criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
+    # Initialize the store that will contain feature points of every car
+    store = TrackStore(max_points, history)
 
-    # Initialize the array that will contain feature points and the average position
-    points = []
-    ave_pos = []
+    # Pyramids of the previous and current frame
+    cache = PyramidCache(lk_params, probe=probe) if reuse_pyramids else None
 
-    # Initialize the frame index
-    frame_idx = 0
+    # Carry on from a checkpoint: the rectangles, the points and the previous frame they were tracked to
+    start = checkpoint.check_state(state, checkpoint_name)
+    prev_gray = None
+    if state is not None:
+        car_rects = np.int32(state['car_rects']).reshape(-1, 4)
+        n_cars = len(car_rects)
+        store.restore(state)
+        prev_gray = state['prev_gray']
 
     # Loop through the image sequence, defining feature points every detection interval
-    while frame_idx < len(imgs):
-
-        # Read the current frame
-        ret, frame = cap.read()
+    for frame_idx, frame in enumerate(frames, start):
 
         # Create grayscale image
-        frame_gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-
-        # Create copy of image
-        vis = frame.copy()
-
-        # Empty the car points
-        x_car_points = []
-        y_car_points = []
+        with probe.stage('gray'):
+            frame_gray = utilities.to_gray(frame)
+        n_car_points = np.zeros(n_cars, np.int64)
 
         # If the length of points to track is greater than 0, then the Lucas-Kanade optical flow algorithm is run on
         # those feature points and the previous feature points
-        if len(points) > 0:
+        if len(store) > 0:
 
-            # Define current image (img1), and previous image (img0)
+            # Track the points of every car forward and check them by tracking them back, only the good points are kept
             img0, img1 = prev_gray, frame_gray
-
-            # Define previous points that were tracked
-            p0 = np.float32([pt[-1] for pt in points]).reshape(-1, 1, 2)
-
-            # Define new points to track using Lucas-Kanade and the current image and previous image
-            p1, st, err = cv2.calcOpticalFlowPyrLK(img0, img1, p0, None, **lk_params)
-
-            # Define new points to track using Lucas-Kanade but with the images reversed
-            p0r, st, err = cv2.calcOpticalFlowPyrLK(img1, img0, p1, None, **lk_params)
-
-            # Find the difference between the 2 LK optical flow calculations for each tracking point
-            difference = abs(p0-p0r).reshape(-1, 2).max(-1)
-
-            # Define the good points to be those where the difference between the 2 LK optical flow calculations is
-            #  less than 1. This will allow us to backward check the points to make sure that all points are good
-            good = difference < 1
-            
-            # Define empty array to be new points to track
-            new_points = []
-
-            # Run through all points found in the LK optical flow calculation, determining which points will be tracked
-            for pt, (x, y), good_flag in zip(points, p1.reshape(-1, 2), good):
-                # If the difference between the 2 LK optical flow calcuations
-                # (the one comparing the current image to the previous image, and the one that does the reverse), then
-                # move on the to the next point
-                if not good_flag:
-                    continue
-                # Add new points to the points to track
-                pt.append((x, y))
-                new_points.append(pt)
-
-                # Draw circle around point
-                cv2.circle(vis, (x, y), 2, (0, 255, 0), -1)
-
-                # If the point lies within the car rectangle, add it to the car points array
-                if x > car_rect[0] and x < car_rect[2] and y > car_rect[1] and y < car_rect[3]:
-                    x_car_points.append(x)
-                    y_car_points.append(y)
-
-            # Update the car rectangle if it contains any points
-            if len(x_car_points) > 0:
-                car_points = np.array([x_car_points, y_car_points])
-                car_rect = utilities.rect_resize(car_rect, car_points)
-
-            # Append the center position of the car rectangle to the average position array
-            ave_pos.append((np.mean([car_rect[0], car_rect[2]]), np.mean([car_rect[1], car_rect[3]])))
-
-            # Define
-            points = new_points
-
-        # If on the detect_interval-th frame, then re-detect features to track using Shi-Tomasi
-        if frame_idx % detect_interval == 0:
-
-            # Define image mask
-            mask = np.zeros_like(frame_gray)
-            mask[:] = 255
-            
-            # Add points currently being tracked to the mask
-            for x, y in [np.int32(pt[-1]) for pt in points]:
-                cv2.circle(mask, (x, y), 5, 0, -1)
-            # Find new features to track using the mask defined
-            p = cv2.goodFeaturesToTrack(frame_gray, mask=mask, **feature_params)
-
-            # Add new points to the points array
-            if p is not None:
-                for x, y in np.float32(p).reshape(-1, 2):
-                    points.append([(x, y)])
+            if cache is not None:
+                img0, img1 = cache.get(frame_idx - 1, prev_gray), cache.get(frame_idx, frame_gray)
+            with probe.stage('flow'):
+                p1, good = track_points(img0, img1, store.live, lk_params)
+                store.update(p1, good)
+            probe.count('points_tracked', len(good))
+            probe.count('points_rejected', len(good) - len(store))
+
+            # Assign the points to the car rectangles and update every rectangle that contains any points
+            with probe.stage('rect_resize'):
+                inside = utilities.points_in_rects(store.live, car_rects)
+                n_car_points = inside.sum(axis=1)
+                car_rects = utilities.rects_resize(car_rects, store.live, inside, rect_buffer)
+
+        # Points drawn for this frame are the ones that survived tracking, before re-detection
+        tracked = store.live.copy()
+
+        if min_car_points is None:
+            # If on the detect_interval-th frame, then re-detect features to track using Shi-Tomasi over the full frame
+            detect = np.full(n_cars, frame_idx % detect_interval == 0)
+            regions = None
+        else:
+            # Re-detect only for the cars running out of points, and only around them
+            detect = n_car_points < min_car_points
+            regions = np.int32([utilities.expand_rect(rect, frame_gray.shape, detect_expand) for rect in car_rects])
+
+            # Stop tracking background points that are far from every car
+            x, y = store.live.T
+            near = ((x >= regions[:, 0:1]) & (x < regions[:, 2:3]) & (y >= regions[:, 1:2]) & (y < regions[:, 3:4]))
+            store.filter(near.any(axis=0))
+
+        # Add new points to the store, once over the full frame or once per car region
+        if detect.any():
+            with probe.stage('detect'):
+                n_detected = 0
+                for region in ([None] if regions is None else regions[detect]):
+                    new_points = detect_features(frame_gray, store.live, feature_params, region)
+                    store.add(new_points)
+                    n_detected += len(new_points)
+            probe.count('features_detected', n_detected)
 
         # Set the previous grayscale image to the current grayscale image
         prev_gray = frame_gray
 
+        centers = np.float64([utilities.rect_center(rect) for rect in car_rects])
+        yield utilities.TrackResult(frame_idx, car_rects.copy(), centers, n_car_points, frame, tracked,
+                                    {'detected': detect})
 
-        if display_image:
-            cv2.rectangle(vis, (car_rect[0], car_rect[1]), (car_rect[2], car_rect[3]), 255)
-            cv2.imshow('lk_track', vis)
-            frame_idx += 1
-            ch = 0xFF & cv2.waitKey(30)
-            if ch == 27:
-                break
+        # Checkpoint once the consumer has taken the result, so that a resumed run starts with the next frame
+        if checkpointer.due(frame_idx):
+            with probe.stage('checkpoint'):
+                checkpointer.save(dict(store.state(), tracker=checkpoint_name, frame_idx=frame_idx + 1,
+                                       car_rects=car_rects, prev_gray=prev_gray))
 
-        # Write to video
-        if write_video:
-            writer.write(vis)
 
-    # Close the image sequence viewer
-    cv2.destroyAllWindows()
-    if write_video:
-        writer.release()
-    return ave_pos
+def lk_optical_flow(imgs, detect_interval=5, car_rect=[5, 160, 50, 195], display_image=True, write_video=False, video_name='LK_OF.avi'):
+    """
+    Runs Lucas-Kanade optical flow algorithm combined with an assumption of the car location rectangle to track the car
+    location.
+
+    :param imgs: string array containing image file locations, or a FrameSource
+    :param detect_interval: interaval determining how often new features to track are calculated using Shi-Tomasi
+            detector
+    :param car_rect: initial car position defined by rectangle
+    :param display_image: flag determining whether or not to display the image stream
+    :param write_video: Flag determining whether or not to record image stream
+    :param video_name: File name of image stream
+    :return: array of average locations of the car rect
+    """
+    results = lk_track(imgs, detect_interval, car_rect)
+    return utilities.show_results(results, 'lk_track', display_image, write_video, video_name)
+
 
 if __name__ == '__main__':
     # Load images
@@ -171,4 +477,4 @@ if __name__ == '__main__':
     ave_pos = lk_optical_flow(imgs)
 
     # Plot the car position
-    utilities.plot_pixel_position(ave_pos)
\ No newline at end of file
+    utilities.plot_pixel_position(ave_pos)
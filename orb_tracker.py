@@ -3,97 +3,193 @@
 ORB Detector and Tracker
 ========================
 Runs an ORB detector and car tracker based on an initial car rectangle position value.
+
+The ORB detector is created once. On every frame it only looks in a search window around the car rectangle, and the
+descriptors it finds are matched against a target model: the keypoints and descriptors seen on the car in the last
+frame it was found. The rectangle is moved by the median motion of the matches and scaled by the median change in
+distance between them. The model is only replaced when enough matches were found, so the rectangle does not drift
+onto the background while the car is hidden.
 """
 
 import cv2
 import numpy as np
 
+import checkpoint
+import hybrid_tracker
+import instrumentation
 import utilities
 
+# Parameters of the ORB detector, with a smaller patch than the default 31 pixels as the car is only a few tens of
+# pixels across
+FEATURE_PARAMS = dict(nfeatures=40, edgeThreshold=15, patchSize=15)
+
+# Parameters of the FLANN LSH index used when matching with matcher='lsh'
+LSH_PARAMS = dict(algorithm=6, table_number=6, key_size=12, multi_probe_level=1)
 
-def orb(imgs, car_rect=[5, 160, 50, 195], feature_params=dict(nfeatures=40), display_image=True,  write_video=False, video_name='ORB.avi'):
+
+def create_orb(feature_params):
     """
-    Tracks a car given an initial rectangle position of the car and displays tracking rectangle and points
+    Creates an ORB detector, with the factory function of OpenCV 3 and later or the constructor of OpenCV 2
 
-    :param imgs: string array containing image file locations
-    :param car_rect: Initial position of the car in array format [X min, Y min, X max, Y max]
     :param feature_params: The feature parameters determining the ORB feature detector
-    :param display_image: flag determining whether or not to display the image stream
-    :param write_video: Flag determining whether or not to record image stream
-    :param video_name: File name of image stream
-    :return: array of average locations of the car rect
+    :return: ORB detector
     """
+    if hasattr(cv2, 'ORB_create'):
+        return cv2.ORB_create(**feature_params)
+    return cv2.ORB(**feature_params)
 
-    # Initialize the average position of the rect to an empty array and the index to 0
-    ave_pos = []
-    frame_idx = 0
-
-    # If write_video flag, record a video
-    if write_video:
-        height, width, _ = cv2.imread(imgs[0]).shape
-        writer = cv2.VideoWriter(video_name, -1, 20, (width, height))
-
-    # Loop through all images
-    while frame_idx < len(imgs):
-
-        # Read the image
-        frame = cv2.imread(imgs[frame_idx], 0)
-
-        # Initialize ORB feature detector (default amount of features to track is 40)
-        orb = cv2.ORB(**feature_params)
 
-        # Detect keypoints in the current image with ORB
-        key_points = orb.detect(frame, None)
-        key_points, _ = orb.compute(frame, key_points)
-
-        # Initialize empty array that will contain points detected on the car
-        x_car_points = []
-        y_car_points = []
+def create_matcher(matcher='bf'):
+    """
+    Creates a descriptor matcher for binary ORB descriptors
 
-        # Loop through all key points detected by ORB and resize the car
-        # rectangle based on the points contained by the rectangle
-        for p in key_points:
-            # Set x and y to integers
-            (x, y) = np.int32(p.pt)
+    :param matcher: 'bf' for brute force Hamming matching with a cross check, 'lsh' for a FLANN LSH index with a ratio
+                    test
+    :return: descriptor matcher
+    """
+    if matcher == 'bf':
+        return cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
+    if matcher == 'lsh':
+        return cv2.FlannBasedMatcher(LSH_PARAMS, dict(checks=32))
+    raise ValueError('Unknown matcher ' + matcher)
 
-            # If the given point is contained within the current car rectangle
-            # add it to the car_points array
-            if x > car_rect[0] and x < car_rect[2] and y > car_rect[1] and y < car_rect[3]:
-                cv2.circle(frame, (x, y), 2, (0, 255, 0), -1)
-                x_car_points.append(x)
-                y_car_points.append(y)
 
+def match_model(matcher, model_descriptors, descriptors, max_distance=64, ratio=0.8):
+    """
+    Matches descriptors of the current frame against the target model
+
+    :param matcher: matcher returned by create_matcher
+    :param model_descriptors: M x 32 array of model descriptors
+    :param descriptors: N x 32 array of descriptors of the current frame
+    :param max_distance: largest Hamming distance of a match
+    :param ratio: Lowe's ratio test threshold, used by matchers that do not cross check
+    :return: (array of model indices, array of frame indices) of the matches
+    """
+    if model_descriptors is None or descriptors is None or len(model_descriptors) == 0 or len(descriptors) < 2:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64)
+
+    if isinstance(matcher, cv2.BFMatcher):
+        matches = [m for m in matcher.match(model_descriptors, descriptors) if m.distance <= max_distance]
+    else:
+        matches = [pair[0] for pair in matcher.knnMatch(model_descriptors, descriptors, k=2)
+                   if len(pair) == 2 and pair[0].distance < ratio * pair[1].distance and
+                   pair[0].distance <= max_distance]
+    return (np.int64([m.queryIdx for m in matches]).reshape(-1),
+            np.int64([m.trainIdx for m in matches]).reshape(-1))
+
+
+def orb_track(imgs, car_rect=[5, 160, 50, 195], feature_params=None, probe=instrumentation.NULL_PROBE,
+              search_expand=2.0, matcher='bf', min_matches=3, max_distance=64, state=None,
+              checkpointer=checkpoint.NULL_CHECKPOINTER, checkpoint_name='orb'):
+    """
+    Generator tracking a car given an initial rectangle position of the car. A TrackResult is yielded as soon as each
+    frame is tracked, no GUI calls are made.
 
+    :param imgs: string array containing image file locations, or a FrameSource
+    :param car_rect: Initial position of the car in array format [X min, Y min, X max, Y max]
+    :param feature_params: The feature parameters determining the ORB feature detector, defaults to FEATURE_PARAMS
+    :param probe: instrumentation probe the stages and counters are reported to
+    :param search_expand: size of the search window relative to the car rectangle
+    :param matcher: 'bf' for brute force Hamming matching, 'lsh' for a FLANN LSH index
+    :param min_matches: matches with the target model needed to move the rectangle and refresh the model
+    :param max_distance: largest Hamming distance of a match
+    :param state: state saved by a checkpointer to resume from, imgs then starts at its frame_idx and car_rect is
+                  ignored
+    :param checkpointer: checkpointer the state is saved through every interval frames, see checkpoint.py
+    :param checkpoint_name: name the state is saved and resumed under, e.g. the name of the configuration, so that
+                            configurations sharing a checkpoint directory never resume from each other's states
+    :return: generator of TrackResult, count is the number of matches with the target model
+    """
 
-        # If there are any points in the car rectangle, resize the rectangle based on those points
-        if len(x_car_points) > 0:
-            car_points = np.array([x_car_points, y_car_points])
-            car_rect = utilities.rect_resize(car_rect, car_points)
+    # Load images, decoded directly to grayscale ahead of the detection loop
+    frames = probe.frames(utilities.open_frames(imgs, grayscale=True))
 
-        # Append the center position of the car rectangle to the average position array
-        ave_pos.append((np.mean([car_rect[0], car_rect[2]]), np.mean([car_rect[1], car_rect[3]])))
+    feature_params = FEATURE_PARAMS if feature_params is None else feature_params
 
-        if display_image:
-            cv2.rectangle(frame, (car_rect[0], car_rect[1]), (car_rect[2], car_rect[3]), 255)
-            cv2.imshow('frame', frame)
-            k = cv2.waitKey(30) & 0xff
-            if k == 27:
-                break
+    # Create the detector and matcher once for the whole sequence
+    orb = create_orb(feature_params)
+    descriptor_matcher = create_matcher(matcher)
 
-        # Write to video
-        if write_video:
-            writer.write(frame)
+    # Work on a copy so the caller's rectangle is never moved in place
+    rect = np.float64(car_rect)
 
-        # Update the frame index
-        frame_idx += 1
+    # Target model: positions and descriptors of the keypoints on the car the last time it was found
+    model_points = np.zeros((0, 2), np.float32)
+    model_descriptors = None
 
-    cv2.destroyAllWindows()
-    if write_video:
-        writer.release()
-    # Return the average position array
-    return ave_pos
+    # Carry on from a checkpoint: the rectangle and the target model
+    start = checkpoint.check_state(state, checkpoint_name)
+    if state is not None:
+        rect = np.float64(state['rect'])
+        model_points = state['model_points']
+        if state['has_model']:
+            model_descriptors = state['model_descriptors']
 
+    # Loop through all images
+    for frame_idx, frame in enumerate(frames, start):
+
+        # ORB works on the grayscale image
+        with probe.stage('gray'):
+            frame = utilities.to_gray(frame)
+
+        # Detect keypoints only in a window around the car rectangle
+        with probe.stage('detect'):
+            x0, y0, x1, y1 = utilities.expand_rect(rect, frame.shape, search_expand)
+            key_points, descriptors = [], None
+            if x1 - x0 > 1 and y1 - y0 > 1:
+                key_points, descriptors = orb.detectAndCompute(frame[y0:y1, x0:x1], None)
+            points = np.float32([p.pt for p in key_points]).reshape(-1, 2) + np.float32([x0, y0])
+        probe.count('keypoints', len(key_points))
+
+        # Match against the target model. Without a model, e.g. on the first frame or when the rectangle held no
+        # keypoints so far, the frame only builds it
+        with probe.stage('match'):
+            model_idx, frame_idx_matched = match_model(descriptor_matcher, model_descriptors, descriptors,
+                                                       max_distance)
+        probe.count('matches', len(model_idx))
+
+        matched = points[frame_idx_matched]
+        bootstrap = model_descriptors is None or len(model_descriptors) == 0
+        found = len(model_idx) >= min_matches
+        if found or bootstrap:
+            # Move the rectangle with the matched keypoints, then refresh the model with the keypoints on the car
+            with probe.stage('rect_update'):
+                if found:
+                    rect = hybrid_tracker.propagate_rect(rect, model_points[model_idx], matched)
+                on_car = utilities.points_in_rects(points, rect)[0]
+                if on_car.sum() >= min_matches or bootstrap:
+                    model_points = points[on_car]
+                    model_descriptors = descriptors[on_car] if descriptors is not None else None
+                    found = found or len(model_points) > 0
+
+        int_rect = np.int32(np.round(rect))
+        yield utilities.TrackResult(frame_idx, int_rect, utilities.rect_center(rect), len(model_idx), frame,
+                                    matched, {'found': found})
+
+        # Checkpoint once the consumer has taken the result, so that a resumed run starts with the next frame
+        if checkpointer.due(frame_idx):
+            with probe.stage('checkpoint'):
+                checkpointer.save({'tracker': checkpoint_name, 'frame_idx': frame_idx + 1, 'rect': rect,
+                                   'model_points': model_points, 'has_model': model_descriptors is not None,
+                                   'model_descriptors': np.zeros((0, 32), np.uint8) if model_descriptors is None
+                                   else model_descriptors})
+
+
+def orb(imgs, car_rect=[5, 160, 50, 195], feature_params=None, display_image=True,  write_video=False,
+        video_name='ORB.avi'):
+    """
+    Tracks a car given an initial rectangle position of the car and displays tracking rectangle and points
 
+    :param imgs: string array containing image file locations, or a FrameSource
+    :param car_rect: Initial position of the car in array format [X min, Y min, X max, Y max]
+    :param feature_params: The feature parameters determining the ORB feature detector, defaults to FEATURE_PARAMS
+    :param display_image: flag determining whether or not to display the image stream
+    :param write_video: Flag determining whether or not to record image stream
+    :param video_name: File name of image stream
+    :return: array of average locations of the car rect
+    """
+    results = orb_track(imgs, car_rect, feature_params)
+    return utilities.show_results(results, 'frame', display_image, write_video, video_name)
 
 
 if __name__ == '__main__':
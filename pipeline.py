@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+"""
+Multi-Tracker Pipeline
+======================
+Runs several trackers over the same image sequence in a single pass. Every frame is decoded and converted to
+grayscale once, and the grayscale frame is handed to every tracker, instead of each tracker re-reading and
+re-decoding the whole sequence.
+
+Trackers are driven through a common interface: init(frame, rect) starts tracking on the first frame and update(frame)
+tracks the next one, both returning a TrackResult. GeneratorTracker adapts any of the tracker generators (lk_track,
+orb_track, cascade_track, dense_track, hybrid_track) to this interface by feeding it one frame at a time.
+
+multi_track yields one TrackResult per frame, whose rect is the fused estimate of all trackers (a confidence weighted
+combination of their rectangles) and whose info['results'] holds the result of every tracker by name.
+"""
+
+import numpy as np
+
+import cascade_tracker
+import dense_optical_flow
+import hybrid_tracker
+import instrumentation
+import lk_tracker
+import orb_tracker
+import utilities
+
+# Count of points, matches or detections at which a tracker is half confident in its result, see result_confidence
+SUPPORT_COUNT = 10
+
+# Least overlap with the rectangle of the most confident tracker for a rectangle to be fused with it
+FUSE_OVERLAP = 0.3
+
+# Trackers run by the demo, each called with the frames to track, the initial rectangle and a probe
+DEMO_TRACKERS = {
+    'lk': lambda frames, rect, probe: lk_tracker.lk_track(frames, car_rect=rect, probe=probe),
+    'orb': lambda frames, rect, probe: orb_tracker.orb_track(frames, car_rect=rect, probe=probe),
+    'cascade': lambda frames, rect, probe: cascade_tracker.cascade_track(frames, './resources/cars3.xml', True,
+                                                                         rect, probe=probe),
+    'dense': lambda frames, rect, probe: dense_optical_flow.dense_track(frames, rect, probe=probe),
+    'hybrid': lambda frames, rect, probe: hybrid_tracker.hybrid_track(frames, './resources/cars3.xml', rect,
+                                                                      probe=probe),
+}
+
+
+class Tracker(object):
+    """
+    Common tracker interface, initialized with a rectangle on a first frame and updated with every following frame
+    """
+
+    def init(self, frame, rect):
+        """
+        :param frame: first frame, grayscale
+        :param rect: initial car position [X min, Y min, X max, Y max]
+        :return: TrackResult of the first frame
+        """
+        raise NotImplementedError
+
+    def update(self, frame):
+        """
+        :param frame: next frame, grayscale
+        :return: TrackResult of the frame
+        """
+        raise NotImplementedError
+
+
+class _Feed(object):
+    """
+    Iterator handing a generator tracker the single frame it is currently allowed to read
+    """
+
+    def __init__(self):
+        self.frame = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.frame is None:
+            raise StopIteration
+        frame, self.frame = self.frame, None
+        return frame
+
+
+class GeneratorTracker(Tracker):
+    """
+    Drives a tracker generator one frame at a time through the Tracker interface
+    """
+
+    def __init__(self, track, probe=instrumentation.NULL_PROBE):
+        """
+        :param track: callable taking (frames, initial rect, probe) and returning a generator of TrackResult
+        :param probe: instrumentation probe handed to the tracker
+        """
+        self.track = track
+        self.probe = probe
+        self.feed = None
+        self.results = None
+
+    def init(self, frame, rect):
+        self.close()
+        self.feed = _Feed()
+        self.results = self.track(self.feed, rect, self.probe)
+        return self.update(frame)
+
+    def update(self, frame):
+        self.feed.frame = frame
+        result = next(self.results, None)
+        if result is None or self.feed.frame is not None:
+            raise RuntimeError('Tracker did not consume exactly one frame')
+        return result
+
+    def close(self):
+        """
+        Stops the underlying generator, releasing whatever it holds
+        """
+        if self.results is not None and hasattr(self.results, 'close'):
+            self.results.close()
+        self.results = None
+
+
+def result_confidence(result, peak):
+    """
+    Confidence of a tracker in its result, from the points, matches or detections it is based on. The count is
+    normalised by the largest count of the same tracker so far, so that trackers counting different things (a few
+    matches, hundreds of flow vectors) compare, and damped while it is small, so that a rectangle held by a couple of
+    points barely counts. A result the tracker reports as not found has no confidence.
+
+    :param result: TrackResult of a tracker
+    :param peak: largest count of the tracker so far
+    :return: confidence between 0 and 1
+    """
+    if result.rect is None or not result.info.get('found', True):
+        return 0.0
+    count = float(np.sum(result.count)) if result.count is not None else 0.0
+    if count <= 0 or peak <= 0:
+        return 0.0
+    return min(1.0, count / peak) * count / (count + SUPPORT_COUNT)
+
+
+def fuse_rects(rects, weights=None, confidences=None):
+    """
+    Fuses rectangles into a single estimate. The rectangle of the most confident tracker (tracker weight times the
+    tracker's confidence in it) anchors the estimate, and the rectangles that do not overlap it by FUSE_OVERLAP are
+    left out, as averaging rectangles that disagree lands between them, on neither. The others are weighted by tracker
+    weight times confidence times their agreement with the rest (mean overlap with the other rectangles left), so a
+    tracker that drifted away from the consensus barely moves the estimate. When no rectangles agree the weights and
+    confidences alone are used, and when no tracker is confident the weights alone.
+
+    :param rects: N x 4 array of rectangles [X min, Y min, X max, Y max]
+    :param weights: optional array of N tracker weights, defaults to equal weights
+    :param confidences: optional array of N tracker confidences, see result_confidence, defaults to equal confidences
+    :return: (fused rectangle as a float array, array of N fusion weights summing to 1, 0 for the rectangles left
+             out), or (None, None) without rects
+    """
+    rects = np.float64(rects).reshape(-1, 4)
+    if len(rects) == 0:
+        return None, None
+    weights = np.ones(len(rects)) if weights is None else np.float64(weights)
+    confidences = np.ones(len(rects)) if confidences is None else np.float64(confidences)
+
+    # Overlap of every rectangle with every other one
+    i, j = np.meshgrid(np.arange(len(rects)), np.arange(len(rects)), indexing='ij')
+    overlaps = utilities.rect_overlap(rects[i.ravel()], rects[j.ravel()]).reshape(len(rects), len(rects))
+
+    # Leave out the rectangles that disagree with the most confident one
+    best = np.argmax(weights * confidences) if (weights * confidences).sum() > 0 else np.argmax(weights)
+    kept = overlaps[best] >= FUSE_OVERLAP
+    kept[best] = True
+
+    # Mean overlap of every rectangle kept with the other ones kept
+    agreement = np.ones(len(rects))
+    if kept.sum() > 1:
+        np.fill_diagonal(overlaps, 0.0)
+        agreement = overlaps[:, kept].sum(axis=1) / (kept.sum() - 1)
+
+    for confidence in (weights * confidences * agreement * kept, weights * confidences * kept, weights * kept):
+        if confidence.sum() > 0:
+            break
+    confidence = confidence / confidence.sum()
+    return np.dot(confidence, rects), confidence
+
+
+def multi_track(imgs, car_rect, trackers, weights=None, probe=instrumentation.NULL_PROBE):
+    """
+    Generator running several trackers over a sequence in a single pass. Every frame is decoded and converted to
+    grayscale once and handed to every tracker. A TrackResult is yielded per frame with the fused rectangle, and
+    info['results'] / info['confidence'] holding the result and fusion weight of every tracker by name.
+
+    :param imgs: string array containing image file locations, or a FrameSource
+    :param car_rect: initial car position [X min, Y min, X max, Y max]
+    :param trackers: dict of tracker name to callable taking (frames, initial rect, probe)
+    :param weights: optional dict of tracker name to fusion weight, defaults to 1 for every tracker
+    :param probe: instrumentation probe the decode, gray, per-tracker and fuse stages are reported to
+    :return: generator of TrackResult, rect and center are None while no tracker has a rectangle
+    """
+    weights = {} if weights is None else weights
+    names = sorted(trackers)
+    running = dict((name, GeneratorTracker(trackers[name])) for name in names)
+
+    # Largest count of every tracker so far, its confidence is relative to it
+    peaks = dict((name, 0.0) for name in names)
+
+    # Load images, decoding ahead of the tracking loop
+    frames = probe.frames(utilities.open_frames(imgs))
+
+    try:
+        for frame_idx, frame in enumerate(frames):
+
+            # Convert once for every tracker
+            with probe.stage('gray'):
+                gray = utilities.to_gray(frame)
+
+            results = {}
+            for name in names:
+                with probe.stage('track_' + name):
+                    if frame_idx == 0:
+                        results[name] = running[name].init(gray, car_rect)
+                    else:
+                        results[name] = running[name].update(gray)
+
+            # Fuse the rectangles of the trackers that have one, each weighted by its confidence in it
+            with probe.stage('fuse'):
+                found = [name for name in names if results[name].rect is not None]
+                for name in names:
+                    if results[name].count is not None:
+                        peaks[name] = max(peaks[name], float(np.sum(results[name].count)))
+                rect, confidence = fuse_rects([results[name].rect for name in found],
+                                              [weights.get(name, 1.0) for name in found],
+                                              [result_confidence(results[name], peaks[name]) for name in found])
+            confidence = dict(zip(found, [] if confidence is None else confidence.tolist()))
+
+            # Gather the points and detections of every tracker so they can be drawn on the fused result
+            points = [np.float32(r.points).reshape(-1, 2) for r in results.values() if r.points is not None]
+            points = np.concatenate(points) if points else None
+            detections = [d for r in results.values() for d in r.info.get('detections', ())]
+
+            info = {'results': results, 'confidence': confidence, 'detections': detections}
+            if rect is None:
+                yield utilities.TrackResult(frame_idx, None, None, 0, frame, points, info)
+            else:
+                yield utilities.TrackResult(frame_idx, np.int32(np.round(rect)), utilities.rect_center(rect),
+                                            len(found), frame, points, info)
+    finally:
+        for tracker in running.values():
+            tracker.close()
+
+
+def multi_tracker(imgs, car_rect, trackers=DEMO_TRACKERS, weights=None, display_image=True, write_video=False,
+                  video_name='MULTI.avi'):
+    """
+    Runs several trackers in a single pass and displays the fused tracking rectangle with the points and detections
+    of every tracker
+
+    :param imgs: string array containing image file locations, or a FrameSource
+    :param car_rect: initial car position [X min, Y min, X max, Y max]
+    :param trackers: dict of tracker name to callable taking (frames, initial rect, probe)
+    :param weights: optional dict of tracker name to fusion weight
+    :param display_image: flag determining whether or not to display the image stream
+    :param write_video: Flag determining whether or not to record image stream
+    :param video_name: File name of image stream
+    :return: array of average locations of the fused car rect
+    """
+    results = multi_track(imgs, car_rect, trackers, weights)
+    return utilities.show_results(results, 'multi', display_image, write_video, video_name)
+
+
+if __name__ == '__main__':
+
+    # Load images
+    imgs = utilities.get_jpeg('./resources/car/')
+
+    # Get average position of the fused rectangle, lk and hybrid only as orb and dense are much less accurate here
+    ave_pos = multi_tracker(imgs, [5, 160, 50, 195], dict((k, DEMO_TRACKERS[k]) for k in ('lk', 'hybrid')))
+
+    # Plot the average position
+    utilities.plot_pixel_position(ave_pos)
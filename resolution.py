@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""
+Reduced Resolution Tracking
+===========================
+Runs any tracker on frames reduced by a factor of 2, 4 or 8, so that the cost follows the detail on the target rather
+than the area of the frame. The car in resources/car is only about 45 x 35 pixels, so full resolution pyramids,
+corner detection and cascade scans spend most of their time on pixels far from it.
+
+The factor is chosen from the size of the target: the largest factor that still leaves at least MIN_TARGET_PIXELS
+pixels and MIN_TARGET_SIDE pixels on either side of the target. Frames decoded from JPEG files are decoded directly at
+the reduced size (IMREAD_REDUCED_*), other frames are resized. The tracker runs in reduced coordinates and every
+result is mapped back to full resolution coordinates, with info['scale'] holding the factor.
+
+Parameters given in pixels (window sizes, the rectangle buffer, ORB's patch size, ...) would cover a larger part of
+the frame at a reduced resolution, so reduced_track takes a tracker builder, called with the factor, which scales
+them down. SCALED_TRACKERS holds builders for the trackers:
+
+    for result in resolution.reduced_track(resolution.SCALED_TRACKERS['lk'], imgs, [5, 160, 50, 195]):
+        print(result.rect)
+"""
+
+import cv2
+import numpy as np
+
+import cascade_tracker
+import dense_optical_flow
+import instrumentation
+import lk_tracker
+import orb_tracker
+import utilities
+
+# Least number of pixels, and least width and height, the target keeps at the reduced resolution
+MIN_TARGET_PIXELS = 256
+MIN_TARGET_SIDE = 12
+
+
+# Tracker builders, each called with the reduction factor and returning a tracker called with the frames to track, the
+# initial rectangle and a probe, with its pixel parameters scaled to the reduced frames
+SCALED_TRACKERS = {
+    'lk': lambda factor: lambda frames, rect, probe: lk_tracker.lk_track(frames, car_rect=rect, probe=probe,
+                                                                         rect_buffer=40 // factor),
+    'orb': lambda factor: lambda frames, rect, probe: orb_tracker.orb_track(
+        frames, rect, dict(orb_tracker.FEATURE_PARAMS, edgeThreshold=max(3, 15 // factor),
+                           patchSize=max(3, 15 // factor)), probe),
+    'cascade': lambda factor: lambda frames, rect, probe: cascade_tracker.cascade_track(
+        frames, './resources/cars3.xml', True, rect, probe=probe),
+    'dense': lambda factor: lambda frames, rect, probe: dense_optical_flow.dense_track(frames, rect, probe=probe),
+}
+
+
+def choose_scale(rect, min_pixels=MIN_TARGET_PIXELS, min_side=MIN_TARGET_SIDE):
+    """
+    Chooses the largest reduction factor that leaves enough pixels on the target
+
+    :param rect: target rectangle [X min, Y min, X max, Y max] at full resolution
+    :param min_pixels: least area of the target at the reduced resolution
+    :param min_side: least width and height of the target at the reduced resolution
+    :return: reduction factor, one of utilities.REDUCED_FLAGS
+    """
+    width, height = float(rect[2] - rect[0]), float(rect[3] - rect[1])
+    best = 1
+    for factor in sorted(utilities.REDUCED_FLAGS):
+        w, h = width / factor, height / factor
+        if w * h >= min_pixels and min(w, h) >= min_side:
+            best = factor
+    return best
+
+
+def reduced_frames(imgs, factor):
+    """
+    Returns the frames of a sequence reduced by a factor, decoded directly at the reduced size when they come from
+    JPEG files
+
+    :param imgs: directory, string array containing image file locations, a FrameSource or an iterable of frames
+    :param factor: reduction factor, one of utilities.REDUCED_FLAGS
+    :return: iterable of reduced frames
+    """
+    if isinstance(imgs, utilities.FrameSource):
+        return utilities.FrameSource(imgs.imgs, imgs.grayscale, imgs.buffer_size, imgs.workers, imgs.start,
+                                     imgs.reduce * factor)
+    frames = utilities.open_frames(imgs)
+    if isinstance(frames, utilities.FrameSource):
+        return utilities.FrameSource(frames.imgs, frames.grayscale, reduce=factor)
+    if factor == 1:
+        return frames
+    return (cv2.resize(frame, (frame.shape[1] // factor, frame.shape[0] // factor), interpolation=cv2.INTER_AREA)
+            for frame in frames)
+
+
+def scale_result(result, factor):
+    """
+    Maps a result tracked on reduced frames back to full resolution coordinates
+
+    :param result: TrackResult in reduced coordinates
+    :param factor: reduction factor of the frames
+    :return: TrackResult in full resolution coordinates, with info['scale'] set to the factor
+    """
+    info = dict(result.info, scale=factor)
+    if len(info.get('detections', ())) > 0:
+        info['detections'] = np.int32(np.round(np.float64(info['detections']) * factor))
+    if 'window' in info and info['window'] is not None:
+        info['window'] = [int(v * factor) for v in info['window']]
+
+    rect = center = points = None
+    if result.rect is not None:
+        rect = np.int32(np.round(np.float64(result.rect) * factor))
+        center = tuple(np.float64(result.center) * factor)
+    if result.points is not None:
+        points = np.float32(result.points) * factor
+    return utilities.TrackResult(result.frame_idx, rect, center, result.count, result.frame, points, info)
+
+
+def reduced_track(build, imgs, car_rect, factor=None, probe=instrumentation.NULL_PROBE, **kwargs):
+    """
+    Generator running a tracker on reduced frames, yielding its results in full resolution coordinates
+
+    :param build: callable taking the reduction factor and returning a tracker taking (frames, initial rect, probe),
+                  e.g. an entry of SCALED_TRACKERS, or lambda factor: benchmark.TRACKERS['lk'] to keep the parameters
+    :param imgs: directory, string array containing image file locations, a FrameSource or an iterable of frames
+    :param car_rect: initial car position [X min, Y min, X max, Y max] at full resolution
+    :param factor: reduction factor, chosen with choose_scale from the initial rectangle if not given
+    :param probe: instrumentation probe handed to the tracker
+    :param kwargs: arguments of choose_scale
+    :return: generator of TrackResult
+    """
+    if factor is None:
+        factor = choose_scale(car_rect, **kwargs)
+    rect = None if car_rect is None else np.int32(np.round(np.float64(car_rect) / factor))
+    results = build(factor)(reduced_frames(imgs, factor), rect, probe)
+    try:
+        for result in results:
+            yield scale_result(result, factor)
+    finally:
+        if hasattr(results, 'close'):
+            results.close()
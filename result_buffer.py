@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+"""
+Result Buffer
+=============
+Columnar buffer of per-frame tracker results, held in preallocated NumPy chunks instead of Python objects, and
+optionally streamed to disk as the frames are tracked.
+
+Columns:
+ frame_idx => index of the frame.
+ rect => X min, Y min, X max, Y max of the car rectangle, NaN without an estimate.
+ center => x, y center of the car rectangle, NaN without an estimate.
+ count => number of points, matches or detections the estimate is based on.
+ For results holding M cars (lk_track_multi), rect, center and count hold M rows per frame, the number of cars being
+ set by the first result.
+ confidence => confidence of the estimate, NaN if the tracker gives none.
+ <stage>_ms => time spent in every stage reported for the frame, NaN for frames the stage did not run on.
+
+On disk, a result directory holds one raw little-endian file per column (<column>.bin) and columns.json describing
+their types, shapes and the number of rows. Columns are appended to chunk by chunk, and load_results memory-maps them
+back. The rectangles can also be streamed to a text file in the VOT groundtruth.txt polygon format, one line per
+frame, which benchmark.load_groundtruth reads back. With several cars, the first car goes to that file and car k to
+the same name with a _<k> suffix, as in a synthetic sequence (see synthetic.py).
+
+    buffer = ResultBuffer('lk_results', vot_path='lk_results.txt')
+    for result in lk_tracker.lk_track(imgs):
+        buffer.append(result)
+    buffer.close()
+    columns = load_results('lk_results')
+"""
+
+import json
+import os
+
+import numpy as np
+
+# Fixed columns: name to (type, shape of a row)
+COLUMNS = [('frame_idx', np.int32, ()), ('rect', np.float32, (4,)), ('center', np.float32, (2,)),
+           ('count', np.int32, ()), ('confidence', np.float32, ())]
+
+# Name of the file describing the columns of a result directory
+INDEX_FILE = 'columns.json'
+
+
+def vot_polygon(rect):
+    """
+    Formats a rectangle as a VOT groundtruth.txt polygon line
+
+    :param rect: rectangle [X min, Y min, X max, Y max], NaN without an estimate
+    :return: line of the 4 corners x1,y1,...,x4,y4 clockwise from the top left
+    """
+    x0, y0, x1, y1 = [float(v) for v in rect]
+    return ','.join('%.2f' % v for v in (x0, y0, x1, y0, x1, y1, x0, y1))
+
+
+class ResultBuffer(object):
+    """
+    Chunked columnar buffer of tracker results, streamed to a result directory and/or a VOT polygon file when paths
+    are given, kept in memory otherwise
+    """
+
+    def __init__(self, path=None, vot_path=None, chunk_size=256, keep_rows=None):
+        """
+        :param path: optional result directory the columns are streamed to, created if needed
+        :param vot_path: optional text file the rectangles are streamed to in the VOT polygon format
+        :param chunk_size: number of rows held before they are written out
+        :param keep_rows: number of rows of the existing result directory and VOT file kept and appended to, e.g. the
+                          frames before a checkpoint a run resumes from, None to start afresh
+        """
+        self.path = path
+        self.chunk_size = max(1, chunk_size)
+        self.rows = 0
+        self.fill = 0
+        self.columns = dict((name, (np.dtype(dtype), shape)) for name, dtype, shape in COLUMNS)
+        self.chunks = []
+        self.targets = None
+
+        if path is not None and keep_rows and os.path.exists(os.path.join(path, INDEX_FILE)):
+            # Cut every column of the existing directory back to the rows kept, and carry on appending to them
+            with open(os.path.join(path, INDEX_FILE)) as f:
+                index = json.load(f)
+            self.rows = min(keep_rows, index['rows'])
+            for name, column in index['columns'].items():
+                dtype, shape = np.dtype(column['dtype']).newbyteorder('='), tuple(column['shape'])
+                self.columns[name] = (dtype, shape)
+                os.truncate(self._file(name), self.rows * dtype.itemsize * int(np.prod(shape)))
+            self.targets = int(np.prod(self.columns['rect'][1])) // 4
+        elif path is not None:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            for name in self.columns:
+                open(self._file(name), 'wb').close()
+        self.chunk = dict((name, self._empty(name)) for name in self.columns)
+
+        # VOT files, one per car, opened as soon as the number of cars is known
+        self.vot_path = vot_path
+        self.vot_keep = keep_rows
+        self.vot = []
+        self.vot_lines = []
+        if vot_path is not None:
+            self._open_vot(1 if self.targets is None else self.targets)
+
+    def __len__(self):
+        return self.rows + self.fill
+
+    def _file(self, name):
+        return os.path.join(self.path, name + '.bin')
+
+    def _empty(self, name):
+        dtype, shape = self.columns[name]
+        return np.full((self.chunk_size,) + shape, np.nan if dtype.kind == 'f' else 0, dtype)
+
+    def _open_vot(self, targets):
+        # Opens the VOT files of the cars not opened yet, keeping the rows asked for of the existing files
+        root, ext = os.path.splitext(self.vot_path)
+        for k in range(len(self.vot), targets):
+            name = self.vot_path if k == 0 else '%s_%d%s' % (root, k, ext)
+            kept = []
+            if self.vot_keep and os.path.exists(name):
+                with open(name) as f:
+                    kept = f.readlines()[:self.vot_keep]
+            f = open(name, 'w')
+            f.writelines(kept)
+            self.vot.append(f)
+            self.vot_lines.append([])
+
+    def _set_targets(self, targets):
+        # Sizes the rect, center and count columns for the number of cars of the first result
+        self.targets = targets
+        if targets > 1:
+            self.columns['rect'] = (self.columns['rect'][0], (targets, 4))
+            self.columns['center'] = (self.columns['center'][0], (targets, 2))
+            self.columns['count'] = (self.columns['count'][0], (targets,))
+            for name in ('rect', 'center', 'count'):
+                self.chunk[name] = self._empty(name)
+        if self.vot_path is not None:
+            self._open_vot(targets)
+
+    def _add_column(self, name):
+        # A stage seen for the first time, earlier rows did not run it
+        self.columns[name] = (np.dtype(np.float32), ())
+        self.chunk[name] = self._empty(name)
+        if self.path is not None:
+            with open(self._file(name), 'wb') as f:
+                np.full(self.rows, np.nan, '<f4').tofile(f)
+        for chunk in self.chunks:
+            chunk[name] = np.full(len(chunk['frame_idx']), np.nan, np.float32)
+
+    def append(self, result, timings=None, confidence=None):
+        """
+        Adds the result of a frame
+
+        :param result: TrackResult, holding a single car or M cars
+        :param timings: optional dict of stage name to seconds spent on the frame
+        :param confidence: optional confidence of the estimate
+        """
+        rects = None if result.rect is None else np.float32(result.rect).reshape(-1, 4)
+        counts = np.ravel(0 if result.count is None else result.count)
+        if self.targets is None:
+            self._set_targets(max(1, len(counts) if rects is None else len(rects)))
+        n = len(counts) if rects is None else len(rects)
+        if n > self.targets:
+            raise ValueError('A result holds %d cars, the buffer was set up for %d' % (n, self.targets))
+
+        row = self.fill
+        self.chunk['frame_idx'][row] = result.frame_idx
+        self.chunk['confidence'][row] = np.nan if confidence is None else confidence
+        if self.targets == 1:
+            self.chunk['count'][row] = counts[0] if len(counts) else 0
+            if rects is not None:
+                self.chunk['rect'][row] = rects[0]
+                self.chunk['center'][row] = np.float32(result.center).reshape(-1, 2)[0]
+        else:
+            # Cars missing from the result keep NaN rectangles and a count of 0
+            self.chunk['count'][row, :len(counts)] = counts
+            if rects is not None:
+                self.chunk['rect'][row, :n] = rects
+                self.chunk['center'][row, :n] = np.float32(result.center).reshape(-1, 2)
+        for stage, seconds in (timings or {}).items():
+            name = stage + '_ms'
+            if name not in self.columns:
+                self._add_column(name)
+            self.chunk[name][row] = seconds * 1000.0
+        for lines, rect in zip(self.vot_lines, self.chunk['rect'][row].reshape(-1, 4)):
+            lines.append(vot_polygon(rect))
+
+        self.fill += 1
+        if self.fill == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes out the rows held in the current chunk
+        """
+        if self.fill == 0:
+            return
+        if self.path is not None:
+            for name, (dtype, shape) in self.columns.items():
+                with open(self._file(name), 'ab') as f:
+                    np.ascontiguousarray(self.chunk[name][:self.fill], dtype.newbyteorder('<')).tofile(f)
+            self._write_index()
+        else:
+            self.chunks.append(dict((name, values[:self.fill].copy()) for name, values in self.chunk.items()))
+        for f, lines in zip(self.vot, self.vot_lines):
+            f.write('\n'.join(lines) + '\n')
+            f.flush()
+            del lines[:]
+
+        self.rows += self.fill
+        self.fill = 0
+        for name in self.columns:
+            self.chunk[name] = self._empty(name)
+
+    def _write_index(self):
+        index = {'rows': self.rows + self.fill,
+                 'columns': dict((name, {'dtype': dtype.newbyteorder('<').str, 'shape': list(shape)})
+                                 for name, (dtype, shape) in self.columns.items())}
+        with open(os.path.join(self.path, INDEX_FILE) + '.tmp', 'w') as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+        os.replace(os.path.join(self.path, INDEX_FILE) + '.tmp', os.path.join(self.path, INDEX_FILE))
+
+    def close(self):
+        """
+        Writes out the remaining rows and closes the files
+        """
+        self.flush()
+        if self.path is not None:
+            self._write_index()
+        for f in self.vot:
+            f.close()
+        self.vot = []
+
+    def arrays(self):
+        """
+        :return: dict of column name to array of every row so far, memory-mapped from the result directory if there
+                 is one
+        """
+        if self.path is not None:
+            self.flush()
+            return load_results(self.path)
+        chunks = self.chunks + [dict((name, values[:self.fill]) for name, values in self.chunk.items())]
+        return dict((name, np.concatenate([chunk[name] for chunk in chunks])) for name in self.columns)
+
+    def centers(self):
+        """
+        :return: N x 2 array of the centers of the frames with an estimate, N x M x 2 with M cars for the frames with
+                 an estimate of any car
+        """
+        center = self.arrays()['center']
+        missing = np.isnan(center).any(axis=-1)
+        if center.ndim == 3:
+            missing = missing.all(axis=1)
+        return center[~missing]
+
+
+def load_results(path):
+    """
+    Memory-maps the columns of a result directory
+
+    :param path: result directory
+    :return: dict of column name to read-only array
+    """
+    with open(os.path.join(path, INDEX_FILE)) as f:
+        index = json.load(f)
+    columns = {}
+    for name, column in index['columns'].items():
+        shape = (index['rows'],) + tuple(column['shape'])
+        if index['rows'] == 0:
+            columns[name] = np.zeros(shape, column['dtype'])
+        else:
+            columns[name] = np.memmap(os.path.join(path, name + '.bin'), column['dtype'], 'r', shape=shape)
+    return columns
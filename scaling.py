@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+"""
+Scaling Benchmark
+=================
+Measures how the trackers scale with the resolution, the length of the sequence, the number of targets and the
+number of points, on synthetic sequences (see synthetic.py).
+
+Every axis is swept on its own, the other axes staying at the base spec. Resolution scales the whole scene (target
+size and speed follow the frame width), frames sets the sequence length, targets adds targets (lk tracks all of them
+with lk_track_multi, the other trackers track the first one among the others) and points sets lk's maxCorners and
+ORB's nfeatures. On the points axis lk detects corners down to 2 pixels apart, or a target would not hold more than
+a few tens of them.
+
+Every run tracks the sequence once without supervision and records:
+ fps => frames per second, decoding included.
+ accuracy => mean overlap with the ground truth of the tracked targets.
+ lost => fraction of frames, per tracked target, without any overlap.
+ traced_peak_mb => high-water mark of the memory allocated through Python and NumPy during the run (tracemalloc).
+ growth_bytes_per_frame => rise of the median traced memory from the second eighth of the run to the seventh,
+                           per frame. Close to zero for a tracker whose state is bounded, positive when something
+                           grows with every frame.
+ rss_peak_mb => high-water mark of the worker's resident memory, OpenCV's allocations included.
+
+The fps pass runs without tracemalloc, which slows allocations down, and a second pass measures the memory. Every run
+gets a fresh worker process, so that the resident high-water mark is its own.
+
+    python scaling.py --trackers lk orb --output scaling.json
+    python scaling.py --baseline scaling.json
+"""
+
+import argparse
+import json
+import resource
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+import cascade_tracker
+import dense_optical_flow
+import instrumentation
+import lk_tracker
+import orb_tracker
+import synthetic
+import utilities
+
+# Values of every axis swept by default
+AXES = {
+    'resolution': [320, 640, 1280],
+    'frames': [50, 200, 800],
+    'targets': [1, 4, 16],
+    'points': [20, 100, 400],
+}
+
+# Base spec the axes are swept around
+BASE_SPEC = dict(synthetic.DEFAULT_SPEC)
+
+# Growth of the traced memory per frame above which a run is reported as growing without bound
+MAX_GROWTH = 1024
+
+# Least number of frames of a run whose growth is measured, shorter runs are too noisy
+MIN_GROWTH_FRAMES = 200
+
+# Tracker builders, called with the number of points (None for the default) and returning a tracker called with the
+# frames, the M x 4 rectangles of the targets and a probe. Trackers that only follow one target track the first one
+TRACKERS = {
+    'lk': lambda points: lambda frames, rects, probe: lk_tracker.lk_track_multi(
+        frames, rects, feature_params=None if points is None else dict(lk_tracker.FEATURE_PARAMS, maxCorners=points,
+                                                                       qualityLevel=0.01, minDistance=2, blockSize=3),
+        max_points=max(500, 2 * len(rects) * (points or 0)), probe=probe),
+    'orb': lambda points: lambda frames, rects, probe: orb_tracker.orb_track(
+        frames, rects[0], None if points is None else dict(orb_tracker.FEATURE_PARAMS, nfeatures=points), probe),
+    'cascade': lambda points: lambda frames, rects, probe: cascade_tracker.cascade_track(
+        frames, './resources/cars3.xml', True, rects[0], probe=probe),
+    'dense': lambda points: lambda frames, rects, probe: dense_optical_flow.dense_track(frames, rects[0], probe=probe),
+}
+
+# Trackers that the points axis applies to
+POINT_TRACKERS = ('lk', 'orb')
+
+
+def axis_spec(axis, value):
+    """
+    Builds the spec of a point of an axis
+
+    :param axis: name of the axis, one of AXES
+    :param value: value on the axis
+    :return: synthetic sequence spec
+    """
+    spec = dict(BASE_SPEC)
+    if axis == 'resolution':
+        # Scale the whole scene, so that the targets cover the same part of the frame
+        factor = value / float(BASE_SPEC['width'])
+        spec.update(width=value, height=int(round(BASE_SPEC['height'] * factor)),
+                    target_width=int(round(BASE_SPEC['target_width'] * factor)),
+                    target_height=int(round(BASE_SPEC['target_height'] * factor)),
+                    speed=BASE_SPEC['speed'] * factor)
+    elif axis in ('frames', 'targets'):
+        spec[axis] = value
+    elif axis != 'points':
+        raise ValueError('Unknown axis ' + str(axis))
+    return spec
+
+
+def _track(tracker, imgs, targets, trace=False):
+    # Tracks a sequence once, returning the per-frame overlaps, the wall time and the traced memory after every frame.
+    # Both are preallocated, so that the measurement itself does not grow with every frame
+    overlaps = np.zeros(targets.shape[:2])
+    samples = np.zeros(len(imgs), np.int64)
+    start = time.perf_counter()
+    results = tracker(utilities.FrameSource(imgs), np.int32(targets[0]), instrumentation.NULL_PROBE)
+    for result in results:
+        if result.rect is not None:
+            rects = np.float64(result.rect).reshape(-1, 4)[:targets.shape[1]]
+            overlaps[result.frame_idx, :len(rects)] = utilities.rect_overlap(rects, targets[result.frame_idx,
+                                                                                             :len(rects)])
+        if trace:
+            samples[result.frame_idx] = tracemalloc.get_traced_memory()[0]
+    wall = time.perf_counter() - start
+    results.close()
+    return overlaps, wall, samples
+
+
+def run(config):
+    """
+    Runs a single configuration in a worker process
+
+    :param config: (tracker name, axis, value, sequence directory)
+    :return: dict of the configuration and its measurements
+    """
+    name, axis, value, path = config
+    cv2.setNumThreads(1)
+    tracker = TRACKERS[name](value if axis == 'points' else None)
+    imgs = utilities.get_jpeg(path)
+    targets = synthetic.load_targets(path)
+    if name != 'lk':
+        targets = targets[:, :1]
+
+    # Timed pass
+    overlaps, wall, _ = _track(tracker, imgs, targets)
+
+    # Memory pass
+    tracemalloc.start()
+    _, _, samples = _track(tracker, imgs, targets, trace=True)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    n_frames = len(imgs)
+
+    # Medians over two windows, as single samples swing with the frames held in the read ahead buffer and the first
+    # frames with the tracker's warm up
+    eighth = len(samples) // 8
+    growth = None
+    if len(samples) >= MIN_GROWTH_FRAMES:
+        early = np.median(samples[eighth:2 * eighth])
+        late = np.median(samples[6 * eighth:7 * eighth])
+        growth = float(late - early) / (5 * eighth)
+
+    return {'tracker': name, 'axis': axis, 'value': value, 'frames': n_frames,
+            'fps': n_frames / wall if wall > 0 else None, 'accuracy': float(np.mean(overlaps)),
+            'lost': float(np.mean(overlaps == 0)), 'traced_peak_mb': peak / 1e6, 'growth_bytes_per_frame': growth,
+            # ru_maxrss is in kilobytes on Linux
+            'rss_peak_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3}
+
+
+def scaling(trackers=('lk', 'orb', 'cascade', 'dense'), axes=AXES, root='./synthetic', workers=1):
+    """
+    Sweeps every axis for every tracker
+
+    :param trackers: names of the trackers in TRACKERS to run
+    :param axes: dict of axis name to list of values
+    :param root: directory the synthetic sequences are kept in
+    :param workers: number of runs at once, 1 keeps the fps figures free of interference
+    :return: dict of every run, ready to be written as JSON
+    """
+    configs = []
+    for axis in sorted(axes):
+        for value in axes[axis]:
+            # Generate the sequences up front, so that no two workers write the same one
+            path = synthetic.open_sequence(axis_spec(axis, value), root)
+            for name in trackers:
+                if axis == 'points' and name not in POINT_TRACKERS:
+                    continue
+                configs.append((name, axis, value, path))
+
+    with ProcessPoolExecutor(max_workers=workers, max_tasks_per_child=1) as pool:
+        runs = list(pool.map(run, configs))
+    return {'base_spec': BASE_SPEC, 'runs': runs}
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Compares scaling results against a baseline results file, and flags runs whose memory grows with every frame
+
+    :param results: dict returned by scaling
+    :param baseline: dict returned by scaling for a previous version
+    :param tolerance: relative drop in fps or accuracy, or rise in traced peak memory, that counts as a regression
+    :return: array of regression descriptions, empty if there are none
+    """
+    previous = dict(((r['tracker'], r['axis'], r['value']), r) for r in (baseline or {}).get('runs', []))
+    regressions = []
+    for r in results['runs']:
+        label = '%s %s=%s' % (r['tracker'], r['axis'], r['value'])
+        if r['growth_bytes_per_frame'] is not None and r['growth_bytes_per_frame'] > MAX_GROWTH:
+            regressions.append('%s memory grows by %.0f bytes per frame' % (label, r['growth_bytes_per_frame']))
+        old = previous.get((r['tracker'], r['axis'], r['value']))
+        if old is None:
+            continue
+        for key in ('fps', 'accuracy'):
+            if r[key] is not None and old[key] and r[key] < old[key] * (1 - tolerance):
+                regressions.append('%s %s dropped from %.3f to %.3f' % (label, key, old[key], r[key]))
+        if old['traced_peak_mb'] and r['traced_peak_mb'] > old['traced_peak_mb'] * (1 + tolerance):
+            regressions.append('%s traced peak rose from %.1f MB to %.1f MB' % (label, old['traced_peak_mb'],
+                                                                                r['traced_peak_mb']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure how the trackers scale on synthetic sequences')
+    parser.add_argument('--trackers', nargs='+', default=['lk', 'orb', 'cascade', 'dense'], choices=sorted(TRACKERS))
+    parser.add_argument('--axes', nargs='+', default=sorted(AXES), choices=sorted(AXES))
+    parser.add_argument('--root', default='./synthetic', help='directory the synthetic sequences are kept in')
+    parser.add_argument('--workers', type=int, default=1, help='number of runs at once')
+    parser.add_argument('--output', default='scaling.json', help='JSON file the results are written to')
+    parser.add_argument('--baseline', help='previous results file to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative change counted as a regression')
+    args = parser.parse_args()
+
+    results = scaling(args.trackers, dict((axis, AXES[axis]) for axis in args.axes), args.root, args.workers)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    for r in results['runs']:
+        growth = r['growth_bytes_per_frame']
+        print('%-8s %-10s %5s  fps %7.1f  accuracy %.3f  lost %.2f  traced %6.1f MB  growth %7s B/frame  '
+              'rss %6.1f MB' % (r['tracker'], r['axis'], r['value'], r['fps'], r['accuracy'], r['lost'],
+                                r['traced_peak_mb'], '-' if growth is None else '%.0f' % growth, r['rss_peak_mb']))
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print('REGRESSION: ' + regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+"""
+Tracking Service
+================
+Runs many tracking jobs at once, each a tracker of benchmark.TRACKERS over a sequence or a live stream, scheduled on
+a pool of worker threads or processes sized to the cores.
+
+Every job is a dict:
+ source => directory of a sequence, or for a live job a directory to tail, tcp://host:port or a pipe (see live.py).
+ tracker => name of the tracker in benchmark.TRACKERS, lk by default.
+ rect => initial car rectangle [X min, Y min, X max, Y max], defaults to the first groundtruth.txt rectangle.
+ live => flag reading a directory source with a LiveSource instead of as a complete sequence.
+ policy, queue_size => LiveSource arguments of a live job.
+ replay, fps => sequence replayed into the live source by the service, for testing streams locally.
+ results => optional result directory the per-frame results are streamed to (see result_buffer.py).
+ checkpoint, checkpoint_interval => directory the tracker state is checkpointed to every checkpoint_interval frames
+                                   (100 by default), see checkpoint.py. A job finding a checkpoint of its tracker
+                                   there resumes from it, for the trackers in RESUMABLE. The checkpoints of a job are
+                                   removed once it finishes, so that only a job that crashed or was stopped resumes.
+ name => optional name of the job in the reports.
+
+OpenCV parallelises many calls internally over every core, so several jobs each doing so would oversubscribe the
+machine. The service limits OpenCV to cv_threads threads, cores divided by workers by default, in every worker
+process (or once for the thread pool, where the setting is global), and decodes every sequence on a single thread.
+
+Every job reports its status (queued, running, done or failed), frames tracked, fps, per-frame latency percentiles,
+time spent queued and, when the sequence has a groundtruth, its mean overlap. The service reports the queue and the
+overall throughput:
+
+    service = TrackingService(workers=4)
+    for sequence in sequences:
+        service.submit({'source': sequence, 'tracker': 'lk'})
+    service.wait()
+    print(service.metrics())
+
+or from the command line, for every combination of sequences and trackers or a JSON file of jobs:
+
+    python service.py --sequences ./resources/car/ ./resources/car/ --trackers lk orb --workers 4 --mode process
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent import futures
+
+import cv2
+import numpy as np
+
+import benchmark
+import cascade_tracker
+import checkpoint
+import instrumentation
+import live
+import lk_tracker
+import orb_tracker
+import result_buffer
+import utilities
+
+# Number of frames between two progress reports of a job
+PROGRESS_EVERY = 10
+
+# Trackers of benchmark.TRACKERS that can be checkpointed and resumed, each called with the frames to track, the
+# initial rectangle, a probe, the state to resume from and the checkpointer. Every tracker saves its checkpoints under
+# its own name, so that lk and lk_adaptive jobs sharing a checkpoint directory never resume from each other's states
+RESUMABLE = {
+    'lk': lambda frames, rect, probe, state, checkpointer: lk_tracker.lk_track(
+        frames, car_rect=rect, probe=probe, state=state, checkpointer=checkpointer, checkpoint_name='lk'),
+    'lk_adaptive': lambda frames, rect, probe, state, checkpointer: lk_tracker.lk_track(
+        frames, car_rect=rect, min_car_points=8, probe=probe, state=state, checkpointer=checkpointer,
+        checkpoint_name='lk_adaptive'),
+    'orb': lambda frames, rect, probe, state, checkpointer: orb_tracker.orb_track(
+        frames, car_rect=rect, probe=probe, state=state, checkpointer=checkpointer, checkpoint_name='orb'),
+    'cascade': lambda frames, rect, probe, state, checkpointer: cascade_tracker.cascade_track(
+        frames, './resources/cars3.xml', probe=probe, state=state, checkpointer=checkpointer,
+        checkpoint_name='cascade'),
+    'cascade_roi': lambda frames, rect, probe, state, checkpointer: cascade_tracker.cascade_track(
+        frames, './resources/cars3.xml', True, rect, probe=probe, state=state, checkpointer=checkpointer,
+        checkpoint_name='cascade_roi'),
+}
+
+
+def init_worker(cv_threads):
+    """
+    Limits the number of threads OpenCV uses in a worker
+
+    :param cv_threads: number of threads OpenCV may use
+    """
+    cv2.setNumThreads(cv_threads)
+
+
+def open_job(job):
+    """
+    Opens the frames, initial rectangle and ground truth of a job
+
+    :param job: job dict
+    :return: (frames, initial rect, N x 4 ground truth rectangles or None)
+    """
+    source = job['source']
+    gt = None
+    if not (source.startswith('tcp://') or source == '-' or os.path.exists(source)):
+        raise IOError('No sequence or stream at ' + source)
+    if job.get('live') or not os.path.isdir(source):
+        frames = live.LiveSource(source, job.get('policy', 'block'), job.get('queue_size', 4))
+    else:
+        # A single decoding thread per job, the pool already keeps the cores busy
+        frames = utilities.FrameSource(utilities.get_jpeg(source), workers=1)
+        gt_path = os.path.join(source, 'groundtruth.txt')
+        if os.path.exists(gt_path):
+            gt = benchmark.load_groundtruth(gt_path)
+
+    rect = job.get('rect')
+    if rect is None and gt is not None:
+        rect = np.int32(np.round(gt[0]))
+    return frames, rect, gt
+
+
+def run_job(job_id, job, events=None):
+    """
+    Runs a single job in a worker, reporting its start and progress to the service
+
+    :param job_id: id of the job
+    :param job: job dict
+    :param events: optional queue receiving (event, job id, time, frames) tuples
+    :return: dict of the job's metrics
+    """
+    started = time.time()
+    if events is not None:
+        events.put(('start', job_id, started, 0))
+
+    name = job.get('tracker', 'lk')
+    frames, rect, gt = open_job(job)
+
+    # Resume from the latest checkpoint of the job, if there is one
+    checkpointer = state = None
+    if job.get('checkpoint'):
+        checkpointer = checkpoint.Checkpointer(job['checkpoint'], job.get('checkpoint_interval', 100))
+        # Only the job's own tracker's checkpoints, any other tracker's in the directory are left alone
+        state = checkpointer.latest(name)
+        frames = checkpoint.resume_frames(frames, state)
+        tracker = lambda frames, rect, probe: RESUMABLE[name](frames, rect, probe, state, checkpointer)
+    else:
+        tracker = benchmark.TRACKERS[name]
+    resumed_from = 0 if state is None else int(state['frame_idx'])
+
+    buffer = None
+    if job.get('results'):
+        buffer = result_buffer.ResultBuffer(job['results'], keep_rows=resumed_from or None)
+
+    # Running overlap totals and a bounded latency sample, as live jobs can run indefinitely
+    overlap_sum = 0.0
+    n_overlaps = 0
+    n_failures = 0
+    latencies = instrumentation.LatencySample()
+    n_frames = 0
+    start = last = time.perf_counter()
+    try:
+        for result in tracker(frames, rect, instrumentation.NULL_PROBE):
+            now = time.perf_counter()
+            latencies.add(now - last)
+            last = now
+            n_frames += 1
+
+            if gt is not None and result.frame_idx < len(gt):
+                overlap = 0.0
+                if result.rect is not None:
+                    rects = np.float64(result.rect).reshape(-1, 4)[:1]
+                    overlap = float(utilities.rect_overlap(rects, gt[result.frame_idx])[0])
+                overlap_sum += overlap
+                n_overlaps += 1
+                n_failures += overlap == 0
+            if buffer is not None:
+                buffer.append(result)
+            if isinstance(frames, live.LiveSource):
+                # Frames are counted from the start of the stream, not from the frame resumed at
+                frames.latency(n_frames - 1)
+            if events is not None and n_frames % PROGRESS_EVERY == 0:
+                events.put(('progress', job_id, time.time(), n_frames))
+    finally:
+        if buffer is not None:
+            buffer.close()
+    wall = time.perf_counter() - start
+
+    # The job is done, its checkpoints would only make a resubmission of it track the last frames again
+    if checkpointer is not None:
+        checkpointer.clear(name)
+
+    metrics = {'started': started, 'frames': n_frames, 'wall': wall, 'fps': n_frames / wall if wall > 0 else None,
+               'latency': latencies.summary()}
+    if n_overlaps:
+        metrics['overlap'] = overlap_sum / n_overlaps
+        metrics['failures'] = n_failures
+    if isinstance(frames, live.LiveSource):
+        metrics['live'] = frames.stats()
+    if checkpointer is not None:
+        metrics.update(resumed_from=resumed_from, checkpoints=checkpointer.stats())
+    return metrics
+
+
+class TrackingService(object):
+    """
+    Schedules tracking jobs on a pool of worker threads or processes and keeps their status and metrics
+    """
+
+    def __init__(self, workers=None, mode='thread', cv_threads=None):
+        """
+        :param workers: number of jobs run at once, defaults to the number of cores
+        :param mode: 'thread' to run jobs on threads of this process, 'process' to run them in worker processes
+        :param cv_threads: number of threads OpenCV may use in every worker, defaults to cores / workers
+        """
+        if mode not in ('thread', 'process'):
+            raise ValueError('Unknown mode ' + str(mode))
+        cores = os.cpu_count() or 1
+        self.workers = workers or cores
+        self.mode = mode
+        self.cv_threads = cv_threads or max(1, cores // self.workers)
+        self.jobs = {}
+        self.futures = {}
+        self.lock = threading.Lock()
+        self.created = time.time()
+        self.next_id = 0
+
+        if mode == 'process':
+            # Worker processes report their progress through a queue owned by a manager process
+            self.manager = multiprocessing.Manager()
+            self.events = self.manager.Queue()
+            self.pool = futures.ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker,
+                                                    initargs=(self.cv_threads,))
+        else:
+            # The OpenCV thread count is global to the process, shared by every worker thread
+            self.manager = None
+            self.events = queue.Queue()
+            init_worker(self.cv_threads)
+            self.pool = futures.ThreadPoolExecutor(max_workers=self.workers)
+
+        self.collector = threading.Thread(target=self._collect)
+        self.collector.daemon = True
+        self.collector.start()
+
+    def _collect(self):
+        # Applies the start and progress events of the jobs to their status
+        while True:
+            event = self.events.get()
+            if event is None:
+                return
+            kind, job_id, at, n_frames = event
+            with self.lock:
+                status = self.jobs[job_id]
+                if status['status'] != 'queued' and status['status'] != 'running':
+                    # The job already finished, its final metrics are in
+                    continue
+                if kind == 'start':
+                    status['status'] = 'running'
+                    status['queue_wait'] = at - status['submitted']
+                else:
+                    status['frames'] = n_frames
+                    status['fps'] = n_frames / (at - status['submitted'] - status['queue_wait'])
+
+    def _done(self, job_id, future):
+        with self.lock:
+            status = self.jobs[job_id]
+            try:
+                metrics = future.result()
+            except Exception as e:
+                status['status'] = 'failed'
+                status['error'] = '%s: %s' % (type(e).__name__, e)
+            else:
+                status['status'] = 'done'
+                status['queue_wait'] = metrics.pop('started') - status['submitted']
+                status.update(metrics)
+            status['finished'] = time.time()
+
+    def submit(self, job):
+        """
+        Queues a job
+
+        :param job: job dict, see the module documentation
+        :return: id of the job
+        """
+        if job.get('tracker', 'lk') not in benchmark.TRACKERS:
+            raise ValueError('Unknown tracker ' + str(job.get('tracker')))
+        if job.get('checkpoint') and job.get('tracker', 'lk') not in RESUMABLE:
+            raise ValueError('Tracker %s cannot be checkpointed' % job.get('tracker'))
+        if job.get('replay') and not job['source'].startswith('tcp://') and not os.path.exists(job['source']):
+            # The directory has to exist before the live source starts, or it would be taken for a pipe
+            os.makedirs(job['source'])
+
+        with self.lock:
+            job_id = self.next_id
+            self.next_id += 1
+            self.jobs[job_id] = {'id': job_id, 'name': job.get('name', '%s:%s' % (job.get('tracker', 'lk'),
+                                                                                 job['source'])),
+                                 'tracker': job.get('tracker', 'lk'), 'source': job['source'], 'status': 'queued',
+                                 'submitted': time.time(), 'queue_wait': None, 'frames': 0, 'fps': None}
+        future = self.pool.submit(run_job, job_id, job, self.events)
+        self.futures[job_id] = future
+        future.add_done_callback(lambda f: self._done(job_id, f))
+
+        if job.get('replay'):
+            producer = threading.Thread(target=live.replay, args=(job['replay'], job['source'], job.get('fps', 30.0)))
+            producer.daemon = True
+            producer.start()
+        return job_id
+
+    def status(self, job_id=None):
+        """
+        :param job_id: id of a job, None for every job
+        :return: status dict of the job, or array of the status dicts of every job in submission order
+        """
+        with self.lock:
+            if job_id is not None:
+                return dict(self.jobs[job_id])
+            return [dict(self.jobs[i]) for i in sorted(self.jobs)]
+
+    def metrics(self):
+        """
+        :return: dict of the number of jobs in every state, frames tracked, overall throughput and time spent queued
+        """
+        jobs = self.status()
+        metrics = dict((state, sum(1 for job in jobs if job['status'] == state))
+                       for state in ('queued', 'running', 'done', 'failed'))
+        wall = time.time() - self.created
+        frames = sum(job['frames'] for job in jobs)
+        metrics.update(workers=self.workers, mode=self.mode, cv_threads=self.cv_threads, frames=frames, wall=wall,
+                       fps=frames / wall if wall > 0 else None)
+        waits = [job['queue_wait'] for job in jobs if job['queue_wait'] is not None]
+        if waits:
+            metrics.update(queue_wait_mean=float(np.mean(waits)), queue_wait_max=float(np.max(waits)))
+        return metrics
+
+    def wait(self, timeout=None, interval=None, report=None):
+        """
+        Waits for every submitted job to finish
+
+        :param timeout: time after which to stop waiting, None to wait for ever
+        :param interval: time between two calls of report
+        :param report: optional callable called with the service every interval while waiting
+        :return: True if every job finished
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            step = interval
+            if deadline is not None:
+                step = max(0, deadline - time.time()) if step is None else min(step, max(0, deadline - time.time()))
+            _, pending = futures.wait(list(self.futures.values()), timeout=step)
+            if not pending:
+                return True
+            if deadline is not None and time.time() >= deadline:
+                return False
+            if report is not None:
+                report(self)
+
+    def shutdown(self):
+        """
+        Waits for the running jobs, then stops the pool
+        """
+        self.pool.shutdown(wait=True)
+        self.events.put(None)
+        self.collector.join()
+        if self.manager is not None:
+            self.manager.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Track many sequences or streams at once on a pool of workers')
+    parser.add_argument('--jobs', help='JSON file holding an array of job dicts, see service.py')
+    parser.add_argument('--sequences', nargs='+', default=[], help='sequences, every one run with every tracker')
+    parser.add_argument('--trackers', nargs='+', default=['lk'], choices=sorted(benchmark.TRACKERS))
+    parser.add_argument('--workers', type=int, help='number of jobs run at once, defaults to the number of cores')
+    parser.add_argument('--mode', default='thread', choices=['thread', 'process'])
+    parser.add_argument('--cv-threads', type=int, help='threads OpenCV may use per worker, defaults to cores / workers')
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds between two status lines')
+    parser.add_argument('--output', default='service.json', help='JSON file the job metrics are written to')
+    args = parser.parse_args()
+
+    jobs = [{'source': sequence, 'tracker': tracker}
+            for sequence, tracker in itertools.product(args.sequences, args.trackers)]
+    if args.jobs:
+        with open(args.jobs) as f:
+            jobs += json.load(f)
+    if not jobs:
+        parser.error('no jobs, give --sequences or --jobs')
+
+    def report(service):
+        m = service.metrics()
+        print('queued %d  running %d  done %d  failed %d  frames %d  fps %.1f' % (
+            m['queued'], m['running'], m['done'], m['failed'], m['frames'], m['fps'] or 0))
+
+    service = TrackingService(args.workers, args.mode, args.cv_threads)
+    try:
+        for job in jobs:
+            service.submit(job)
+        service.wait(interval=args.interval, report=report)
+    finally:
+        service.shutdown()
+
+    results = {'metrics': service.metrics(), 'jobs': service.status()}
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    for job in results['jobs']:
+        if job['status'] == 'failed':
+            print('%-40s failed: %s' % (job['name'], job['error']))
+        else:
+            print('%-40s frames %4d  fps %7.1f  queued %.2fs  overlap %s' % (
+                job['name'], job['frames'], job['fps'] or 0, job['queue_wait'] or 0,
+                '%.3f' % job['overlap'] if 'overlap' in job else '-'))
+    m = results['metrics']
+    print('%d jobs on %d %s workers (OpenCV threads %d): %d frames in %.1fs, %.1f fps' % (
+        len(results['jobs']), m['workers'], m['mode'], m['cv_threads'], m['frames'], m['wall'], m['fps']))
+    return 1 if m['failed'] else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
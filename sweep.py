@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+"""
+Parameter Sweep
+===============
+Runs every configuration of a parameter grid over a sequence on a pool of worker processes and reports speed and
+accuracy per configuration, plus the Pareto front of accuracy against fps.
+
+The sequence is decoded once to grayscale into a frame store (see frame_store.py), which every worker maps read-only,
+so workers share the decoded frames through the page cache instead of each re-decoding the JPEGs. The store is kept
+next to the sequence and reused by later sweeps until the images change.
+
+Grids are given per tracker as a dict of parameter name to list of values, e.g.
+ {"lk": {"detect_interval": [1, 5, 10], "maxCorners": [20, 50]}, "orb": {"nfeatures": [40, 100]}}
+lk parameters are split between detect_interval, FEATURE_PARAMS and LK_PARAMS by name, orb parameters override the
+ORB detector's FEATURE_PARAMS and dense parameters override FARNEBACK_PARAMS. The dense flow is only timed, it has no
+accuracy.
+dense_roi tracks the car with dense_track: roi_expand, scale and estimator go to dense_track, any other parameter
+overrides ROI_FARNEBACK_PARAMS.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+import benchmark
+import dense_optical_flow
+import frame_store
+import instrumentation
+import lk_tracker
+import orb_tracker
+
+# Grid used when no grid file is given
+DEFAULT_GRID = {
+    'lk': {'detect_interval': [1, 5, 10], 'maxCorners': [20, 50], 'winSize': [9, 15, 21]},
+    'orb': {'nfeatures': [40, 100, 200]},
+    'dense': {'winsize': [15, 50], 'levels': [1, 3]},
+    'dense_roi': {'winsize': [9, 15], 'scale': [0.5, 1.0]},
+}
+
+# Frame stack mapped by every worker process, set by init_worker
+_frames = None
+
+
+def expand_grid(grid):
+    """
+    Expands a grid into every combination of its values
+
+    :param grid: dict of tracker name to dict of parameter name to list of values
+    :return: array of (tracker name, parameter dict) configurations
+    """
+    configs = []
+    for name in sorted(grid):
+        keys = sorted(grid[name])
+        for values in itertools.product(*[grid[name][key] for key in keys]):
+            configs.append((name, dict(zip(keys, values))))
+    return configs
+
+
+def build_tracker(name, params):
+    """
+    Builds a tracker callable taking (frames, initial rect, probe) from a configuration
+
+    :param name: tracker name, one of lk, orb, dense or dense_roi
+    :param params: parameter dict of the configuration
+    :return: callable returning a generator of results
+    """
+    if name == 'lk':
+        detect_interval = params.get('detect_interval', 5)
+        feature_params = dict(lk_tracker.FEATURE_PARAMS)
+        lk_params = dict(lk_tracker.LK_PARAMS)
+        for key, value in params.items():
+            if key in feature_params:
+                feature_params[key] = value
+            elif key == 'winSize':
+                # A single window size applies to both dimensions
+                lk_params[key] = (value, value) if np.isscalar(value) else tuple(value)
+            elif key in lk_params:
+                lk_params[key] = value
+        return lambda frames, rect, probe: lk_tracker.lk_track(frames, detect_interval, rect, feature_params, lk_params,
+                                                              probe=probe)
+    if name == 'orb':
+        feature_params = dict(orb_tracker.FEATURE_PARAMS, **params)
+        return lambda frames, rect, probe: orb_tracker.orb_track(frames, rect, feature_params, probe)
+    if name == 'dense':
+        farneback_params = dict(dense_optical_flow.FARNEBACK_PARAMS, **params)
+        return lambda frames, rect, probe: dense_optical_flow.flow_fields(frames, farneback_params, probe)
+    if name == 'dense_roi':
+        track_params = dict((k, v) for k, v in params.items() if k in ('roi_expand', 'scale', 'estimator'))
+        farneback_params = dict(dense_optical_flow.ROI_FARNEBACK_PARAMS)
+        farneback_params.update((k, v) for k, v in params.items() if k not in track_params)
+        return lambda frames, rect, probe: dense_optical_flow.dense_track(frames, rect,
+                                                                          farneback_params=farneback_params,
+                                                                          probe=probe, **track_params)
+    raise ValueError('Unknown tracker ' + name)
+
+
+def init_worker(path):
+    """
+    Maps the shared grayscale frame store read-only in a worker process. OpenCV is limited to one thread per worker so
+    that the pool does not oversubscribe the cores
+
+    :param path: directory of the frame store
+    """
+    global _frames
+    cv2.setNumThreads(1)
+    _frames = frame_store.FrameStore(path, grayscale=True).frames
+
+
+def run_config(config, gt):
+    """
+    Runs a single configuration in a worker process
+
+    :param config: (tracker name, parameter dict)
+    :param gt: N x 4 array of ground truth rectangles
+    :return: dict of configuration, speed and accuracy
+    """
+    name, params = config
+    tracker = build_tracker(name, params)
+    result = {'tracker': name, 'params': params}
+
+    if name == 'dense':
+        # No accuracy for the dense flow, only time it over the whole sequence
+        start = time.perf_counter()
+        n_frames = sum(1 for _ in tracker(_frames, None, instrumentation.NULL_PROBE))
+        wall = time.perf_counter() - start
+        result.update(accuracy=None, failures=None, fps=n_frames / wall if wall > 0 else None)
+        return result
+
+    run = benchmark.run_supervised(tracker, _frames, gt)
+    summary = benchmark.score(run, {})
+    result.update(accuracy=summary['accuracy'], failures=summary['failures'], fps=summary['fps'],
+                  latency=summary['latency']['frame'])
+    return result
+
+
+def pareto_front(results):
+    """
+    Finds the configurations that no other configuration beats on both accuracy and fps
+
+    :param results: array of dicts returned by run_config
+    :return: array of the non-dominated results, fastest first
+    """
+    scored = [r for r in results if r['accuracy'] is not None and r['fps'] is not None]
+    front = []
+    for r in scored:
+        dominated = any(o['accuracy'] >= r['accuracy'] and o['fps'] >= r['fps'] and
+                        (o['accuracy'] > r['accuracy'] or o['fps'] > r['fps']) for o in scored)
+        if not dominated:
+            front.append(r)
+    return sorted(front, key=lambda r: -r['fps'])
+
+
+def sweep(sequence, grid=DEFAULT_GRID, workers=None, store=None):
+    """
+    Runs every configuration of a grid over a sequence on a process pool
+
+    :param sequence: directory of the sequence, containing the images and groundtruth.txt
+    :param grid: dict of tracker name to dict of parameter name to list of values
+    :param workers: number of worker processes, defaults to the number of cores
+    :param store: directory of the sequence's frame store, defaults to the sequence directory + .frames
+    :return: dict of every result and the Pareto front
+    """
+    gt = benchmark.load_groundtruth(os.path.join(sequence, 'groundtruth.txt'))
+    configs = expand_grid(grid)
+
+    # Decode the sequence a single time for all workers, and for later sweeps as long as the images do not change
+    path = frame_store.open_store(sequence, store, grayscale=True).path
+
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=init_worker,
+                             initargs=(path,)) as pool:
+        results = list(pool.map(run_config, configs, itertools.repeat(gt)))
+
+    return {'sequence': sequence, 'results': results, 'pareto_front': pareto_front(results)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sweep tracker parameters over a VOT sequence')
+    parser.add_argument('--sequence', default='./resources/car/', help='directory of the sequence')
+    parser.add_argument('--grid', help='JSON file holding the parameter grid, defaults to DEFAULT_GRID')
+    parser.add_argument('--workers', type=int, help='number of worker processes, defaults to the number of cores')
+    parser.add_argument('--output', default='sweep.json', help='JSON file the results are written to')
+    parser.add_argument('--store', help='directory of the frame store, defaults to the sequence directory + .frames')
+    args = parser.parse_args()
+
+    grid = DEFAULT_GRID
+    if args.grid:
+        with open(args.grid) as f:
+            grid = json.load(f)
+
+    results = sweep(args.sequence, grid, args.workers, args.store)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    print('Pareto front (accuracy against fps):')
+    for r in results['pareto_front']:
+        print('%-6s fps %7.1f  accuracy %.3f  failures %d  %s' % (r['tracker'], r['fps'], r['accuracy'],
+                                                                  r['failures'], json.dumps(r['params'])))
+
+
+if __name__ == '__main__':
+    main()
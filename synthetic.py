@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+"""
+Synthetic Sequences
+===================
+Generates deterministic synthetic image sequences with exact ground truth, to measure the trackers at resolutions,
+lengths and target counts that resources/car does not cover.
+
+Every target is a rectangle of random blocky texture, rich in corners, moving at a constant speed over a smooth
+textured background and bouncing off the frame borders. A vertical occluding bar can cover the middle of the frame,
+and Gaussian noise can be added to every frame. The same spec and seed always give the same frames.
+
+A sequence is a directory laid out like a VOT sequence:
+ 00000001.jpg ... => the frames.
+ groundtruth.txt => rectangle of the first target as VOT polygons, readable by benchmark.load_groundtruth.
+ groundtruth_<k>.txt => rectangles of every other target.
+ spec.json => the spec the sequence was generated from.
+
+Generate a sequence from the command line:
+
+    python synthetic.py --output ./synthetic/demo --width 1280 --height 960 --frames 300 --targets 4 --noise 5
+
+or from python, reusing the sequence generated by an earlier call with the same spec:
+
+    path = synthetic.open_sequence(dict(synthetic.DEFAULT_SPEC, targets=4))
+    targets = synthetic.load_targets(path)
+"""
+
+import argparse
+import hashlib
+import json
+import os
+
+import cv2
+import numpy as np
+
+import benchmark
+import result_buffer
+import utilities
+
+# Spec of a sequence, every key can be overridden
+#  frames => number of frames.
+#  width, height => frame size in pixels.
+#  targets => number of moving targets.
+#  target_width, target_height => target size in pixels.
+#  speed => target speed in pixels per frame.
+#  occlusion => width of the occluding bar in the middle of the frame, relative to the target width, 0 for none.
+#  noise => standard deviation of the Gaussian noise added to every frame, 0 for none.
+#  seed => random seed of the textures, start positions and directions.
+DEFAULT_SPEC = dict(frames=100, width=640, height=480, targets=1, target_width=48, target_height=36, speed=3.0,
+                    occlusion=0.0, noise=0.0, seed=0)
+
+# JPEG quality of the written frames
+JPEG_QUALITY = 90
+
+
+def _texture(rng, height, width, block, smooth=0):
+    # Random texture of block x block pixel cells, smoothed with a Gaussian blur if asked for
+    cells = rng.randint(0, 256, (max(1, height // block + 1), max(1, width // block + 1), 3)).astype(np.uint8)
+    texture = cv2.resize(cells, (cells.shape[1] * block, cells.shape[0] * block), interpolation=cv2.INTER_NEAREST)
+    texture = texture[:height, :width]
+    if smooth > 0:
+        texture = cv2.GaussianBlur(texture, (0, 0), smooth)
+    return np.ascontiguousarray(texture)
+
+
+def render(spec=None):
+    """
+    Generator rendering the frames of a synthetic sequence
+
+    :param spec: dict overriding DEFAULT_SPEC
+    :return: generator of (frame, M x 4 array of target rectangles [X min, Y min, X max, Y max])
+    """
+    spec = dict(DEFAULT_SPEC, **(spec or {}))
+    width, height = int(spec['width']), int(spec['height'])
+    target_w, target_h = int(spec['target_width']), int(spec['target_height'])
+    if target_w >= width or target_h >= height:
+        raise ValueError('Targets of %d x %d do not fit in %d x %d frames' % (target_w, target_h, width, height))
+    rng = np.random.RandomState(spec['seed'])
+
+    # Smooth background, so that the corners are on the targets, and one corner rich texture per target
+    background = _texture(rng, height, width, 16, smooth=8)
+    textures = [_texture(rng, target_h, target_w, 6) for _ in range(spec['targets'])]
+
+    # Start positions and directions of the targets
+    n = spec['targets']
+    limits = np.float64([width - target_w, height - target_h])
+    positions = rng.uniform(0, 1, (n, 2)) * limits
+    angles = rng.uniform(0, 2 * np.pi, n)
+    velocities = spec['speed'] * np.stack([np.cos(angles), np.sin(angles)], axis=1)
+
+    # Occluding bar in the middle of the frame
+    bar = None
+    if spec['occlusion'] > 0:
+        bar_w = max(1, int(round(spec['occlusion'] * target_w)))
+        bar = (width // 2 - bar_w // 2, width // 2 - bar_w // 2 + bar_w)
+        bar_texture = _texture(rng, height, bar[1] - bar[0], 4)
+
+    for _ in range(spec['frames']):
+        frame = background.copy()
+        corners = np.int32(np.round(positions))
+        for (x, y), texture in zip(corners, textures):
+            frame[y:y + target_h, x:x + target_w] = texture
+        if bar is not None:
+            frame[:, bar[0]:bar[1]] = bar_texture
+        if spec['noise'] > 0:
+            noise = rng.normal(0, spec['noise'], frame.shape)
+            frame = np.uint8(np.clip(frame + noise, 0, 255))
+
+        rects = np.float64(np.hstack([corners, corners + [target_w, target_h]]))
+        yield frame, rects
+
+        # Move the targets, bouncing off the borders
+        positions += velocities
+        for axis in range(2):
+            low, high = positions[:, axis] < 0, positions[:, axis] > limits[axis]
+            positions[low, axis] *= -1
+            positions[high, axis] = 2 * limits[axis] - positions[high, axis]
+            velocities[low | high, axis] *= -1
+
+
+def generate(path, spec=None):
+    """
+    Writes a synthetic sequence to a directory
+
+    :param path: directory of the sequence, created if needed
+    :param spec: dict overriding DEFAULT_SPEC
+    :return: dict of the full spec
+    """
+    spec = dict(DEFAULT_SPEC, **(spec or {}))
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    gt_files = [open(os.path.join(path, 'groundtruth.txt' if k == 0 else 'groundtruth_%d.txt' % k), 'w')
+                for k in range(spec['targets'])]
+    try:
+        for idx, (frame, rects) in enumerate(render(spec)):
+            cv2.imwrite(os.path.join(path, '%08d.jpg' % (idx + 1)), frame, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+            for f, rect in zip(gt_files, rects):
+                f.write(result_buffer.vot_polygon(rect) + '\n')
+    finally:
+        for f in gt_files:
+            f.close()
+
+    # The spec is written last, so that a partial sequence is never mistaken for a complete one
+    with open(os.path.join(path, 'spec.json'), 'w') as f:
+        json.dump(spec, f, indent=2, sort_keys=True)
+    return spec
+
+
+def open_sequence(spec=None, root='./synthetic'):
+    """
+    Returns the directory of the synthetic sequence of a spec, generating it first unless an earlier call did
+
+    :param spec: dict overriding DEFAULT_SPEC
+    :param root: directory the sequences are kept in, each in a directory named after a hash of its spec
+    :return: directory of the sequence
+    """
+    spec = dict(DEFAULT_SPEC, **(spec or {}))
+    name = hashlib.sha1(json.dumps(spec, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    path = os.path.join(root, name)
+    try:
+        with open(os.path.join(path, 'spec.json')) as f:
+            if json.load(f) == spec and len(utilities.get_jpeg(path)) == spec['frames']:
+                return path
+    except (IOError, OSError, ValueError):
+        pass
+    generate(path, spec)
+    return path
+
+
+def load_targets(path):
+    """
+    Loads the rectangles of every target of a synthetic sequence
+
+    :param path: directory of the sequence
+    :return: N x M x 4 array of rectangles of the M targets in the N frames
+    """
+    with open(os.path.join(path, 'spec.json')) as f:
+        n = json.load(f)['targets']
+    names = ['groundtruth.txt'] + ['groundtruth_%d.txt' % k for k in range(1, n)]
+    return np.stack([benchmark.load_groundtruth(os.path.join(path, name)) for name in names], axis=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a deterministic synthetic sequence with ground truth')
+    parser.add_argument('--output', required=True, help='directory the sequence is written to')
+    for key, value in sorted(DEFAULT_SPEC.items()):
+        parser.add_argument('--' + key.replace('_', '-'), type=type(value), default=value)
+    args = parser.parse_args()
+
+    spec = generate(args.output, dict((key, getattr(args, key)) for key in DEFAULT_SPEC))
+    print('%d frames of %d x %d with %d targets written to %s' % (spec['frames'], spec['width'], spec['height'],
+                                                                  spec['targets'], args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,28 +3,406 @@
 Utilities
 ===========
 This module contains multiple utility functions:
- get_jpeg => will load jpeg images and return them as an array.
+ get_jpeg => will load jpeg images and return them as an array, sorted by frame number.
+ FrameSource => will decode images on background threads into a bounded buffer, in frame order.
+ open_frames => will turn a path, an image array or a frame source into an iterable of frames.
+ TrackResult => per-frame result yielded by the tracker generators.
+ show_results => will display and/or record tracker results, keep them in a ResultBuffer and return the average
+                 positions.
+ VideoWriter => will encode video frames on a background thread behind a bounded queue.
  plot_pixel_position => will plot pixel location given an array.
  rect_resize => will resize a rectangle given an array of points.
+ rects_resize => will resize many rectangles at once, each given the points assigned to it.
+ points_in_rects => will assign points to the rectangles they lie strictly inside.
+ expand_rect => will grow a rectangle around its center, clipped to the image.
+ rect_overlap => will compute the intersection over union of rectangles.
 """
 
 import cv2
 import os
+import re
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import queue
 import matplotlib.pyplot as plt
 import numpy as np
 
+import instrumentation
+import result_buffer
+
+
+def _frame_number(name):
+    """
+    Sort key that orders file names by the numbers they contain, so that '10.jpg' comes after '9.jpg'
+
+    :param name: file name
+    :return: list of alternating text and integer chunks of the name
+    """
+    return [int(chunk) if chunk.isdigit() else chunk for chunk in re.split(r'(\d+)', name)]
+
+
 def get_jpeg(path):
     """
-    Returns all JPEG files given a path
+    Returns all JPEG files given a path, in frame number order (os.listdir gives no ordering guarantee)
     :param path:
     """
     image_names = []
-    for f in os.listdir(path):
+    for f in sorted(os.listdir(path), key=_frame_number):
         if f.endswith(".jpg"):
-            image_names.append(path + f)
+            image_names.append(os.path.join(path, f))
     return image_names
 
 
+# imread flags decoding at a reduced size, by reduction factor: (color, grayscale). JPEG images are decoded directly
+# at the reduced size, which is much cheaper than decoding at full size and resizing
+REDUCED_FLAGS = {
+    1: (cv2.IMREAD_COLOR, cv2.IMREAD_GRAYSCALE),
+    2: (cv2.IMREAD_REDUCED_COLOR_2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+    4: (cv2.IMREAD_REDUCED_COLOR_4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    8: (cv2.IMREAD_REDUCED_COLOR_8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+}
+
+
+class FrameSource(object):
+    """
+    Iterable over decoded frames of an image sequence. Frames are decoded on background threads and kept in a bounded
+    buffer ahead of the consumer, so that JPEG decoding overlaps with tracking work. Frames are always delivered in
+    the order of the image array.
+    """
+
+    def __init__(self, imgs, grayscale=False, buffer_size=8, workers=2, start=0, reduce=1):
+        """
+        :param imgs: string array containing image file locations, or a directory containing JPEG images
+        :param grayscale: flag determining whether frames are decoded directly to single channel grayscale
+        :param buffer_size: maximum number of decoded frames held ahead of the consumer
+        :param workers: number of decoding threads
+        :param start: index of the first frame to deliver
+        :param reduce: factor the frames are reduced by while decoding, one of REDUCED_FLAGS
+        """
+        if isinstance(imgs, str):
+            imgs = get_jpeg(imgs)
+        if reduce not in REDUCED_FLAGS:
+            raise ValueError('Frames can only be reduced by one of %s' % sorted(REDUCED_FLAGS))
+        self.imgs = list(imgs)
+        self.grayscale = grayscale
+        self.reduce = reduce
+        self.buffer_size = max(1, buffer_size)
+        self.workers = max(1, workers)
+        self.start = start
+
+    def __len__(self):
+        return max(0, len(self.imgs) - self.start)
+
+    def read(self, name):
+        """
+        Decodes a single image
+
+        :param name: image file location
+        :return: decoded image
+        """
+        frame = cv2.imread(name, REDUCED_FLAGS[self.reduce][1 if self.grayscale else 0])
+        if frame is None:
+            raise IOError('Could not decode image ' + name)
+        return frame
+
+    def __iter__(self):
+        names = iter(self.imgs[self.start:])
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            # Fill the buffer with pending decodes, the oldest is always at the front
+            pending = deque()
+            for name in names:
+                pending.append(pool.submit(self.read, name))
+                if len(pending) >= self.buffer_size:
+                    break
+
+            # Hand out the oldest frame and queue up the next decode in its place
+            while pending:
+                frame = pending.popleft().result()
+                name = next(names, None)
+                if name is not None:
+                    pending.append(pool.submit(self.read, name))
+                yield frame
+
+
+# Codec and frame rate used when recording videos
+VIDEO_FOURCC = 'MJPG'
+VIDEO_FPS = 20
+
+
+class VideoWriter(object):
+    """
+    Video writer that encodes frames on a background thread, so that recording does not slow down tracking. Frames
+    are copied into a bounded queue; when the queue is full, write either blocks until there is room or drops the
+    frame, depending on the policy. The video file is opened with the size of the first frame written.
+    """
+
+    def __init__(self, video_name, fourcc=VIDEO_FOURCC, fps=VIDEO_FPS, queue_size=32, policy='block'):
+        """
+        :param video_name: File name of the video
+        :param fourcc: four character code of the codec, e.g. 'MJPG' or 'XVID'
+        :param fps: frame rate of the video
+        :param queue_size: maximum number of frames waiting to be encoded
+        :param policy: 'block' to wait for room in the queue, 'drop' to drop frames when the queue is full
+        """
+        if policy not in ('block', 'drop'):
+            raise ValueError('Unknown policy ' + str(policy))
+        self.video_name = video_name
+        self.fourcc = fourcc
+        self.fps = fps
+        self.policy = policy
+        self.queue = queue.Queue(maxsize=max(1, queue_size))
+        self.writer = None
+        self.error = None
+
+        # Statistics: frames encoded and dropped, and running totals and maxima of the encode latency of every frame
+        # and of the queue depth at every write, so that they stay constant in size however long the recording
+        self.written = 0
+        self.dropped = 0
+        self.encode_total = 0.0
+        self.encode_max = 0.0
+        self.writes = 0
+        self.depth_total = 0
+        self.depth_max = 0
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                if self.writer is None:
+                    height, width = frame.shape[:2]
+                    self.writer = cv2.VideoWriter(self.video_name, cv2.VideoWriter_fourcc(*self.fourcc), self.fps,
+                                                  (width, height), frame.ndim == 3)
+                    if not self.writer.isOpened():
+                        raise IOError('Could not open video %s with codec %s' % (self.video_name, self.fourcc))
+                start = time.perf_counter()
+                self.writer.write(frame)
+                encode = time.perf_counter() - start
+                self.encode_total += encode
+                self.encode_max = max(self.encode_max, encode)
+                self.written += 1
+            except Exception as e:
+                self.error = e
+
+    def write(self, frame):
+        """
+        Queues a copy of a frame to be encoded
+
+        :param frame: image to write
+        :return: False if the frame was dropped, True otherwise
+        """
+        if self.error is not None:
+            raise self.error
+        depth = self.queue.qsize()
+        self.writes += 1
+        self.depth_total += depth
+        self.depth_max = max(self.depth_max, depth)
+        try:
+            self.queue.put(frame.copy(), block=self.policy == 'block')
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def release(self):
+        """
+        Waits for the queued frames to be encoded and closes the video
+        """
+        self.queue.put(None)
+        self.thread.join()
+        if self.writer is not None:
+            self.writer.release()
+        if self.error is not None:
+            raise self.error
+
+    def stats(self):
+        """
+        :return: dict of frames written and dropped, mean and max encode latency in milliseconds and queue depth
+        """
+        return {'written': self.written, 'dropped': self.dropped,
+                'encode_ms_mean': self.encode_total * 1000.0 / self.written if self.written else None,
+                'encode_ms_max': self.encode_max * 1000.0 if self.written else None,
+                'queue_depth_mean': float(self.depth_total) / self.writes if self.writes else 0.0,
+                'queue_depth_max': self.depth_max}
+
+
+def open_frames(imgs, grayscale=False):
+    """
+    Returns an iterable of decoded frames. Directories and image arrays are wrapped in a FrameSource, anything else
+    (a FrameSource, a list of decoded frames) is assumed to already yield frames and is returned as is.
+
+    :param imgs: directory, string array containing image file locations, or an iterable of frames
+    :param grayscale: flag determining whether frames are decoded directly to grayscale
+    :return: iterable of frames
+    """
+    if isinstance(imgs, str) or (isinstance(imgs, (list, tuple)) and len(imgs) > 0 and isinstance(imgs[0], str)):
+        return FrameSource(imgs, grayscale=grayscale)
+    return imgs
+
+
+def to_gray(frame):
+    """
+    Returns a grayscale version of the frame, frames that were decoded as grayscale are returned unchanged
+
+    :param frame: BGR or grayscale image
+    :return: grayscale image
+    """
+    if frame.ndim == 2:
+        return frame
+    return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+
+# Per-frame result yielded by every tracker generator:
+# frame_idx - index of the frame in the sequence
+# rect - car rectangle [X min, Y min, X max, Y max], or None if the tracker has no estimate for this frame
+# center - (x, y) center of the car rectangle, or None
+# count - number of points (or detections) supporting the estimate
+# frame - the frame the result was computed on
+# points - N x 2 array of tracked points, or None
+# info - dict of tracker specific extras
+TrackResult = namedtuple('TrackResult', ['frame_idx', 'rect', 'center', 'count', 'frame', 'points', 'info'])
+
+
+def rect_center(rect):
+    """
+    Returns the center of a rectangle
+
+    :param rect: rectangle [X min, Y min, X max, Y max]
+    :return: (x, y) center
+    """
+    return np.mean([rect[0], rect[2]]), np.mean([rect[1], rect[3]])
+
+
+def expand_rect(rect, shape, expand=2.0):
+    """
+    Grows a rectangle by a factor around its center, clipped to the image
+
+    :param rect: rectangle [X min, Y min, X max, Y max]
+    :param shape: shape of the image
+    :param expand: size of the grown rectangle relative to the rectangle
+    :return: grown rectangle [X min, Y min, X max, Y max] as integers
+    """
+    cx, cy = rect_center(rect)
+    half_w = (rect[2] - rect[0]) * expand / 2.0
+    half_h = (rect[3] - rect[1]) * expand / 2.0
+    height, width = shape[:2]
+    return [int(max(0, cx - half_w)), int(max(0, cy - half_h)),
+            int(min(width, cx + half_w)), int(min(height, cy + half_h))]
+
+
+def rect_overlap(rects, gt):
+    """
+    Computes the overlap (intersection over union) of rectangles with other rectangles, row by row
+
+    :param rects: N x 4 array of rectangles [X min, Y min, X max, Y max], rows of NaN count as no estimate
+    :param gt: N x 4 array of rectangles to compare against
+    :return: array of N overlaps, 0 where there is no estimate
+    """
+    rects = np.asarray(rects, np.float64).reshape(-1, 4)
+    gt = np.asarray(gt, np.float64).reshape(-1, 4)
+    width = np.minimum(rects[:, 2], gt[:, 2]) - np.maximum(rects[:, 0], gt[:, 0])
+    height = np.minimum(rects[:, 3], gt[:, 3]) - np.maximum(rects[:, 1], gt[:, 1])
+    intersection = np.clip(width, 0, None) * np.clip(height, 0, None)
+    union = ((rects[:, 2] - rects[:, 0]) * (rects[:, 3] - rects[:, 1]) +
+             (gt[:, 2] - gt[:, 0]) * (gt[:, 3] - gt[:, 1]) - intersection)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result = intersection / union
+    return np.nan_to_num(result)
+
+
+def draw_result(result):
+    """
+    Draws a tracker result (points, detections and car rectangle) on a color copy of its frame. Results tracked on
+    reduced frames (info['scale'], see resolution.py) are in full resolution coordinates and are drawn scaled down
+    onto the reduced frame
+
+    :param result: TrackResult
+    :return: vis image
+    """
+    vis = cv2.cvtColor(result.frame, cv2.COLOR_GRAY2BGR) if result.frame.ndim == 2 else result.frame.copy()
+    scale = 1.0 / result.info.get('scale', 1)
+
+    # Draw the tracked points
+    if result.points is not None:
+        for x, y in np.int32(np.float64(result.points) * scale).reshape(-1, 2):
+            cv2.circle(vis, (int(x), int(y)), 2, (0, 255, 0), -1)
+
+    # Draw every detection in a blue rectangle
+    for (x, y, w, h) in np.float64(result.info.get('detections', ())).reshape(-1, 4) * scale:
+        cv2.rectangle(vis, (int(x), int(y)), (int(x + w), int(y + h)), (255, 0, 0))
+
+    # Draw the car rectangle, or every target rectangle of a multi-target result
+    if result.rect is not None:
+        for rect in np.int32(np.float64(result.rect) * scale).reshape(-1, 4):
+            rect = [int(v) for v in rect]
+            cv2.rectangle(vis, (rect[0], rect[1]), (rect[2], rect[3]), 255)
+    return vis
+
+
+def show_results(results, window_name='frame', display_image=True, write_video=False, video_name='out.avi', writer=None,
+                 probe=instrumentation.NULL_PROBE, results_path=None, vot_path=None):
+    """
+    Consumes the results of a tracker generator, optionally displaying and recording them. Nothing is drawn when
+    neither display nor recording is requested, so headless runs go at the speed of the tracker. Every result is kept
+    in a columnar ResultBuffer, streamed to disk as it arrives if paths are given.
+
+    :param results: iterable of TrackResult
+    :param window_name: name of the display window
+    :param display_image: flag determining whether or not to display the image stream
+    :param write_video: Flag determining whether or not to record image stream
+    :param video_name: File name of image stream
+    :param writer: optional VideoWriter to record to instead of one opened on video_name, it is released at the end
+    :param probe: instrumentation probe the draw, display and write stages are reported to, its per-frame stage
+                  timings are kept with the results when it is enabled
+    :param results_path: optional result directory the results are streamed to, see result_buffer.py
+    :param vot_path: optional text file the rectangles are streamed to in the VOT groundtruth polygon format
+    :return: N x 2 array of average locations of the car rect, for the frames with an estimate, N x M x 2 with M cars
+    """
+    buffer = result_buffer.ResultBuffer(results_path, vot_path)
+    write_video = write_video or writer is not None
+    for result in results:
+        # Keep the result, with the timings the probe recorded for the frame so far
+        timings = probe.current['stages'] if probe.enabled and probe.current is not None else None
+        confidence = result.info.get('confidence')
+        buffer.append(result, timings, confidence if np.isscalar(confidence) else None)
+
+        if not (display_image or write_video):
+            continue
+        with probe.stage('draw'):
+            vis = draw_result(result)
+
+        # Write to video, encoded on a background thread
+        if write_video:
+            with probe.stage('write'):
+                if writer is None:
+                    writer = VideoWriter(video_name)
+                writer.write(vis)
+
+        if display_image:
+            with probe.stage('display'):
+                cv2.imshow(window_name, vis)
+                k = cv2.waitKey(30) & 0xff
+            if k == 27:
+                break
+
+    # Close the image sequence viewer and release the video
+    if display_image:
+        cv2.destroyAllWindows()
+    if writer is not None:
+        writer.release()
+    buffer.close()
+    return buffer.centers()
+
+
 def plot_pixel_position(pos):
     """
     :param pos:
@@ -63,26 +441,61 @@ def rect_resize(rect, car_points, buffer=40):
     return np.int32(rect)
 
 
+def points_in_rects(points, rects):
+    """
+    Assigns points to rectangles, all at once
+
+    :param points: N x 2 array of points
+    :param rects: M x 4 array of rectangles [X min, Y min, X max, Y max]
+    :return: M x N boolean array marking the points strictly inside each rectangle
+    """
+    x, y = np.asarray(points).reshape(-1, 2).T
+    rects = np.asarray(rects).reshape(-1, 4)
+    return ((x > rects[:, 0:1]) & (x < rects[:, 2:3]) & (y > rects[:, 1:2]) & (y < rects[:, 3:4]))
+
+
+def rects_resize(rects, points, inside, buffer=40):
+    """
+    Resizes many rectangles at once, the same way rect_resize does for one. Every rectangle moves halfway towards the
+    buffered bounds of the points assigned to it, rectangles without points are left as they are
+
+    :param rects: M x 4 array of rectangles [X min, Y min, X max, Y max]
+    :param points: N x 2 array of points
+    :param inside: M x N boolean array assigning the points to the rectangles, as returned by points_in_rects
+    :param buffer: amount the bounds of the points are grown by
+    :return: M x 4 int32 array of resized rectangles
+    """
+    rects = np.int32(rects).reshape(-1, 4)
+    points = np.asarray(points).reshape(-1, 2)
+    has_points = inside.any(axis=1)
+    if not has_points.any():
+        return rects.copy()
+
+    # Bounds of the assigned points of every rectangle, masking out the points assigned elsewhere
+    x, y = points.T
+    inf = np.array(np.inf, points.dtype)
+    bounds = np.stack([np.where(inside, x, inf).min(axis=1) - buffer,
+                       np.where(inside, y, inf).min(axis=1) - buffer,
+                       np.where(inside, x, -inf).max(axis=1) + buffer,
+                       np.where(inside, y, -inf).max(axis=1) + buffer], axis=1)
+
+    resized = rects.copy()
+    resized[has_points] = (rects[has_points] + np.float64(bounds[has_points])) / 2
+    return resized
+
+
 if __name__ == '__main__':
 
     # Load images into array
     imgs = get_jpeg('C:/Users/Drew/Dropbox/Uber_Assignment/uber_cv_car_exercise/car/')
 
-    # Begin video capture of images
-    cap = cv2.VideoCapture(imgs[0])
-    idx = 0
-
-    # Loop through images, end once at the end of the image array
-    while idx < len(imgs):
-        ret, frame = cap.read()
+    # Loop through images, decoded in the background, end once at the end of the image array
+    for frame in FrameSource(imgs):
         cv2.imshow('Frame', frame)
         k = cv2.waitKey(30) & 0xff
         if k == 27:
             break
 
-        # Update the index
-        idx += 1
-
     # Close all windows
     cv2.destroyAllWindows()
 